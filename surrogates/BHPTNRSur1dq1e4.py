@@ -4,6 +4,8 @@
 ## Author : Tousif Islam, Aug 2022 [tislam@umassd.edu / tousifislam24@gmail.com]
 ##==============================================================================
 
+import functools
+import threading
 import warnings
 
 import numpy as np
@@ -13,7 +15,9 @@ from .model_utils import load_surrogates as load
 from .model_utils import eval_surrogates as eval_sur
 from .common_utils import utils, fits
 from .common_utils import nr_calibration as nrcalib
+from .common_utils import load_splines as load_spl
 from .common_utils import doc_string as docs
+from .common_utils.workspace import Workspace
 
 # h5 data directory
 h5_data_dir = os.path.dirname(os.path.abspath(__file__)) + '/../data'
@@ -21,23 +25,79 @@ h5_data_dir = os.path.dirname(os.path.abspath(__file__)) + '/../data'
 # lazy-loaded surrogate data cache
 _surrogate_data = {}
 
+# held while the surrogate data is loaded so that concurrent first calls load it only once
+_load_lock = threading.Lock()
+
 _SURROGATE_KEYS = (
     'time', 'fit_data_dict_1', 'fit_data_dict_2',
-    'B_dict_1', 'B_dict_2', 'alpha_coeffs', 'beta_coeffs',
+    'B_dict_1', 'B_dict_2', 'alpha_coeffs', 'beta_coeffs', 'packed_fits',
 )
 
-def _ensure_loaded():
-    """Load the surrogate data from H5 file on first access."""
-    if not _surrogate_data:
-        time, fit_data_dict_1, fit_data_dict_2, B_dict_1, B_dict_2, \
-            alpha_coeffs, beta_coeffs = load.load_BHPTNRSur1dq1e4_surrogate(h5_data_dir)
-        _surrogate_data['time'] = time
-        _surrogate_data['fit_data_dict_1'] = fit_data_dict_1
-        _surrogate_data['fit_data_dict_2'] = fit_data_dict_2
-        _surrogate_data['B_dict_1'] = B_dict_1
-        _surrogate_data['B_dict_2'] = B_dict_2
-        _surrogate_data['alpha_coeffs'] = alpha_coeffs
-        _surrogate_data['beta_coeffs'] = beta_coeffs
+def _ensure_loaded(mmap=None, workers=None):
+    """Load the surrogate data on first access, from the compiled cache if there is one.
+    With mmap=True (or BHPTNRSUR_MMAP=1) the arrays are read-only views of the memory-mapped
+    cache, shared between all processes that map it.
+    With workers > 1 (or BHPTNRSUR_LOAD_WORKERS > 1) all modes are read from the H5 file
+    right away by that many threads instead of on first use (see common_utils/parallel_io.py)."""
+    if _surrogate_data:
+        return
+    with _load_lock:
+        if not _surrogate_data:
+            data = load.load_surrogate_data('BHPTNRSur1dq1e4', h5_data_dir,
+                                            functools.partial(_parse_h5, workers=workers), mmap=mmap)
+            # published with a single update() so that readers never see a partially filled dict
+            _surrogate_data.update(data)
+
+def preload(mmap=None, workers=None):
+    """
+    Load the surrogate data now instead of on the first call to generate_surrogate(),
+    e.g. at the start of a service. Safe to call from several threads; the data is
+    loaded once. See _ensure_loaded() for the mmap and workers options.
+    """
+    _ensure_loaded(mmap=mmap, workers=workers)
+
+def preload_async(mmap=None, workers=None):
+    """
+    Start loading the surrogate data in a background thread and return a
+    concurrent.futures.Future that completes once the data is loaded (or holds the
+    exception raised while loading). Waveform calls made in the meantime wait only
+    for the remainder of the load.
+    """
+    return load.run_in_background(preload, 'BHPTNRSur1dq1e4-preload', mmap=mmap, workers=workers)
+
+def freeze(modes=None, lmax=5, gc_freeze=True):
+    """
+    Prepare the model to be shared by forked processes, e.g. the workers of a prefork
+    server; call it in the parent before forking. The surrogate data is loaded, the packed
+    fits of the given modes (default: all modes up to lmax) are built by evaluating one
+    waveform, and the data is then repacked into one contiguous read-only buffer with plain
+    dictionaries of views as index tables. With gc_freeze=True, gc.freeze() keeps the
+    garbage collector from touching the objects of the parent in the children.
+    """
+    generate_surrogate(q=10.0, modes=modes, lmax=lmax)
+    load.freeze_surrogate_data(_surrogate_data, _load_lock, gc_freeze=gc_freeze)
+
+def _parse_h5(h5_data_dir, workers=None):
+    """Open the H5 file; the data of each mode is read when it is first used, or right away
+    by workers threads for workers > 1."""
+    time, fit_data_dict_1, fit_data_dict_2, B_dict_1, B_dict_2, \
+        alpha_coeffs, beta_coeffs = load.load_BHPTNRSur1dq1e4_surrogate(h5_data_dir, check_hash=False,
+                                                                        lazy=True, workers=workers)
+    # stacked spline data of each set of evaluated modes, built on first use
+    return {'time': time, 'fit_data_dict_1': fit_data_dict_1, 'fit_data_dict_2': fit_data_dict_2,
+            'B_dict_1': B_dict_1, 'B_dict_2': B_dict_2, 'alpha_coeffs': alpha_coeffs,
+            'beta_coeffs': beta_coeffs, 'packed_fits': {}}
+
+def compile_surrogate(workers=None):
+    """
+    Parse the H5 file once and write the compiled cache that later sessions load
+    instead of the H5 file. The cache is written next to the H5 file, or to the
+    BHPTNRSUR_CACHE_DIR directory if that environment variable is set.
+    With workers > 1 the modes are read by that many threads.
+    Returns the path of the cache file.
+    """
+    return load.compile_surrogate_data('BHPTNRSur1dq1e4', h5_data_dir,
+                                       functools.partial(_parse_h5, workers=workers))
 
 def __getattr__(name):
     """Lazy access to surrogate data attributes at the module level."""
@@ -51,21 +111,81 @@ def __getattr__(name):
 @docs.copy_doc(docs.generic_doc_for_models,docs.BHPTNRSur1dq1e4_doc)
 def generate_surrogate(q, spin1=None, spin2=None, ecc=None, ano=None, modes=None, M_tot=None, \
                        dist_mpc=None, orb_phase=None, inclination=None, neg_modes=True, \
-                       mode_sum=False, lmax=5, calibrated=True, mass_scale='M'):
+                       mode_sum=False, lmax=5, calibrated=True, mass_scale='M', out=None,
+                       workspace=None, output='complex', workers=None):
 
     _ensure_loaded()
 
-    # modes modelled in the surrogate
-    modes_available = [(2,2),(2,1),(3,1),(3,2),(3,3),(4,2),(4,3),(4,4),(5,3),(5,4),(5,5),
-               (6,4),(6,5),(6,6),(7,5),(7,6),(7,7),(8,6),(8,7),(8,8),(9,7),(9,8),
-               (9,9),(10,8),(10,9)]
+    # warn about ignored inputs and obtain the mass scale of uncalibrated waveforms
+    mass_factor = _check_options(q, spin1, spin2, ecc, ano, calibrated, mass_scale)
+
+    # define the parameterization for surrogate
+    X_sur = np.log10(q)
+
+    # define parameterization for nr calibration
+    X_calib = 1/q
+
+    # normalization parameter to be multiplied with the surrogate waveform
+    norm = 1/q
+
+    return _evaluate(X_sur, X_calib, norm, mass_factor, modes, M_tot, dist_mpc, orb_phase,
+                     inclination, neg_modes, mode_sum, lmax, calibrated,
+                     out=out, workspace=workspace, output=output, workers=workers)
+
+#----------------------------------------------------------------------------------------------------
+def generate_surrogate_batch(q, spin1=None, spin2=None, ecc=None, ano=None, modes=None, M_tot=None, \
+                             dist_mpc=None, orb_phase=None, inclination=None, neg_modes=True, \
+                             mode_sum=False, lmax=5, calibrated=True, mass_scale='M',
+                             output='complex', workers=None):
+    """
+    Generates BHPTNRSur1dq1e4 waveforms for a batch of mass ratios at once.
+
+    Takes the same inputs as generate_surrogate(), except that q is an array of N mass
+    ratios. M_tot, dist_mpc, orb_phase and inclination can be scalars shared by the whole
+    batch or arrays with one value per waveform. The spline fits of all waveforms are
+    evaluated together and the EIM reconstruction is a matrix-matrix product per mode.
+
+    Output
+    ======
+    t : time, array of shape (N, n_times); each waveform has its own (calibrated) time
+    h : waveform modes as a dictionary of arrays of shape (N, n_times)
+        (array of shape (N, n_times) if mode_sum=True; pairs of amplitude and phase arrays
+        of shape (N, n_times) if output='amp_phase')
+    """
+
+    _ensure_loaded()
+
+    q = np.atleast_1d(np.asarray(q, dtype=float))
+    if q.ndim != 1:
+        raise ValueError("q must be a scalar or a 1d array of mass ratios")
+
+    # warn about ignored inputs and obtain the mass scale of uncalibrated waveforms
+    mass_factor = _check_options(q, spin1, spin2, ecc, ano, calibrated, mass_scale)
+
+    # per-waveform quantities are columns so that they broadcast against (N, n_times)
+    n_batch = len(q)
+    q = q[:, None]
+    M_tot = utils.batch_column(M_tot, n_batch, 'M_tot')
+    dist_mpc = utils.batch_column(dist_mpc, n_batch, 'dist_mpc')
+    orb_phase = utils.batch_column(orb_phase, n_batch, 'orb_phase')
+    inclination = utils.batch_column(inclination, n_batch, 'inclination')
+
+    return _evaluate(np.log10(q), 1/q, 1/q, mass_factor[:, None], modes, M_tot, dist_mpc,
+                     orb_phase, inclination, neg_modes, mode_sum, lmax, calibrated, output=output,
+                     workers=workers)
+
+#----------------------------------------------------------------------------------------------------
+def _check_options(q, spin1, spin2, ecc, ano, calibrated, mass_scale):
+    """ Warns about ignored inputs, validates mass_scale and returns the factor applied
+        to time and strain of uncalibrated waveforms.
+    """
 
     # Warning to user if inputs include spin or eccentricity
     ignored = {k for k, v in [("spin1", spin1), ("spin2", spin2), ("ecc", ecc), ("ano", ano)] if v is not None}
     if ignored:
         warnings.warn(
             "Model only takes [q] as input. Ignoring extra params: %s" % ", ".join(sorted(ignored)),
-            stacklevel=2,
+            stacklevel=3,
         )
 
     # validate mass_scale parameter
@@ -75,27 +195,33 @@ def generate_surrogate(q, spin1=None, spin2=None, ecc=None, ano=None, modes=None
     if calibrated and mass_scale != 'M':
         warnings.warn(
             "mass_scale is ignored when calibrated=True (NR calibration already uses total mass M)",
-            stacklevel=2,
+            stacklevel=3,
         )
 
     # compute mass_factor for uncalibrated waveforms
     if not calibrated and mass_scale == 'M':
         mass_factor = 1.0 / (1.0 + 1.0/q)
     else:
-        mass_factor = 1.0
+        mass_factor = np.ones_like(q, dtype=float) if np.ndim(q) else 1.0
 
-    # modes requested
-    if modes==None:
-        modes = modes_available
+    return mass_factor
 
-    # define the parameterization for surrogate
-    X_sur = np.log10(q)
+#----------------------------------------------------------------------------------------------------
+def _evaluate(X_sur, X_calib, norm, mass_factor, modes, M_tot, dist_mpc, orb_phase, inclination,
+              neg_modes, mode_sum, lmax, calibrated, out=None, workspace=None,
+              output='complex', workers=None):
+    """ Evaluates the surrogate for given parameterizations; a batch of N waveforms
+        is evaluated when the inputs are columns of shape (N, 1)
+    """
 
-    # define parameterization for nr calibration
-    X_calib = 1/q
+    # modes modelled in the surrogate
+    modes_available = [(2,2),(2,1),(3,1),(3,2),(3,3),(4,2),(4,3),(4,4),(5,3),(5,4),(5,5),
+               (6,4),(6,5),(6,6),(7,5),(7,6),(7,7),(8,6),(8,7),(8,8),(9,7),(9,8),
+               (9,9),(10,8),(10,9)]
 
-    # normalization parameter to be multiplied with the surrogate waveform
-    norm = 1/q
+    # modes requested
+    if modes==None:
+        modes = modes_available
 
     # domain of validity
     X_min = [np.log10(2.5)]
@@ -115,6 +241,14 @@ def generate_surrogate(q, spin1=None, spin2=None, ecc=None, ano=None, modes=None
     # to inertial frame
     CoorbToInert = True
 
+    # stacked spline data of the evaluated modes, to evaluate all their EIM nodes at once
+    packed_fits = None
+    if _surrogate_data.get('packed_fits') is not None:
+        packed_fits = fits.packed_fits_for_modes(_surrogate_data['packed_fits'], modes, lmax,
+                                                 _surrogate_data['fit_data_dict_1'],
+                                                 _surrogate_data['fit_data_dict_2'],
+                                                 load_spl.pack_spline_fits)
+
     # generate surrogate waveform
     t_surrogate, h_surrogate = eval_sur.evaluate_surrogate(X_sur, X_calib, X_bounds,
                                         _surrogate_data['time'], modes,
@@ -126,6 +260,8 @@ def generate_surrogate(q, spin1=None, spin2=None, ecc=None, ano=None, modes=None
                                         _surrogate_data['B_dict_1'], _surrogate_data['B_dict_2'],
                                         fit_func, decomposition_funcs,\
                                         norm, mode_sum, neg_modes, lmax, CoorbToInert,
-                                        mass_factor=mass_factor)
+                                        mass_factor=mass_factor,
+                                        packed_fits=packed_fits, out=out, workspace=workspace,
+                                        output=output, workers=workers)
 
     return t_surrogate, h_surrogate
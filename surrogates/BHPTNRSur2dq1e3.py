@@ -5,6 +5,8 @@
 ## Modified : Tousif Islam, Jul 2023
 ##==============================================================================
 
+import functools
+import threading
 import warnings
 
 import numpy as np
@@ -14,7 +16,11 @@ from .model_utils import load_surrogates as load
 from .model_utils import eval_surrogates as eval_sur
 from .common_utils import utils, fits
 from .common_utils import nr_calibration as nrcalib
+from .common_utils import load_GPRs as load_gpr
+from .common_utils import lazy_modes
+from .common_utils import parallel_io
 from .common_utils import doc_string as docs
+from .common_utils.workspace import Workspace
 
 # h5 data directory
 h5_data_dir = os.path.dirname(os.path.abspath(__file__)) + '/../data'
@@ -22,23 +28,118 @@ h5_data_dir = os.path.dirname(os.path.abspath(__file__)) + '/../data'
 # lazy-loaded surrogate data cache
 _surrogate_data = {}
 
+# held while the surrogate data is loaded so that concurrent first calls load it only once
+_load_lock = threading.Lock()
+
 _SURROGATE_KEYS = (
     'times_dict', 'fit_data_dict_1_sign', 'fit_data_dict_2_sign',
-    'B_dict_1_sign', 'B_dict_2_sign', 'alpha_coeffs', 'beta_coeffs',
+    'B_dict_1_sign', 'B_dict_2_sign', 'alpha_coeffs', 'beta_coeffs', 'packed_fits_sign',
 )
 
-def _ensure_loaded():
-    """Load the surrogate data from H5 file on first access."""
-    if not _surrogate_data:
-        times_dict, fit_data_dict_1_sign, fit_data_dict_2_sign, B_dict_1_sign, B_dict_2_sign, \
-            alpha_coeffs, beta_coeffs = load.load_BHPTNRSur2dq1e3_surrogate(h5_data_dir)
-        _surrogate_data['times_dict'] = times_dict
-        _surrogate_data['fit_data_dict_1_sign'] = fit_data_dict_1_sign
-        _surrogate_data['fit_data_dict_2_sign'] = fit_data_dict_2_sign
-        _surrogate_data['B_dict_1_sign'] = B_dict_1_sign
-        _surrogate_data['B_dict_2_sign'] = B_dict_2_sign
-        _surrogate_data['alpha_coeffs'] = alpha_coeffs
-        _surrogate_data['beta_coeffs'] = beta_coeffs
+# the two sub-surrogates, and the keys of their data in _surrogate_data
+_SPIN_SIGNS = ('negative_spin', 'positive_spin')
+_SUB_SURROGATE_KEYS = {
+    'times_dict': 'times', 'fit_data_dict_1_sign': 'fit_data_dict_1',
+    'fit_data_dict_2_sign': 'fit_data_dict_2', 'B_dict_1_sign': 'B_dict_1',
+    'B_dict_2_sign': 'B_dict_2', 'packed_fits_sign': 'packed_fits',
+}
+
+def _ensure_loaded(mmap=None, workers=None):
+    """Load the surrogate data on first access, from the compiled cache if there is one.
+    The two sub-surrogates are loaded independently, each when it is first used.
+    With mmap=True (or BHPTNRSUR_MMAP=1) the arrays are read-only views of the memory-mapped
+    cache, shared between all processes that map it.
+    With workers > 1 (or BHPTNRSUR_LOAD_WORKERS > 1) all modes of a sub-surrogate are read
+    from the H5 file by that many threads when it is loaded (see common_utils/parallel_io.py)."""
+    if _surrogate_data:
+        return
+    with _load_lock:
+        if not _surrogate_data:
+            file_hash = load.check_h5_file('BHPTNRSur2dq1e3', h5_data_dir)
+            data = load.load_surrogate_data('BHPTNRSur2dq1e3', h5_data_dir, _parse_h5, mmap=mmap,
+                                            file_hash=file_hash)
+
+            def load_sub_surrogate(spin_sign):
+                return load.load_surrogate_data('BHPTNRSur2dq1e3', h5_data_dir,
+                                                functools.partial(_parse_h5_sub_surrogate,
+                                                                  spin_sign=spin_sign, workers=workers),
+                                                mmap=mmap, part=spin_sign, file_hash=file_hash)
+
+            # e.g. _surrogate_data['times_dict'][spin_sign] loads the sub-surrogate on first access
+            sub_surrogates = lazy_modes.LazyModeDict(_SPIN_SIGNS, load_sub_surrogate)
+            for key, sub_key in _SUB_SURROGATE_KEYS.items():
+                data[key] = lazy_modes.LazyModeDict(_SPIN_SIGNS, lambda spin_sign, sub_key=sub_key:
+                                                    sub_surrogates[spin_sign][sub_key])
+            # published with a single update() so that readers never see a partially filled dict
+            _surrogate_data.update(data)
+
+def preload(mmap=None, workers=None):
+    """
+    Load the surrogate data now instead of on the first call to generate_surrogate(),
+    e.g. at the start of a service. Safe to call from several threads; the data is
+    loaded once. See _ensure_loaded() for the mmap and workers options; with
+    workers > 1 both sub-surrogates are loaded now, concurrently. With mmap=True (or
+    BHPTNRSUR_MMAP=1) both sub-surrogates are loaded now as well, so that their caches are
+    compiled before worker processes map them (see model_utils/sweep.py).
+    """
+    _ensure_loaded(mmap=mmap, workers=workers)
+    workers = parallel_io.n_workers(workers)
+    if workers > 1 or load.resolve_mmap(mmap):
+        parallel_io.read_all(_surrogate_data['times_dict'].__getitem__, _SPIN_SIGNS, workers)
+
+def preload_async(mmap=None, workers=None):
+    """
+    Start loading the surrogate data in a background thread and return a
+    concurrent.futures.Future that completes once the data is loaded (or holds the
+    exception raised while loading). Waveform calls made in the meantime wait only
+    for the remainder of the load.
+    """
+    return load.run_in_background(preload, 'BHPTNRSur2dq1e3-preload', mmap=mmap, workers=workers)
+
+def freeze(modes=None, lmax=4, gc_freeze=True):
+    """
+    Prepare the model to be shared by forked processes, e.g. the workers of a prefork
+    server; call it in the parent before forking. Both sub-surrogates are loaded, the
+    packed fits of the given modes (default: all modes up to lmax) are built by evaluating
+    one waveform with each, and the data is then repacked into one contiguous read-only
+    buffer with plain dictionaries of views as index tables. With gc_freeze=True,
+    gc.freeze() keeps the garbage collector from touching the objects of the parent in
+    the children.
+    """
+    for spin1 in [-0.1, 0.1]:
+        generate_surrogate(q=10.0, spin1=spin1, modes=modes, lmax=lmax)
+    load.freeze_surrogate_data(_surrogate_data, _load_lock, gc_freeze=gc_freeze)
+
+def _parse_h5(h5_data_dir):
+    """Read the data shared by both sub-surrogates from the H5 file."""
+    alpha_coeffs, beta_coeffs = load.load_BHPTNRSur2dq1e3_nrcalib_info(h5_data_dir)
+    return {'alpha_coeffs': alpha_coeffs, 'beta_coeffs': beta_coeffs}
+
+def _parse_h5_sub_surrogate(h5_data_dir, spin_sign, workers=None):
+    """Open one sub-surrogate in the H5 file; the data of each mode is read when it is first used,
+    or right away by workers threads for workers > 1."""
+    times, fit_data_dict_1, fit_data_dict_2, B_dict_1, B_dict_2 = \
+        load.load_BHPTNRSur2dq1e3_sub_surrogate(h5_data_dir, spin_sign, workers=workers)
+    # stacked GPR data of each set of evaluated modes, built on first use
+    return {'times': times, 'fit_data_dict_1': fit_data_dict_1, 'fit_data_dict_2': fit_data_dict_2,
+            'B_dict_1': B_dict_1, 'B_dict_2': B_dict_2, 'packed_fits': {}}
+
+def compile_surrogate(workers=None):
+    """
+    Parse the H5 file once and write the compiled caches that later sessions load
+    instead of the H5 file: one for the shared nr calibration data and one for each
+    sub-surrogate. The caches are written next to the H5 file, or to the
+    BHPTNRSUR_CACHE_DIR directory if that environment variable is set.
+    With workers > 1 the modes are read by that many threads.
+    Returns the paths of the cache files.
+    """
+    paths = [load.compile_surrogate_data('BHPTNRSur2dq1e3', h5_data_dir, _parse_h5)]
+    for spin_sign in _SPIN_SIGNS:
+        paths.append(load.compile_surrogate_data('BHPTNRSur2dq1e3', h5_data_dir,
+                                                 functools.partial(_parse_h5_sub_surrogate,
+                                                                   spin_sign=spin_sign, workers=workers),
+                                                 part=spin_sign))
+    return paths
 
 def __getattr__(name):
     """Lazy access to surrogate data attributes at the module level."""
@@ -52,21 +153,126 @@ def __getattr__(name):
 @docs.copy_doc(docs.generic_doc_for_models,docs.BHPTNRSur2dq1e3_doc)
 def generate_surrogate(q, spin1=0.0, spin2=None, ecc=None, ano=None, modes=None, M_tot=None, dist_mpc=None,
                        orb_phase=None, inclination=None, neg_modes=True, mode_sum=False, lmax=4,
-                       calibrated=True, mass_scale='M'):
+                       calibrated=True, mass_scale='M', out=None,
+                       workspace=None, output='complex', workers=None):
 
     _ensure_loaded()
 
-    # list the modes modelled in BHPTNRSur2dq1e3
-    modes_available = [(2,2),(2,1),(3,1),(3,2),(3,3),(4,2),(4,3),(4,4)]
-    if modes==None:
-        modes = modes_available
+    # warn about ignored inputs and obtain the mass scale of uncalibrated waveforms
+    mass_factor = _check_options(q, spin2, ecc, ano, calibrated, mass_scale)
+
+    # this model provide fits for the positive spin and negative spin cases differently
+    # choose appropriate fit params here depending on the input spin value
+    if spin1 < 0.0:
+        spin_sign = 'negative_spin'
+    else:
+        spin_sign = 'positive_spin'
+
+    # define the parameterization for surrogate
+    X_sur = [np.log10(q), spin1]
+
+    # define parameterization for nr calibration
+    X_calib = [q, spin1]
+
+    # normalization parameter to be multiplied with the surrogate waveform
+    norm = 1/q
+
+    return _evaluate(spin_sign, X_sur, X_calib, norm, mass_factor, modes, M_tot, dist_mpc,
+                     orb_phase, inclination, neg_modes, mode_sum, lmax, calibrated,
+                     out=out, workspace=workspace, output=output, workers=workers)
+
+#----------------------------------------------------------------------------------------------------
+def generate_surrogate_batch(q, spin1=0.0, spin2=None, ecc=None, ano=None, modes=None, M_tot=None,
+                             dist_mpc=None, orb_phase=None, inclination=None, neg_modes=True,
+                             mode_sum=False, lmax=4, calibrated=True, mass_scale='M',
+                             output='complex', workers=None):
+    """
+    Generates BHPTNRSur2dq1e3 waveforms for a batch of (q, spin1) values at once.
+
+    Takes the same inputs as generate_surrogate(), except that q and spin1 are arrays of
+    N values (a scalar spin1 is shared by the whole batch). M_tot, dist_mpc, orb_phase and
+    inclination can be scalars shared by the whole batch or arrays with one value per
+    waveform. Waveforms with negative and non-negative spins are evaluated with their
+    respective sub-surrogates, each as one batch.
+
+    Output
+    ======
+    t : time, array of shape (N, n_times); each waveform has its own (calibrated) time
+    h : waveform modes as a dictionary of arrays of shape (N, n_times)
+        (array of shape (N, n_times) if mode_sum=True; pairs of amplitude and phase arrays
+        of shape (N, n_times) if output='amp_phase')
+    """
+
+    _ensure_loaded()
+
+    q = np.atleast_1d(np.asarray(q, dtype=float))
+    if q.ndim != 1:
+        raise ValueError("q must be a scalar or a 1d array of mass ratios")
+    spin1 = np.broadcast_to(np.asarray(spin1, dtype=float), q.shape)
+
+    # warn about ignored inputs and obtain the mass scale of uncalibrated waveforms
+    mass_factor = _check_options(q, spin2, ecc, ano, calibrated, mass_scale)
+
+    # per-waveform quantities are columns so that they broadcast against (N, n_times)
+    n_batch = len(q)
+    extrinsic_params = [utils.batch_column(M_tot, n_batch, 'M_tot'),
+                        utils.batch_column(dist_mpc, n_batch, 'dist_mpc'),
+                        utils.batch_column(orb_phase, n_batch, 'orb_phase'),
+                        utils.batch_column(inclination, n_batch, 'inclination')]
+
+    # evaluate each spin sign with its own sub-surrogate
+    results = []
+    for spin_sign, rows in [('negative_spin', np.flatnonzero(spin1 < 0.0)),
+                            ('positive_spin', np.flatnonzero(spin1 >= 0.0))]:
+        if len(rows) == 0:
+            continue
+        q_sub, spin1_sub = q[rows, None], spin1[rows, None]
+        M_tot_sub, dist_mpc_sub, orb_phase_sub, inclination_sub = \
+                [x if np.ndim(x) == 0 else x[rows] for x in extrinsic_params]
+        t_sub, h_sub = _evaluate(spin_sign, np.hstack([np.log10(q_sub), spin1_sub]),
+                                 [q_sub, spin1_sub], 1/q_sub, mass_factor[rows, None], modes,
+                                 M_tot_sub, dist_mpc_sub, orb_phase_sub, inclination_sub,
+                                 neg_modes, mode_sum, lmax, calibrated, output=output,
+                                 workers=workers)
+        results.append((rows, t_sub, h_sub))
+
+    if len(results) == 1:
+        return results[0][1], results[0][2]
+
+    # combine both sub-surrogates into the original ordering of the batch
+    if results[0][1].shape[1] != results[1][1].shape[1]:
+        raise ValueError("The negative and positive spin sub-surrogates have different time "
+                         "grids; evaluate batches with a single spin sign instead")
+    t_surrogate = np.empty((n_batch, results[0][1].shape[1]))
+    if mode_sum:
+        h_surrogate = np.empty((n_batch, results[0][1].shape[1]), dtype=complex)
+    else:
+        # the batch is the second to last axis of the complex or amplitude/phase modes
+        data = results[0][2].data
+        h_surrogate = results[0][2].with_data(np.empty(data.shape[:-2] + (n_batch, data.shape[-1]),
+                                                       dtype=data.dtype))
+    for rows, t_sub, h_sub in results:
+        t_surrogate[rows] = t_sub
+        if mode_sum:
+            h_surrogate[rows] = h_sub
+        else:
+            # all modes at once
+            h_surrogate.data[..., rows, :] = h_sub.data
+
+    return t_surrogate, h_surrogate
+
+#----------------------------------------------------------------------------------------------------
+def _check_options(q, spin2, ecc, ano, calibrated, mass_scale):
+    """ Warns about ignored inputs, validates mass_scale and returns the factor applied
+        to time and strain of uncalibrated waveforms.
+    """
 
     # Warning to user if inputs include secondary spin or eccentricity
     ignored = {k for k, v in [("spin2", spin2), ("ecc", ecc), ("ano", ano)] if v is not None}
     if ignored:
         warnings.warn(
             "Model only takes [q, spin1] as input. Ignoring extra params: %s" % ", ".join(sorted(ignored)),
-            stacklevel=2,
+            stacklevel=3,
         )
 
     # validate mass_scale parameter
@@ -76,38 +282,43 @@ def generate_surrogate(q, spin1=0.0, spin2=None, ecc=None, ano=None, modes=None,
     if calibrated and mass_scale != 'M':
         warnings.warn(
             "mass_scale is ignored when calibrated=True (NR calibration already uses total mass M)",
-            stacklevel=2,
+            stacklevel=3,
         )
 
     # compute mass_factor for uncalibrated waveforms
     if not calibrated and mass_scale == 'M':
         mass_factor = 1.0 / (1.0 + 1.0/q)
     else:
-        mass_factor = 1.0
+        mass_factor = np.ones_like(q, dtype=float) if np.ndim(q) else 1.0
 
-    # this model provide fits for the positive spin and negative spin cases differently
-    # choose appropriate fit params here depending on the input spin value
-    if spin1 < 0.0:
-        times = _surrogate_data['times_dict']['negative_spin']
-        fit_data_dict_1 = _surrogate_data['fit_data_dict_1_sign']['negative_spin']
-        fit_data_dict_2 = _surrogate_data['fit_data_dict_2_sign']['negative_spin']
-        B_dict_1 = _surrogate_data['B_dict_1_sign']['negative_spin']
-        B_dict_2 = _surrogate_data['B_dict_2_sign']['negative_spin']
-    else:
-        times = _surrogate_data['times_dict']['positive_spin']
-        fit_data_dict_1 = _surrogate_data['fit_data_dict_1_sign']['positive_spin']
-        fit_data_dict_2 = _surrogate_data['fit_data_dict_2_sign']['positive_spin']
-        B_dict_1 = _surrogate_data['B_dict_1_sign']['positive_spin']
-        B_dict_2 = _surrogate_data['B_dict_2_sign']['positive_spin']
+    return mass_factor
 
-    # define the parameterization for surrogate
-    X_sur = [np.log10(q), spin1]
+#----------------------------------------------------------------------------------------------------
+def _evaluate(spin_sign, X_sur, X_calib, norm, mass_factor, modes, M_tot, dist_mpc, orb_phase,
+              inclination, neg_modes, mode_sum, lmax, calibrated, out=None, workspace=None,
+              output='complex', workers=None):
+    """ Evaluates the sub-surrogate for the given spin sign; a batch of N waveforms
+        is evaluated when X_sur has shape (N, 2) and the other inputs are columns
+        of shape (N, 1)
+    """
 
-    # define parameterization for nr calibration
-    X_calib = [q, spin1]
+    # list the modes modelled in BHPTNRSur2dq1e3
+    modes_available = [(2,2),(2,1),(3,1),(3,2),(3,3),(4,2),(4,3),(4,4)]
+    if modes==None:
+        modes = modes_available
 
-    # normalization parameter to be multiplied with the surrogate waveform
-    norm = 1/q
+    # fit data of the sub-surrogate for the given spin sign
+    times = _surrogate_data['times_dict'][spin_sign]
+    fit_data_dict_1 = _surrogate_data['fit_data_dict_1_sign'][spin_sign]
+    fit_data_dict_2 = _surrogate_data['fit_data_dict_2_sign'][spin_sign]
+    B_dict_1 = _surrogate_data['B_dict_1_sign'][spin_sign]
+    B_dict_2 = _surrogate_data['B_dict_2_sign'][spin_sign]
+    # stacked GPR data of the evaluated modes, to evaluate all their EIM nodes at once
+    packed_fits_sign = _surrogate_data.get('packed_fits_sign')
+    packed_fits = None
+    if packed_fits_sign is not None:
+        packed_fits = fits.packed_fits_for_modes(packed_fits_sign[spin_sign], modes, lmax,
+                                                 fit_data_dict_1, fit_data_dict_2, load_gpr.pack_gpr_fits)
 
     # domain of validity
     X_min_q = np.log10(3)
@@ -136,6 +347,8 @@ def generate_surrogate(q, spin1=0.0, spin2=None, ecc=None, ano=None, modes=None,
             calibrated, M_tot, dist_mpc, orb_phase, inclination, fit_data_dict_1,\
             fit_data_dict_2, B_dict_1, B_dict_2, fit_func, decomposition_funcs,\
             norm, mode_sum, neg_modes, lmax, CoorbToInert,
-                                        mass_factor=mass_factor)
+                                        mass_factor=mass_factor, packed_fits=packed_fits,
+                                        out=out, workspace=workspace, output=output,
+                                        workers=workers)
 
     return t_surrogate, h_surrogate
@@ -1,11 +1,15 @@
-from . import utils
-from . import fits
-from . import nr_calibration
-from . import check_inputs
-from . import doc_string
-from . import load_splines
-from . import filehash
-try:
-    from .eval_pysur import evaluate_fit
-except ImportError:
-    evaluate_fit = None
\ No newline at end of file
+import importlib
+
+# submodules are imported on first access (e.g. common_utils.fits) so that importing the
+# package does not pull in scipy, h5py, gwtools or the eval_pysur submodule
+_SUBMODULES = ('utils', 'fits', 'nr_calibration', 'check_inputs', 'doc_string', 'load_splines',
+               'load_GPRs', 'filehash', 'download', 'lazy_modes', 'parallel_io', 'surrogate_cache',
+               'lazy_imports', 'waveform_modes', 'workspace', 'parallel_eval')
+
+def __getattr__(name):
+    if name in _SUBMODULES:
+        return importlib.import_module('.' + name, __name__)
+    if name == 'evaluate_fit':
+        from .lazy_imports import optional_module
+        return optional_module('.eval_pysur.evaluate_fit', __name__)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
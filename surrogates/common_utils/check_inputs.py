@@ -29,12 +29,17 @@ def check_domain_of_validity(X_in, X_bounds):
     # if the input X is just a number, make sure to array it up
     if isinstance(X_in,(list))==False and isinstance(X_in,(float,int))==True:
         X_in= [X_in]
+    # a batch of parameters is given as rows of a 2d array; check each parameter
+    # over the whole batch
+    elif np.ndim(X_in)==2:
+        X_in = np.transpose(X_in)
     # raise error for all other scenarios
     #else:
     #    raise ValueError("param types are not matching with bound types")
 
     for param_indx in range(len(X_in)):
-        if X_in[param_indx]<X_bounds[0][param_indx] or X_in[param_indx]>X_bounds[1][param_indx]:
+        if np.any(np.less(X_in[param_indx], X_bounds[0][param_indx])) or \
+                np.any(np.greater(X_in[param_indx], X_bounds[1][param_indx])):
             warnings.warn(
                 "Input parameter is outside bounds for parameter value at index %d" % param_indx,
                 stacklevel=3,
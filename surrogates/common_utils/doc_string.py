@@ -93,10 +93,39 @@ def generic_doc_for_models() -> None:
                  When calibrated=False and mass_scale='m1', the raw ppBHPT waveform
                  is returned without any rescaling.
 
+    out:  Preallocated output to write the waveform into, for repeated calls in a loop.
+          If mode_sum=True, a complex array of the length of t. Otherwise the modes h
+          returned by a previous call with the same modes (which is then returned again),
+          or a complex array with one row per m>0 mode (per returned mode, m<0 included,
+          if orb_phase and inclination are given). Default: None
+
+    workspace:  A Workspace() of this module holding the scratch arrays of the
+                evaluation, reused between calls. With out and workspace, no arrays of
+                the length of the waveform are allocated apart from the time array t.
+                Use one workspace per thread. Default: None
+
+    output:  'complex' for complex modes, or 'amp_phase' for the amplitude and unwrapped
+             phase of each mode, h[mode] = (amp, phase) with mode = amp*exp(1j*phase),
+             e.g. for resampling on coarser grids. They are computed from the
+             amplitude/phase (or real/imaginary) datapieces of the surrogate without
+             forming the complex modes; the orbital phase of the coorbital frame is half
+             the phase of the (2,2) mode. h.amp and h.phase hold all modes, and
+             h.to_complex() returns the complex modes. Not available with mode_sum=True
+             or out. Default: 'complex'
+
+    workers:  Number of threads that evaluate the modes concurrently, which lowers the
+              latency of a single waveform on a multi-core machine; the waveform does
+              not depend on it. The threads are started on first use and shared between
+              calls. Default: None (the BHPTNRSUR_EVAL_WORKERS environment variable,
+              else 1)
+
     Output
     ======
     t : time
     h : waveform modes as a dictionary
+        With neg_modes=True, h stores the m>0 modes and computes each m<0 mode
+        h[(l,-m)] = (-1)^l h[(l,m)]^* when it is accessed; h.materialize() returns all 
+        modes as rows of h.data. On the sphere, the m<0 modes are stored as well.
 
 
     Example Uses:
@@ -117,6 +146,17 @@ def generic_doc_for_models() -> None:
     6. to obtain mode-summed NR calibrated physical waveform on a sphere
             t, h = generate_surrogate(q=8, M_tot=60, dist_mpc=100, orb_phase=np.pi/3, 
                                       inclination=np.pi/4, lmax=3, mode_sum=True)
+    7. to evaluate many mode-summed waveforms reusing the same arrays
+            workspace = Workspace()
+            t, h = generate_surrogate(q=8, M_tot=60, dist_mpc=100, orb_phase=np.pi/3,
+                                      inclination=np.pi/4, mode_sum=True, workspace=workspace)
+            for q in [9, 10, 11]:
+                t, h = generate_surrogate(q=q, M_tot=60, dist_mpc=100, orb_phase=np.pi/3,
+                                          inclination=np.pi/4, mode_sum=True, out=h,
+                                          workspace=workspace)
+    8. to obtain the amplitude and phase of the modes
+            t, h = generate_surrogate(q=8, modes=[(2,1),(2,2)], output='amp_phase')
+            amp, phase = h[(2,2)]
               
     """
     return
@@ -0,0 +1,188 @@
+##==============================================================================
+## BHPTNRSurrogate module
+## Description : parallel, resumable download of the surrogate h5 files
+## Author : BHPTNRSurrogate developers, Oct 2026
+##==============================================================================
+
+import os
+import json
+import shutil
+import threading
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+"""
+Files are downloaded with HTTP range requests over several connections into
+<file>.part, whose completed chunks are recorded in <file>.part.json so that an
+interrupted download resumes where it stopped. Once all chunks are in, the file is
+renamed into place, so the data directory never holds a truncated h5 file. A lock file
+makes sure only one process downloads a given file; the others wait and then use it.
+
+The environment variable BHPTNRSUR_MIRROR points the download at a local mirror,
+either a directory holding the h5 files or a base URL that they are fetched from.
+"""
+
+# size of the byte ranges requested per connection
+CHUNK_SIZE = 16 * 1024 * 1024
+
+# number of parallel connections
+N_CONNECTIONS = 4
+
+# seconds to wait for the server
+TIMEOUT = 60
+
+#----------------------------------------------------------------------------------------------------
+class _FileLock:
+    """ Exclusive advisory lock on <path>.lock, held across processes (and threads) """
+
+    def __init__(self, path):
+        self.path = path + '.lock'
+
+    def __enter__(self):
+        self.f = open(self.path, 'a')
+        if fcntl is not None:
+            fcntl.flock(self.f.fileno(), fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc):
+        if fcntl is not None:
+            fcntl.flock(self.f.fileno(), fcntl.LOCK_UN)
+        self.f.close()
+
+#----------------------------------------------------------------------------------------------------
+def _remote_size(url, timeout):
+    """
+    Returns the size of the remote file, or None if the server does not serve byte ranges
+    """
+    request = urllib.request.Request(url, headers={'Range': 'bytes=0-0'})
+    with urllib.request.urlopen(request, timeout=timeout) as response:
+        content_range = response.headers.get('Content-Range')
+        if response.status != 206 or content_range is None:
+            return None
+        # Content-Range: bytes 0-0/<size>
+        return int(content_range.rsplit('/', 1)[-1])
+
+#----------------------------------------------------------------------------------------------------
+def _download_whole(url, part_path, timeout):
+    """ Download without range requests, for servers that do not support them """
+    with urllib.request.urlopen(url, timeout=timeout) as response, open(part_path, 'wb') as f:
+        shutil.copyfileobj(response, f, 1024 * 1024)
+
+#----------------------------------------------------------------------------------------------------
+def _download_chunks(url, part_path, size, chunk_size, n_connections, timeout):
+    """ Download the missing chunks of part_path with range requests over several connections """
+    state_path = part_path + '.json'
+    chunks = [(start, min(start + chunk_size, size)) for start in range(0, size, chunk_size)]
+
+    # resume from the chunks completed by an earlier, interrupted download
+    done = set()
+    if os.path.isfile(part_path) and os.path.isfile(state_path):
+        try:
+            with open(state_path) as f:
+                state = json.load(f)
+            if state['url'] == url and state['size'] == size and state['chunk_size'] == chunk_size:
+                done = set(state['done'])
+        except (OSError, ValueError, KeyError):
+            pass
+    if not done:
+        with open(part_path, 'wb') as f:
+            f.truncate(size)
+
+    state_lock = threading.Lock()
+
+    def save_state():
+        tmp_path = state_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'url': url, 'size': size, 'chunk_size': chunk_size, 'done': sorted(done)}, f)
+        os.replace(tmp_path, state_path)
+
+    def fetch(index):
+        start, stop = chunks[index]
+        request = urllib.request.Request(url, headers={'Range': 'bytes=%d-%d' % (start, stop - 1)})
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            data = response.read()
+        if response.status != 206 or len(data) != stop - start:
+            raise IOError("Bad response for bytes %d-%d of %s" % (start, stop - 1, url))
+        with open(part_path, 'r+b') as f:
+            f.seek(start)
+            f.write(data)
+        with state_lock:
+            done.add(index)
+            save_state()
+
+    todo = [index for index in range(len(chunks)) if index not in done]
+    with ThreadPoolExecutor(max_workers=n_connections) as executor:
+        for future in [executor.submit(fetch, index) for index in todo]:
+            future.result()
+
+#----------------------------------------------------------------------------------------------------
+def download_file(url, file_path, chunk_size=None, n_connections=None, timeout=None):
+    """
+    Download url to file_path with parallel range requests, resuming a previous partial
+    download if there is one. The file only appears at file_path once it is complete.
+    If another process is downloading the same file, waits for it instead.
+
+    Inputs
+    ======
+        url : url of the file
+        file_path : where to install the file
+        chunk_size : bytes per range request (default CHUNK_SIZE)
+        n_connections : number of parallel connections (default N_CONNECTIONS)
+        timeout : seconds to wait for the server (default TIMEOUT)
+    """
+    chunk_size = chunk_size or CHUNK_SIZE
+    n_connections = n_connections or N_CONNECTIONS
+    timeout = timeout or TIMEOUT
+    part_path = file_path + '.part'
+
+    with _FileLock(file_path):
+        # downloaded by another process while we waited for the lock
+        if os.path.isfile(file_path):
+            return
+        size = _remote_size(url, timeout)
+        if size is None:
+            _download_whole(url, part_path, timeout)
+        else:
+            _download_chunks(url, part_path, size, chunk_size, n_connections, timeout)
+            if os.path.getsize(part_path) != size:
+                raise IOError("Downloaded %s has the wrong size" % part_path)
+        os.replace(part_path, file_path)
+        if os.path.exists(part_path + '.json'):
+            os.remove(part_path + '.json')
+
+#----------------------------------------------------------------------------------------------------
+def copy_file(src_path, file_path):
+    """
+    Copy a file from a local mirror to file_path; like download_file, the file only
+    appears at file_path once it is complete.
+    """
+    with _FileLock(file_path):
+        if os.path.isfile(file_path):
+            return
+        part_path = file_path + '.part'
+        shutil.copyfile(src_path, part_path)
+        os.replace(part_path, file_path)
+
+#----------------------------------------------------------------------------------------------------
+def fetch_data_file(fname, h5_data_dir, zenodo_ID):
+    """
+    Obtain the h5 file fname in h5_data_dir from the BHPTNRSUR_MIRROR directory or url if
+    set, otherwise from the Zenodo record zenodo_ID. Returns the source used.
+    """
+    file_path = os.path.join(h5_data_dir, fname)
+    mirror = os.environ.get('BHPTNRSUR_MIRROR')
+    if mirror and not mirror.startswith(('http://', 'https://', 'ftp://')):
+        src_path = os.path.join(mirror[len('file://'):] if mirror.startswith('file://') else mirror, fname)
+        copy_file(src_path, file_path)
+        return src_path
+    if mirror:
+        url = '%s/%s' % (mirror.rstrip('/'), fname)
+    else:
+        url = 'https://zenodo.org/record/%s/files/%s' % (zenodo_ID, fname)
+    download_file(url, file_path)
+    return url
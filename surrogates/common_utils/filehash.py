@@ -5,32 +5,49 @@
 ##==============================================================================
 
 import os
+import json
 import hashlib
-import urllib.request
+import tempfile
+from . import surrogate_cache
+from .lazy_imports import LazyModule
+
+# urllib is only needed when the h5 file has to be downloaded
+download = LazyModule(__package__ + '.download')
 
 #----------------------------------------------------------------------------------------------------
-def md5(fname, h5_data_dir, zenodo_ID):
+def md5(fname, h5_data_dir, zenodo_ID, strict=None):
     """ Compute hash from file. code taken from
-    https://stackoverflow.com/questions/3431825/generating-an-md5-checksum-of-a-file"""
+    https://stackoverflow.com/questions/3431825/generating-an-md5-checksum-of-a-file
+
+    If the file was verified before (see record_verified_hash) and its size, mtime and
+    inode are unchanged, the recorded hash is returned without reading the file.
+    strict=True (or the environment variable BHPTNRSUR_STRICT_HASH=1) always rehashes.
+    """
 
     file_path = os.path.join(h5_data_dir, fname)
 
     # download file if not already there
     if not os.path.isfile(file_path):
-        url = 'https://zenodo.org/record/%s/files/%s' % (zenodo_ID, fname)
         print('%s not found in BHPTNRSurrogate/data/' % fname)
         print('Downloading %s from Zenodo ... this may take a few minutes ...' % fname)
         try:
-            urllib.request.urlretrieve(url, file_path)
+            source = download.fetch_data_file(fname, h5_data_dir, zenodo_ID)
         except Exception as e:
             raise RuntimeError(
-                "Failed to download %s from %s: %s" % (fname, url, e)
+                "Failed to download %s: %s" % (fname, e)
             )
-        print('Download complete: %s' % fname)
+        print('Download complete: %s (from %s)' % (fname, source))
+
+    if strict is None:
+        strict = os.environ.get('BHPTNRSUR_STRICT_HASH', '0') not in ('', '0')
+    if not strict:
+        file_hash = _manifest_hash(file_path)
+        if file_hash is not None:
+            return file_hash
 
     hash_md5 = hashlib.md5()
     with open(file_path, "rb") as f:
-        for chunk in iter(lambda: f.read(4096), b""):
+        for chunk in iter(lambda: f.read(1 << 20), b""):
             hash_md5.update(chunk)
     return hash_md5.hexdigest()
 
@@ -43,3 +60,49 @@ def check_current_hash(file_hash, zenodo_current_hash, url, fname):
                              %(fname,url))
     else:
         pass
+
+#----------------------------------------------------------------------------------------------------
+def _manifest_path(file_path):
+    """ Path of the verification manifest of a file, e.g. data/.BHPTNRSur1dq1e4.h5.verified """
+    h5_data_dir, fname = os.path.split(file_path)
+    return os.path.join(h5_data_dir, '.%s.verified' % fname)
+
+#----------------------------------------------------------------------------------------------------
+def _file_signature(file_path):
+    """ Size, modification time and inode of a file """
+    stat = os.stat(file_path)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'inode': stat.st_ino}
+
+#----------------------------------------------------------------------------------------------------
+def _manifest_hash(file_path):
+    """ Returns the hash recorded in the manifest of a file if the file is unchanged, else None """
+    try:
+        with open(_manifest_path(file_path)) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if {key: manifest.get(key) for key in ('size', 'mtime_ns', 'inode')} != _file_signature(file_path):
+        return None
+    return manifest.get('md5')
+
+#----------------------------------------------------------------------------------------------------
+def record_verified_hash(fname, h5_data_dir, file_hash):
+    """ Records the hash of a file that passed check_current_hash, together with its size,
+    mtime and inode, so that md5() can skip rehashing the unchanged file. Nothing is
+    recorded if the data directory is not writable.
+    """
+    file_path = os.path.join(h5_data_dir, fname)
+    manifest = dict(_file_signature(file_path), md5=file_hash)
+    try:
+        fd, tmp_path = tempfile.mkstemp(dir=h5_data_dir, prefix='.%s.' % fname)
+    except OSError:
+        return
+    try:
+        # readable by the other users of the data directory, see surrogate_cache.set_default_mode
+        surrogate_cache.set_default_mode(fd)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(manifest, f)
+        os.replace(tmp_path, _manifest_path(file_path))
+    except OSError:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
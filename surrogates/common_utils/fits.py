@@ -6,31 +6,48 @@
 ##==============================================================================
 
 import numpy as np
-import scipy
-from scipy.interpolate import splrep, splev
 from . import utils
-try:
-    from .eval_pysur import evaluate_fit as evaluate_GPR
-except ImportError:
-    evaluate_GPR = None
+from . import parallel_eval
+from .waveform_modes import AmpPhaseModes, WaveformModes
+from .workspace import Workspace
+from .lazy_imports import LazyModule, optional_module
+
+# imported on first use, see lazy_imports.py
+_interpolate = LazyModule('scipy.interpolate')
 
 #----------------------------------------------------------------------------------------------------
 def _evaluate_GPR_at_EIM_nodes(X, fit_data):
     """ Evaluate the GPR at one EIM node
         For information on the inputs, please look at all_modes_surrogate()
     """
-    if evaluate_GPR is None:
-        raise ImportError(
-            "The eval_pysur submodule is required for GPR-based surrogate models "
-            "(e.g. BHPTNRSur2dq1e3). Initialize it with:\n"
-            "  cd BHPTNRSurrogate && git submodule init && git submodule update"
-        )
-
-    [h_eim_gpr_mode, eim_indicies] = fit_data
+    h_eim_gpr_mode, eim_indicies = fit_data[:2]
+
+    # reuse the fit evaluators built by an earlier call; they are not built at load time
+    # (older caches hold a list of None in place of the evaluators)
+    if len(fit_data) > 2 and fit_data[2] is not None and None not in fit_data[2]:
+        fit_evaluators = fit_data[2]
+    else:
+        evaluate_GPR = optional_module('.eval_pysur.evaluate_fit', __package__)
+        if evaluate_GPR is None:
+            raise ImportError(
+                "The eval_pysur submodule is required for GPR-based surrogate models "
+                "(e.g. BHPTNRSur2dq1e3). Initialize it with:\n"
+                "  cd BHPTNRSurrogate && git submodule init && git submodule update"
+            )
+        fit_evaluators = [evaluate_GPR.getFitEvaluator(dict(h_eim_gpr_mode['node%s'%i]))
+                          for i in range(len(eim_indicies))]
+        # keep the evaluators for the next calls
+        if len(fit_data) > 2:
+            fit_data[2] = fit_evaluators
+
+    # a batch of parameters is given as rows of a 2d array; evaluate them one by one
+    if np.ndim(X) == 2:
+        return np.array([[fit_evaluator(list(x)) for fit_evaluator in fit_evaluators] for x in X])
+
     [q_log10, chi] = X
 
     # Evaluate GPR fit using pySurrogate at each node
-    fit = [evaluate_GPR.getFitEvaluator(dict(h_eim_gpr_mode['node%s'%i]))([q_log10, chi]) for i in range(len(eim_indicies))]
+    fit = [fit_evaluator([q_log10, chi]) for fit_evaluator in fit_evaluators]
 
     # Return result for given (log(q),chi)
     return np.array(fit)
@@ -42,22 +59,137 @@ def _evaluate_splines_at_EIM_nodes(X, fit_data):
     """
     
     [h_eim_spline, eim_indicies] = fit_data
-    return np.array([splev(X, h_eim_spline[j]) for j in range(len(eim_indicies))])
+    # a batch of parameters is given as rows of a 2d array
+    if np.ndim(X) == 2:
+        X = np.asarray(X)[:,0]
+    return np.array([_interpolate.splev(X, h_eim_spline[j]) for j in range(len(eim_indicies))]).T
+
+
+#----------------------------------------------------------------------------------------------------
+def _evaluate_packed_splines(X, packed_fits):
+    """ Evaluate the splines at all EIM nodes of all modes at once
+        Nodes sharing a knot vector are evaluated with a single B-spline call
+        For information on packed_fits, please look at load_splines.pack_spline_fits()
+    """
+
+    # a batch of parameters is given as rows of a 2d array
+    X = np.asarray(X, dtype=float)
+    if X.ndim == 2:
+        X = X[:,0]
+
+    eim_vals = np.empty(X.shape + (packed_fits['n_nodes'],))
+    for group in packed_fits['groups']:
+        spline = _interpolate.BSpline(group['knots'], group['coefs'].T, group['degree'])
+        eim_vals[..., group['rows']] = spline(X)
+    return eim_vals
+
+#----------------------------------------------------------------------------------------------------
+def _evaluate_packed_GPRs(X, packed_fits, chunk_size=2**22):
+    """ Evaluate the GPR fits at all EIM nodes of all modes at once
+        The kernel is ConstantKernel * RBF + WhiteKernel; the white noise term does not 
+        contribute away from the training points. The GPR prediction is de-standardized 
+        and the linear regression trend is added, as in eval_pysur.
+        Batches are evaluated in chunks of at most chunk_size kernel entries.
+        For information on packed_fits, please look at load_GPRs.pack_gpr_fits()
+    """
+
+    X = np.asarray(X, dtype=float)
+    X_batch = np.atleast_2d(X)
+    X_train_scaled = packed_fits['X_train_scaled']
+    n_nodes, n_train_max, n_dim = X_train_scaled.shape
+
+    eim_vals = np.empty((len(X_batch), n_nodes))
+    n_chunk = max(1, chunk_size // (n_nodes * n_train_max))
+    for start in range(0, len(X_batch), n_chunk):
+        x = X_batch[start:start+n_chunk]
+        x_scaled = x[:, None, :] / packed_fits['length_scale'][None, :, :]
+        # squared distances to the training points, (n_points, n_nodes, n_train_max)
+        sq_dists = np.zeros((len(x), n_nodes, n_train_max))
+        for dim in range(n_dim):
+            sq_dists += (x_scaled[:, :, None, dim] - X_train_scaled[None, :, :, dim])**2
+        kernel = np.exp(-0.5 * sq_dists)
+        y = np.einsum('pnt,nt->pn', kernel, packed_fits['const_alpha'])
+        # undo the normalizations of the GPR fit
+        y = packed_fits['y_train_std'] * y + packed_fits['y_train_mean']
+        y = y * packed_fits['data_std'] + packed_fits['data_mean']
+        # add the linear regression trend
+        eim_vals[start:start+n_chunk] = y + np.dot(x, packed_fits['coef'].T) + packed_fits['intercept']
+
+    if X.ndim < 2:
+        return eim_vals[0]
+    return eim_vals
+
+#----------------------------------------------------------------------------------------------------
+def evaluate_packed_fits(X, packed_fits):
+    """ Evaluate the packed fits at all EIM nodes of all modes and datapieces
+
+    Inputs
+    ======
+
+        X : surrogate parameterization e.g. log(q) or [log(q), spin1]; a batch of N 
+            parameters is given as a 2d array of shape (N, n_params)
+
+        packed_fits : packed fit data from load_splines.pack_spline_fits() or 
+                      load_GPRs.pack_gpr_fits()
+
+    Outputs
+    =======
+
+        h_eim_dict : dictionary of EIM node values keyed by (datapiece, mode), with
+                     datapiece 0 or 1. For a batch of N parameters, each entry has
+                     shape (N, n_nodes).
+
+    """
+
+    if packed_fits['fit_func'] == 'spline_1d':
+        eim_vals = _evaluate_packed_splines(X, packed_fits)
+    elif packed_fits['fit_func'] == 'GPR_fits':
+        eim_vals = _evaluate_packed_GPRs(X, packed_fits)
+    else:
+        raise ValueError("Unknown packed fit type %r" % packed_fits['fit_func'])
+
+    return {key: eim_vals[..., start:stop] for key, (start, stop) in packed_fits['offsets'].items()}
 
 
 #----------------------------------------------------------------------------------------------------
-def _EIM_B_to__waveform_datapiece(B, eim_vals):
-    """ Compute the interpolated waveform for a single mode 
+def packed_fits_for_modes(packed_fits_by_modes, modes, lmax, fit_data_dict_1, fit_data_dict_2, pack_func):
+    """
+    Returns the packed fit data of the modes that all_modes_surrogate() evaluates, i.e. the
+    requested modes with l<=lmax, so that only the fit data of these modes is read.
+    The packed fit data is built with pack_func (load_splines.pack_spline_fits or
+    load_GPRs.pack_gpr_fits) the first time a set of modes is requested and kept in the
+    packed_fits_by_modes dictionary, keyed by the sorted modes.
+    Returns None if none of the requested modes is available.
+    """
+    available_modes = list(fit_data_dict_1.keys())
+    key = tuple(sorted(tuple(mode) for mode in modes if mode in available_modes and mode[0] <= lmax))
+    if not key:
+        return None
+    packed_fits = packed_fits_by_modes.get(key)
+    if packed_fits is None:
+        packed_fits = pack_func({mode: fit_data_dict_1[mode] for mode in key},
+                                {mode: fit_data_dict_2[mode] for mode in key})
+        packed_fits_by_modes[key] = packed_fits
+    return packed_fits
+
+#----------------------------------------------------------------------------------------------------
+def _EIM_B_to__waveform_datapiece(B, eim_vals, out=None):
+    """ Compute the interpolated waveform for a single mode, written into out if given
+        For a batch, eim_vals has shape (N, n_nodes) and the datapieces of all N 
+        waveforms are obtained with one matrix-matrix product
         For information on the inputs, please look at all_modes_surrogate()
     """
     
-    approx_datapiece = np.dot(B.transpose(), eim_vals)
+    if np.ndim(eim_vals) == 2:
+        approx_datapiece = np.dot(eim_vals, B, out=out)
+    else:
+        approx_datapiece = np.dot(B.transpose(), eim_vals, out=out)
     return approx_datapiece
 
 
 #----------------------------------------------------------------------------------------------------
-def _evaluate_datapiece(X, fit_data, B, fit_func):
-    """ Compute the datapiece for the input parameters 
+def _evaluate_datapiece(X, fit_data, B, fit_func, out=None):
+    """ Compute the datapiece for the input parameters, written into out if given
         For information on the inputs, please look at all_modes_surrogate()
     """
     
@@ -68,39 +200,62 @@ def _evaluate_datapiece(X, fit_data, B, fit_func):
     elif fit_func == 'GPR_fits':
         h_eim_datapiece = _evaluate_GPR_at_EIM_nodes(X, fit_data)
     # combine h_eim and  eim basis matrix to give full datapiece
-    h_approx_datapiece = _EIM_B_to__waveform_datapiece(B, h_eim_datapiece) 
+    h_approx_datapiece = _EIM_B_to__waveform_datapiece(B, h_eim_datapiece, out=out) 
     
     return h_approx_datapiece
 
 
 #----------------------------------------------------------------------------------------------------
 def _evaluate_surrogate_mode(X, fit_data_1, fit_data_2, B_datapiece_1, B_datapiece_2, 
-                            fit_func, decomposition_func, norm):
-    """ Compute the interpolated waveform for a single mode 
+                            fit_func, decomposition_func, norm, out=None, datapiece_out=(None, None)):
+    """ Compute the interpolated waveform for a single mode, written into out if given
+        and with the datapieces written into datapiece_out if given
         For information on the inputs, please look at all_modes_surrogate()
     """
     
     # evaluate first datapiece e.g amplitude / real part of wf
-    h_approx_datapiece_1 = _evaluate_datapiece(X,  fit_data_1, B_datapiece_1, fit_func)
+    h_approx_datapiece_1 = _evaluate_datapiece(X,  fit_data_1, B_datapiece_1, fit_func, out=datapiece_out[0])
     # evaluate second datapiece e.g phase / imag part of wf
-    h_approx_datapiece_2 = _evaluate_datapiece(X,  fit_data_2, B_datapiece_2, fit_func)
+    h_approx_datapiece_2 = _evaluate_datapiece(X,  fit_data_2, B_datapiece_2, fit_func, out=datapiece_out[1])
     
+    return _datapieces_to_surrogate_mode(h_approx_datapiece_1, h_approx_datapiece_2,
+                                         decomposition_func, norm, out=out)
+
+
+#----------------------------------------------------------------------------------------------------
+def _datapieces_to_surrogate_mode(h_approx_datapiece_1, h_approx_datapiece_2, decomposition_func, norm,
+                                  out=None):
+    """ Combine the two datapieces of a single mode into the complex waveform, written 
+        into out if given
+        For information on the inputs, please look at all_modes_surrogate()
+    """
+
     # combine datapieces to obtain full wf either in the inertial frame or in the
     # coorbital frame; at this stage, the waveforms are returned in their respective
     # frames where models have been built e.g. inertial for 22 or coorbital for HMs
     # in case of BHPTNRSur1dq1e4
-    h_approx =  decomposition_func(h_approx_datapiece_1, h_approx_datapiece_2)
+    h_approx =  decomposition_func(h_approx_datapiece_1, h_approx_datapiece_2, out=out)
     
     # needed to match convention of other surrogate models
-    # multiply surrogate amplitude with overall normalization factor
-    h_approx = np.conj(np.array(h_approx))*norm
+    h_approx = np.conjugate(h_approx, out=h_approx)
+    # multiply surrogate amplitude with overall normalization factor, in place;
+    # norm=1 when the normalization is left to utils.obtain_processed_output
+    if np.ndim(norm) != 0 or norm != 1:
+        h_approx *= norm
     
     return h_approx
 
 
+#----------------------------------------------------------------------------------------------------
+def evaluated_modes(modes, lmax):
+    """ The modes that all_modes_surrogate() evaluates, in order: the requested modes with l<=lmax """
+    return [tuple(mode) for mode in modes if mode[0]<=lmax]
+
+
 #----------------------------------------------------------------------------------------------------
 def all_modes_surrogate(modes, X_input, fit_data_dict_1, fit_data_dict_2, \
-                        B_dict_1, B_dict_2, lmax, fit_func, decomposition_funcs, norm):
+                        B_dict_1, B_dict_2, lmax, fit_func, decomposition_funcs, norm,
+                        packed_fits=None, out=None, workspace=None, workers=None):
 
     """ Takes the fit data (either from splines or GPR), matrix B and computes the 
         interpolated waveform for all modes 
@@ -117,6 +272,8 @@ def all_modes_surrogate(modes, X_input, fit_data_dict_1, fit_data_dict_2, \
         modes : list of modes to evaluate
         
         X_input :  array of surrogate parameterization e.g. [log(q), spin1, spin2]
+                   A batch of N parameters is given as a 2d array of shape (N, n_params);
+                   the modes are then returned as arrays of shape (N, n_times)
 
         fit_data_dict_1, fit_data_dict_2 : dictionary of fit data obtained for two datapieces from 
                                            the h5 file.
@@ -135,42 +292,161 @@ def all_modes_surrogate(modes, X_input, fit_data_dict_1, fit_data_dict_2, \
         decomposition_funcs : form of data decomposition function to combine datapieces for 22 and
                               higher modes respectively. e.g. Amp/Phase to full or real/imag to full
                               etc. These functions are available at common_utils.utils.py
+                              and write their result into their out argument if given.
 
         norm : overall normalization factor to be multiplied to final waveform. This depends on the 
               way the surrogate have been constructed. Mostly norm=1/q or norm=1. 
+              For a batch, norm has shape (N, 1). With norm=1 no multiplication is done,
+              so that evaluate_surrogate can fold the normalization into the single 
+              per-mode scale of utils.obtain_processed_output.
+
+        packed_fits : (optional) packed fit data of (at least) the evaluated modes from 
+                      load_splines.pack_spline_fits() or load_GPRs.pack_gpr_fits(), see
+                      packed_fits_for_modes(). When given, all EIM nodes are evaluated 
+                      at once and fit_data_dict_1, fit_data_dict_2 are not used.
+
+        out : (optional) complex array of shape (n_modes, n_times) or (n_modes, N, n_times) 
+              with one row per evaluated mode (see evaluated_modes()) that the modes are 
+              written into, e.g. a view of a larger preallocated block.
+
+        workspace : (optional) workspace.Workspace holding the scratch arrays of the 
+                    datapieces.
+
+        workers : (optional) number of threads evaluating the modes concurrently, see 
+                  parallel_eval.py. Default: the BHPTNRSUR_EVAL_WORKERS environment 
+                  variable, else 1. The modes do not depend on the number of workers.
     
     Outputs
     =======
     
         t_surrogate : time array
-        h_surrogate : dictionary of modes  
+        h_surrogate : dictionary of modes, a waveform_modes.WaveformModes holding all modes
+                      in one (n_modes, n_times) or, for a batch, (n_modes, N, n_times) array
         
     """
     
-    # dictionary to save waveform
-    h_approx_dict={}
-    # evaluate all the modes     
-    for mode in modes:
-        (l,m) = mode
-        # load modes only upto l=lmax
-        if l<=lmax:
+    # evaluate the packed fits at all EIM nodes at once
+    if packed_fits is not None:
+        h_eim_dict = evaluate_packed_fits(X_input, packed_fits)
+
+    # modes to evaluate: only upto l=lmax
+    eval_modes = evaluated_modes(modes, lmax)
+    workers = parallel_eval.n_workers(workers)
+    if workspace is None:
+        workspace = Workspace()
+    # block to save the waveform modes in, allocated once the shape of a mode is known
+    # unless it is given; the modes are written directly into their row
+    h_approx_data = out
+    if out is not None and len(out) != len(eval_modes):
+        raise ValueError("out has %d rows for %d modes" % (len(out), len(eval_modes)))
+
+    def evaluate_mode(i, mode):
+        # read the decomposition function for the modes; special treatment for the
+        # 22 mode and higher order modes
+        if mode==(2,2):
+            decomposition_func = decomposition_funcs[0]
+        else:
+            decomposition_func = decomposition_funcs[1]
+        # scratch arrays of the datapieces, one set per thread
+        h_approx_row, datapiece_out = None, (None, None)
+        if h_approx_data is not None:
+            h_approx_row = h_approx_data[i]
+            mode_workspace = workspace if workers < 2 else workspace.for_thread()
+            datapiece_out = (mode_workspace.array('datapiece_1', np.shape(h_approx_row)),
+                             mode_workspace.array('datapiece_2', np.shape(h_approx_row)))
+
+        # evaluate surrogate modes
+        # return surrogate modes in coordinate frame it has been modelled.
+        # e.g. for models using the co-orbital frame, the modes are still in the 
+        # co-oorbital frame at this point.
+        if packed_fits is not None:
+            h_approx = _datapieces_to_surrogate_mode(
+                        _EIM_B_to__waveform_datapiece(B_dict_1[(mode)], h_eim_dict[(0, mode)],
+                                                      out=datapiece_out[0]),
+                        _EIM_B_to__waveform_datapiece(B_dict_2[(mode)], h_eim_dict[(1, mode)],
+                                                      out=datapiece_out[1]),
+                        decomposition_func, norm, out=h_approx_row)
+        else:
             # get the fit data for specific mode for both the datapieces
             fit_data_1 = fit_data_dict_1[mode]
             fit_data_2 = fit_data_dict_2[mode]
-            
-            # read the decomposition function for the modes; special treatment for the
-            # 22 mode and higher order modes
-            if mode==(2,2):
-                decomposition_func = decomposition_funcs[0]
-            else:
-                decomposition_func = decomposition_funcs[1]
+            h_approx = _evaluate_surrogate_mode(X_input, fit_data_1, fit_data_2, 
+                                                B_dict_1[(mode)], B_dict_2[(mode)], 
+                                                fit_func, decomposition_func, norm, out=h_approx_row,
+                                                datapiece_out=datapiece_out)
+        return h_approx
+
+    if not eval_modes:
+        return WaveformModes(eval_modes, np.empty((0,), dtype=complex))
+    # the first mode gives the shape of the block; the others are evaluated into their rows,
+    # concurrently with workers > 1
+    h_approx = evaluate_mode(0, eval_modes[0])
+    if h_approx_data is None:
+        h_approx_data = np.empty((len(eval_modes),) + np.shape(h_approx), dtype=complex)
+        h_approx_data[0] = h_approx
+    parallel_eval.for_each(evaluate_mode, eval_modes[1:], workers, start=1)
+    return WaveformModes(eval_modes, h_approx_data)
+
+
+#----------------------------------------------------------------------------------------------------
+def all_modes_surrogate_amp_phase(modes, X_input, fit_data_dict_1, fit_data_dict_2, \
+                                  B_dict_1, B_dict_2, lmax, fit_func, decomposition_funcs, norm,
+                                  packed_fits=None, workspace=None, workers=None):
+    """ Same as all_modes_surrogate(), but returns the modes as amplitude and unwrapped phase
+        (a waveform_modes.AmpPhaseModes, with the same conjugation convention) instead of 
+        complex modes. The datapieces of each mode are written into its amplitude and phase 
+        rows and converted there with utils.polar_decomposition(decomposition_func): for 
+        amplitude/phase datapieces this only flips the sign of the phase, so no complex 
+        exponential is computed.
+        
+        For information on the inputs, please look at all_modes_surrogate()
+    """
     
-            # evaluate surrogate modes
-            # return surrogate modes in coordinate frame it has been modelled.
-            # e.g. for models using the co-orbital frame, the modes are still in the 
-            # co-oorbital frame at this point.
-            h_approx_dict[(mode)] = _evaluate_surrogate_mode(X_input, fit_data_1, fit_data_2, 
-                                                            B_dict_1[(mode)], B_dict_2[(mode)], 
-                                                            fit_func, decomposition_func, norm)
-                
-    return h_approx_dict
+    # evaluate the packed fits at all EIM nodes at once
+    if packed_fits is not None:
+        h_eim_dict = evaluate_packed_fits(X_input, packed_fits)
+    if workspace is None:
+        workspace = Workspace()
+
+    # modes to evaluate: only upto l=lmax
+    eval_modes = evaluated_modes(modes, lmax)
+    workers = parallel_eval.n_workers(workers)
+    # block of the amplitudes and phases, allocated once the shape of a datapiece is known
+    h_approx_data = None
+
+    def evaluate_mode(i, mode):
+        nonlocal h_approx_data
+        # special treatment for the 22 mode and higher order modes
+        if mode==(2,2):
+            polar_func = utils.polar_decomposition(decomposition_funcs[0])
+        else:
+            polar_func = utils.polar_decomposition(decomposition_funcs[1])
+
+        datapiece_out = (None, None) if h_approx_data is None else tuple(h_approx_data[i])
+        if packed_fits is not None:
+            datapiece_1 = _EIM_B_to__waveform_datapiece(B_dict_1[(mode)], h_eim_dict[(0, mode)],
+                                                        out=datapiece_out[0])
+            datapiece_2 = _EIM_B_to__waveform_datapiece(B_dict_2[(mode)], h_eim_dict[(1, mode)],
+                                                        out=datapiece_out[1])
+        else:
+            datapiece_1 = _evaluate_datapiece(X_input, fit_data_dict_1[mode], B_dict_1[(mode)], fit_func,
+                                              out=datapiece_out[0])
+            datapiece_2 = _evaluate_datapiece(X_input, fit_data_dict_2[mode], B_dict_2[(mode)], fit_func,
+                                              out=datapiece_out[1])
+        if h_approx_data is None:
+            h_approx_data = np.empty((len(eval_modes), 2) + np.shape(datapiece_1))
+        amp, phase = polar_func(datapiece_1, datapiece_2, out=tuple(h_approx_data[i]),
+                                workspace=workspace if workers < 2 else workspace.for_thread())
+
+        # needed to match convention of other surrogate models
+        np.negative(phase, out=phase)
+        if np.ndim(norm) != 0 or norm != 1:
+            amp *= norm
+
+    if not eval_modes:
+        return AmpPhaseModes(eval_modes, np.empty((0,)))
+    # the first mode gives the shape of the block; the others are evaluated into their rows,
+    # concurrently with workers > 1
+    evaluate_mode(0, eval_modes[0])
+    parallel_eval.for_each(evaluate_mode, eval_modes[1:], workers, start=1)
+    return AmpPhaseModes(eval_modes, h_approx_data)
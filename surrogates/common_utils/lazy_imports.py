@@ -0,0 +1,52 @@
+##==============================================================================
+## BHPTNRSurrogate module
+## Description : modules that are imported when they are first used
+## Author : BHPTNRSurrogate developers, Oct 2026
+##==============================================================================
+
+import importlib
+
+"""
+gwtools, scipy.interpolate, h5py and the eval_pysur submodule (which pulls in sklearn)
+take most of the import time of the package but are only needed to read the h5 files,
+evaluate the fits or convert to physical units. They are imported on first use so that
+importing a model stays cheap.
+"""
+
+#----------------------------------------------------------------------------------------------------
+class LazyModule:
+    """
+    Stands in for the module name, which is imported the first time one of its
+    attributes is accessed, e.g. h5py = LazyModule('h5py'); h5py.File(...)
+    """
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        module = self._module
+        if module is None:
+            # the import system serializes concurrent first imports
+            module = self._module = importlib.import_module(self._name)
+        return getattr(module, attr)
+
+    def __repr__(self):
+        return '<lazily imported module %r%s>' % (self._name, '' if self._module is None else ' (imported)')
+
+# optional modules that could not be imported
+_missing = set()
+
+#----------------------------------------------------------------------------------------------------
+def optional_module(name, package=None):
+    """
+    Imports and returns the module name (relative to package if it starts with a dot),
+    or returns None if it cannot be imported, e.g. an uninitialized git submodule
+    """
+    if (name, package) in _missing:
+        return None
+    try:
+        return importlib.import_module(name, package)
+    except ImportError:
+        _missing.add((name, package))
+        return None
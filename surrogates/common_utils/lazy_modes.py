@@ -0,0 +1,83 @@
+##==============================================================================
+## BHPTNRSurrogate module
+## Description : mode dictionaries whose data is read from the h5 file on first access
+## Author : BHPTNRSurrogate developers, Oct 2026
+##==============================================================================
+
+import threading
+from collections.abc import Mapping
+
+from . import parallel_io
+
+#----------------------------------------------------------------------------------------------------
+class LazyModeDict(Mapping):
+    """
+    Read-only dictionary mode -> data whose keys are known up front and whose values are
+    read with read_mode(mode) the first time they are accessed, then kept. Checking
+    membership, iterating over the keys or taking the length never reads any data.
+    Safe to use from several threads; every mode is read once, and different modes
+    can be read concurrently. on_complete, if given, is called once all modes have been
+    read, e.g. to close the h5 file they are read from.
+    """
+
+    def __init__(self, modes, read_mode, on_complete=None):
+        self._modes = list(modes)
+        self._mode_set = set(self._modes)
+        self._read_mode = read_mode
+        self._on_complete = on_complete
+        self._data = {}
+        self._locks = {mode: threading.Lock() for mode in self._modes}
+        self._complete_lock = threading.Lock()
+
+    def __getitem__(self, mode):
+        try:
+            return self._data[mode]
+        except KeyError:
+            if mode not in self._mode_set:
+                raise
+        with self._locks[mode]:
+            if mode not in self._data:
+                self._data[mode] = self._read_mode(mode)
+        if self._on_complete is not None and len(self._data) == len(self._modes):
+            self._complete()
+        return self._data[mode]
+
+    def _complete(self):
+        """ Calls on_complete once, from the thread that reads the last mode """
+        with self._complete_lock:
+            on_complete, self._on_complete = self._on_complete, None
+        if on_complete is not None:
+            on_complete()
+
+    def __contains__(self, mode):
+        return mode in self._mode_set
+
+    def __iter__(self):
+        return iter(self._modes)
+
+    def __len__(self):
+        return len(self._modes)
+
+    def loaded_modes(self):
+        """ Modes whose data has been read so far """
+        return [mode for mode in self._modes if mode in self._data]
+
+    def __repr__(self):
+        return '%s(%d modes, %d loaded)' % (type(self).__name__, len(self._modes), len(self._data))
+
+#----------------------------------------------------------------------------------------------------
+def split_mode_dict(mode_dict, n_items):
+    """
+    Splits a LazyModeDict whose values are tuples into n_items LazyModeDicts, one per tuple
+    entry, e.g. into fit_data_dict_1, fit_data_dict_2, B_dict_1, B_dict_2. Accessing a mode
+    in any of them reads the whole tuple once.
+    """
+    return [LazyModeDict(mode_dict, lambda mode, i=i: mode_dict[mode][i]) for i in range(n_items)]
+
+#----------------------------------------------------------------------------------------------------
+def read_modes(mode_dicts, modes, workers):
+    """
+    Reads the given modes of all LazyModeDicts in mode_dicts right away, with a thread pool
+    of workers threads (see parallel_io.read_all)
+    """
+    parallel_io.read_all(lambda mode: [mode_dict[mode] for mode_dict in mode_dicts], modes, workers)
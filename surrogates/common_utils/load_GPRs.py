@@ -11,10 +11,15 @@
 ##==============================================================================
 
 import numpy as np
-import h5py
 import copy
 from . import load_splines
+from . import lazy_modes
+from . import parallel_io
 from . import utils
+from .lazy_imports import LazyModule
+
+# imported on first use, see lazy_imports.py
+h5py = LazyModule('h5py')
 
 #----------------------------------------------------------------------------------------------------
 def read_times(file):
@@ -112,17 +117,211 @@ def extract_h5filegprsettings_to_emptydict(h_gpr, h_file, nnodes):
                                ['name', 'noise_level', 'noise_level_bounds'])
                         
 
+# GPR settings copied for every node by extract_h5filegprsettings_to_emptydict, as
+# (group relative to the node, dataset names)
+_GPR_NODE_DATASETS = [
+    ('', ['data_mean', 'data_std']),
+    ('lin_reg_params', ['coef_', 'intercept_']),
+    ('GPR_params', ['X_train_', 'alpha_', '_y_train_mean', 'L_']),
+    ('GPR_params/kernel_', ['name', 'k2__noise_level', 'k2__noise_level_bounds', 'k1__k2__length_scale',
+                            'k1__k2__length_scale_bounds', 'k1__k1__constant_value',
+                            'k1__k1__constant_value_bounds']),
+    ('GPR_params/kernel_/k1', ['name', 'k1__constant_value', 'k1__constant_value_bounds',
+                               'k2__length_scale', 'k2__length_scale_bounds']),
+    ('GPR_params/kernel_/k1/k1', ['name', 'constant_value', 'constant_value_bounds']),
+    ('GPR_params/kernel_/k1/k2', ['name', 'length_scale', 'length_scale_bounds']),
+    ('GPR_params/kernel_/k1__k1', ['name', 'constant_value', 'constant_value_bounds']),
+    ('GPR_params/kernel_/k1__k2', ['name', 'length_scale', 'length_scale_bounds']),
+    ('GPR_params/kernel_/k2', ['name', 'noise_level', 'noise_level_bounds']),
+]
+
+# path of each dataset relative to the node -> (group path as a list, dataset name)
+_GPR_NODE_DATASET_PATHS = {(group + '/' + key if group else key): (group.split('/') if group else [], key)
+                           for group, keys in _GPR_NODE_DATASETS for key in keys}
+
+#----------------------------------------------------------------------------------------------------
+def _read_stacked(buffers, path, dsid, eim_indx, nnodes):
+    """
+    Read the dataset dsid of node eim_indx into row eim_indx of the buffer stacking the
+    dataset at path over all nodes, allocating the buffer for the first node. Returns the
+    row (a view), or a new array if the dataset does not have the shape of the buffer.
+    """
+    shape, dtype = dsid.shape, dsid.dtype
+    buffer = buffers.get(path)
+    if buffer is None or buffer.shape[1:] != shape or buffer.dtype != dtype:
+        if eim_indx == 0:
+            buffer = buffers[path] = np.empty((nnodes,) + shape, dtype=dtype)
+        else:
+            buffer = np.empty((1,) + shape, dtype=dtype)
+            eim_indx = 0
+    row = buffer[eim_indx:eim_indx+1].reshape(shape)
+    dsid.read(h5py.h5s.ALL, h5py.h5s.ALL, row)
+    # scalar datasets are returned as numpy scalars, as by dataset[()]
+    return row[()] if shape == () else row
+
+#----------------------------------------------------------------------------------------------------
+def read_gpr_settings(h_file, nnodes):
+    """
+    Read all GPR fit related settings of the amplitude/phase or real/imag fit of one mode.
+    Gives the same settings as extract_h5filegprsettings_to_emptydict, but opens every
+    dataset once through the low level h5py interface and reads it straight into a buffer
+    stacking that dataset over all nodes, without intermediate copies.
+    h_file: group in the h5 file containing all GPR settings, e.g. f_mode['gpr_amp']
+    nnodes: number of EIM nodes
+    Returns the GPR settings as a dictionary with keys 'node0', 'node1', ...
+    """
+    fit_type = utils.chars_to_string(h_file['fitType'][()])
+
+    buffers = {}
+    h_gpr = {}
+    for eim_indx in range(nnodes):
+        node = 'node%s'%eim_indx
+        kernel = {'k1__k1': {}, 'k2': {}, 'k1__k2': {}, 'k1': {'k1': {}, 'k2': {}}}
+        h_node = {'GPR_params': {'kernel_': kernel}, 'lin_reg_params': {}, 'fitType': fit_type}
+
+        for path, (groups, key) in _GPR_NODE_DATASET_PATHS.items():
+            dsid = h5py.h5d.open(h_file.id, ('%s/%s'%(node, path)).encode())
+            value = _read_stacked(buffers, path, dsid, eim_indx, nnodes)
+            target = h_node
+            for group in groups:
+                target = target[group]
+            target[key] = utils.chars_to_string(value) if key == 'name' else value
+
+        h_gpr[node] = h_node
+    return h_gpr
+
 #----------------------------------------------------------------------------------------------------
-def load_surrogate(h5_data_dir, fname, wf_modes, nrcalib_modes):
+def _check_kernel_structure(kernel):
+    """
+    Check that a GPR kernel is ConstantKernel * RBF + WhiteKernel, the structure assumed
+    by the packed GPR evaluation
+    kernel: dictionary with the kernel settings of one node
+    """
+    names = [utils.chars_to_string(name) if not isinstance(name, str) else name for name in
+             [kernel['name'], kernel['k1']['name'], kernel['k1']['k1']['name'],
+              kernel['k1']['k2']['name'], kernel['k2']['name']]]
+    if names != ['Sum', 'Product', 'ConstantKernel', 'RBF', 'WhiteKernel']:
+        raise ValueError("Packed GPR fits require a ConstantKernel * RBF + WhiteKernel kernel, "
+                         "got %s(%s(%s, %s), %s)" % tuple(names))
+
+#----------------------------------------------------------------------------------------------------
+def pack_gpr_fits(fit_data_dict_1, fit_data_dict_2):
+    """
+    Stacks the per-node GPR settings of all modes and both datapieces into padded arrays
+    so that every EIM node can be evaluated at once (see fits.evaluate_packed_fits).
+
+    Nodes with fewer training points are padded with zero weights, which do not contribute
+    to the prediction.
+
+    Inputs
+    ======
+        fit_data_dict_1, fit_data_dict_2 : dictionary of GPR fit data for the two datapieces
+                                           of one sub-surrogate as returned by load_surrogate()
+
+    Outputs
+    =======
+        packed_fits : dictionary with
+                        'fit_func' : 'GPR_fits'
+                        'n_nodes'  : total number of EIM nodes
+                        'offsets'  : (datapiece, mode) -> (start, stop) slice of the nodes
+                                     in the stacked EIM values; datapiece is 0 or 1
+                        'X_train_scaled' : training points divided by the RBF length 
+                                     scales, (n_nodes, n_train_max, n_dim)
+                        'const_alpha' : constant kernel value times the GPR weights,
+                                     (n_nodes, n_train_max)
+                        'length_scale' : RBF length scales, (n_nodes, n_dim)
+                        'y_train_mean', 'y_train_std', 'data_mean', 'data_std' : 
+                                     normalization of the GPR output, (n_nodes,)
+                        'coef', 'intercept' : linear regression trend, (n_nodes, n_dim) 
+                                     and (n_nodes,)
+    """
+    offsets = {}
+    nodes = []
+    for datapiece, fit_data_dict in enumerate([fit_data_dict_1, fit_data_dict_2]):
+        for mode in fit_data_dict.keys():
+            h_eim_gpr, eim_indicies = fit_data_dict[mode][:2]
+            offsets[(datapiece, mode)] = (len(nodes), len(nodes) + len(eim_indicies))
+            nodes.extend(h_eim_gpr['node%s'%eim_indx] for eim_indx in range(len(eim_indicies)))
+
+    n_nodes = len(nodes)
+    n_dim = np.shape(nodes[0]['GPR_params']['X_train_'])[1]
+    n_train_max = max(len(node['GPR_params']['X_train_']) for node in nodes)
+
+    packed_fits = {'fit_func': 'GPR_fits', 'n_nodes': n_nodes, 'offsets': offsets,
+                   'X_train_scaled': np.zeros((n_nodes, n_train_max, n_dim)),
+                   'const_alpha': np.zeros((n_nodes, n_train_max)),
+                   'length_scale': np.empty((n_nodes, n_dim)),
+                   'y_train_mean': np.empty(n_nodes), 'y_train_std': np.empty(n_nodes),
+                   'data_mean': np.empty(n_nodes), 'data_std': np.empty(n_nodes),
+                   'coef': np.empty((n_nodes, n_dim)), 'intercept': np.empty(n_nodes)}
+
+    for i, node in enumerate(nodes):
+        gpr_params = node['GPR_params']
+        kernel = gpr_params['kernel_']
+        _check_kernel_structure(kernel)
+        n_train = len(gpr_params['X_train_'])
+        packed_fits['length_scale'][i] = kernel['k1']['k2']['length_scale']
+        packed_fits['X_train_scaled'][i, :n_train] = gpr_params['X_train_'] / packed_fits['length_scale'][i]
+        packed_fits['const_alpha'][i, :n_train] = kernel['k1']['k1']['constant_value'] * \
+                                                  np.ravel(gpr_params['alpha_'])
+        # single-output fits; scikit-learn may store these as arrays of length one
+        packed_fits['y_train_mean'][i] = np.squeeze(gpr_params['_y_train_mean'])
+        # fits built with scikit-learn < 0.23 have no _y_train_std, which amounts to 1
+        packed_fits['y_train_std'][i] = np.squeeze(gpr_params.get('_y_train_std', 1.0))
+        packed_fits['data_mean'][i] = np.squeeze(node['data_mean'])
+        packed_fits['data_std'][i] = np.squeeze(node['data_std'])
+        packed_fits['coef'][i] = np.ravel(node['lin_reg_params']['coef_'])
+        packed_fits['intercept'][i] = np.squeeze(node['lin_reg_params']['intercept_'])
+
+    return packed_fits
+
+#----------------------------------------------------------------------------------------------------
+def read_mode_fits(f_sign, mode):
+    """
+    Read the fit data and basis matrices of the amplitude and phase of one mode of a
+    sub-surrogate
+    f_sign: group of the sub-surrogate in the h5 file, e.g. file['positive_spin']
+    Returns fit_data_amp, fit_data_ph, B_amp, B_ph in the layout of load_surrogate()
+    """
+    # splice out the relevant dictionary from h5 file for each mode
+    f_mode = f_sign['l%s_m%s'%(mode[0], mode[1])]
+
+    # basis matrix; h5py returns new arrays, no copies needed
+    B_amp = f_mode["B_amp"][()]
+    B_ph = f_mode["B_phase"][()]
+
+    # EIM indicies
+    eim_indicies_amp = f_mode["eim_indicies_amp"][()]
+    eim_indicies_ph = f_mode["eim_indicies_phase"][()]
+
+    # GPR settings, reading each group of the h5 file in a single traversal
+    h_eim_gpr_amp = read_gpr_settings(f_mode['gpr_amp'], len(eim_indicies_amp))
+    h_eim_gpr_ph = read_gpr_settings(f_mode['gpr_phase'], len(eim_indicies_ph))
+
+    # construct fit data for each mode; the fit evaluators are built on first use (see
+    # fits._evaluate_GPR_at_EIM_nodes), the packed GPR evaluation does not need them
+    return [h_eim_gpr_amp, eim_indicies_amp, None], \
+           [h_eim_gpr_ph, eim_indicies_ph, None], B_amp, B_ph
+
+#----------------------------------------------------------------------------------------------------
+def load_surrogate(h5_data_dir, fname, wf_modes, nrcalib_modes, workers=None):
     """ Loads all GPR interpolation data
             - Included modes = [(2,1),(3,1),(2,2),(3,2),(4,2),(3,3),(4,3),(4,4)]
             - NOTE: Requires h5 file to be in the same directory as this script.
             - Returns:
                 - times, eim_indicies_amp, eim_indicies_ph, b_amp, b_ph, h_amp_gpr, h_ph_gpr
                 - NOTE: times is dictionary with times.keys() = ['negative_spin', 'positive_spin']
+                - NOTE: the fit data of each mode is [GPR settings, EIM indicies, fit evaluators],
+                  where the evaluators are None until they are first needed
+            - With workers > 1 the file is prefetched and the modes of both sub-surrogates are
+              read concurrently (see parallel_io); defaults to BHPTNRSUR_LOAD_WORKERS.
     """
-    
-    with h5py.File('%s/%s'%(h5_data_dir,fname), 'r') as file:
+
+    workers = parallel_io.n_workers(workers)
+    path = '%s/%s'%(h5_data_dir,fname)
+    parallel_io.prefetch_file(path, workers)
+
+    with h5py.File(path, 'r') as file:
         
         # obtain training time values
         times = read_times(file)
@@ -131,7 +330,13 @@ def load_surrogate(h5_data_dir, fname, wf_modes, nrcalib_modes):
         # Now for 2d surrogae each of dictionary will contain data for positive and negative spins 
         B_dict_amp, B_dict_ph = {}, {}
         fit_data_dict_amp, fit_data_dict_ph = {}, {}
-        
+
+        # read the modes of both sub-surrogates, concurrently for several workers
+        sign_modes = [(spin_sign, mode) for spin_sign in ['negative_spin', 'positive_spin']
+                      for mode in wf_modes]
+        mode_fits = parallel_io.read_all(lambda sign_mode: read_mode_fits(file[sign_mode[0]], sign_mode[1]),
+                                         sign_modes, workers)
+
         for spin_sign in ['negative_spin', 'positive_spin']:
             
             # empty dictionaries for holding basis vectors, EIM info and GPR settings
@@ -142,33 +347,69 @@ def load_surrogate(h5_data_dir, fname, wf_modes, nrcalib_modes):
     
             # Copy data groups we need to access from hdf5 file into output dicts
             for mode in wf_modes:
-                
-                # splice out the relevant dictionary from h5 file for each mode
-                f_mode = file[spin_sign]['l%s_m%s'%(mode[0], mode[1])]
-                # obtain data groups for the amplitude and phases
-                h_amp_file, h_ph_file = dict(f_mode['gpr_amp']), dict(f_mode['gpr_phase'])
-
-                # basis matrix
-                B_dict_amp[spin_sign][mode] = copy.deepcopy(f_mode["B_amp"][()])
-                B_dict_ph[spin_sign][mode] = copy.deepcopy(f_mode["B_phase"][()])
-                
-                # EIM indicies
-                eim_indicies_amp = copy.deepcopy(f_mode["eim_indicies_amp"][()])
-                eim_indicies_ph = copy.deepcopy(f_mode["eim_indicies_phase"][()])
-                
-                # GPR settings
-                h_eim_gpr_amp, h_eim_gpr_ph = {}, {}
-                extract_h5filegprsettings_to_emptydict(h_eim_gpr_amp, h_amp_file, len(eim_indicies_amp))
-                extract_h5filegprsettings_to_emptydict(h_eim_gpr_ph, h_ph_file, len(eim_indicies_ph))
-                        
-                # construct fit data for each mode
-                fit_data_dict_amp[spin_sign][mode] = [h_eim_gpr_amp, eim_indicies_amp]
-                fit_data_dict_ph[spin_sign][mode] = [h_eim_gpr_ph, eim_indicies_ph]
+                fit_data_dict_amp[spin_sign][mode], fit_data_dict_ph[spin_sign][mode], \
+                    B_dict_amp[spin_sign][mode], B_dict_ph[spin_sign][mode] \
+                                                        = mode_fits[(spin_sign, mode)]
 
         # nr calibration info
         alpha_coeffs, beta_coeffs = load_splines.read_nrcalib_info(file, nrcalib_modes)
 
     return times, fit_data_dict_amp, fit_data_dict_ph, B_dict_amp, B_dict_ph, alpha_coeffs, beta_coeffs
-                        
 
+#----------------------------------------------------------------------------------------------------
+def open_sub_surrogate(h5_data_dir, fname, spin_sign, wf_modes, workers=None):
+    """ Opens one sub-surrogate ('negative_spin' or 'positive_spin') of the h5 file, which is
+        kept open until all modes have been read. The times are read right away; the fit
+        data and basis matrices of each mode are read when they are first accessed (see
+        lazy_modes.LazyModeDict). With workers > 1 all modes are instead read right away,
+        concurrently, and the file is closed (see parallel_io); defaults to the
+        BHPTNRSUR_LOAD_WORKERS environment variable.
+            - Returns:
+                - times, fit_data_dict_amp, fit_data_dict_ph, B_dict_amp, B_dict_ph of the
+                  sub-surrogate, in the layout of load_surrogate() without the spin sign level
+    """
+
+    workers = parallel_io.n_workers(workers)
+    path = '%s/%s'%(h5_data_dir,fname)
+    parallel_io.prefetch_file(path, workers)
+    file = h5py.File(path, 'r')
+    try:
+        f_sign = file[spin_sign]
+
+        # same times for all modes
+        times = f_sign["l2_m2"]["times"][()]
+    except BaseException:
+        file.close()
+        raise
+
+    # the file is closed once the last mode has been read
+    mode_fits = lazy_modes.LazyModeDict(wf_modes, lambda mode: read_mode_fits(f_sign, mode),
+                                        on_complete=file.close)
+    mode_dicts = lazy_modes.split_mode_dict(mode_fits, 4)
+    if workers > 1:
+        lazy_modes.read_modes(mode_dicts, wf_modes, workers)
+    fit_data_dict_amp, fit_data_dict_ph, B_dict_amp, B_dict_ph = mode_dicts
+
+    return times, fit_data_dict_amp, fit_data_dict_ph, B_dict_amp, B_dict_ph
+
+#----------------------------------------------------------------------------------------------------
+def open_surrogate(h5_data_dir, fname, wf_modes, nrcalib_modes, workers=None):
+    """ Same as load_surrogate(), but the fit data and basis matrices of each mode of each
+        sub-surrogate are only read from the h5 file, which is kept open until all modes
+        have been read, when they are first accessed (see open_sub_surrogate). The times and nr calibration info
+        are read right away. With workers > 1 all modes are read right away, concurrently.
+    """
+
+    times = {}
+    B_dict_amp, B_dict_ph = {}, {}
+    fit_data_dict_amp, fit_data_dict_ph = {}, {}
+    for spin_sign in ['negative_spin', 'positive_spin']:
+        times[spin_sign], fit_data_dict_amp[spin_sign], fit_data_dict_ph[spin_sign], \
+            B_dict_amp[spin_sign], B_dict_ph[spin_sign] \
+                                = open_sub_surrogate(h5_data_dir, fname, spin_sign, wf_modes, workers)
 
+    # nr calibration info
+    with h5py.File('%s/%s'%(h5_data_dir,fname), 'r') as file:
+        alpha_coeffs, beta_coeffs = load_splines.read_nrcalib_info(file, nrcalib_modes)
+
+    return times, fit_data_dict_amp, fit_data_dict_ph, B_dict_amp, B_dict_ph, alpha_coeffs, beta_coeffs
@@ -5,7 +5,12 @@
 ##==============================================================================
 
 import numpy as np
-import h5py
+from . import lazy_modes
+from . import parallel_io
+from .lazy_imports import LazyModule
+
+# imported on first use, see lazy_imports.py
+h5py = LazyModule('h5py')
 
 #----------------------------------------------------------------------------------------------------
 def read_amplitude_fits(f, lmode, mmode):
@@ -121,55 +126,152 @@ def read_nrcalib_info(f, nrcalib_modes):
     return alpha_coeffs, beta_coeffs
 
 #----------------------------------------------------------------------------------------------------
-def load_surrogate(h5_data_dir, h5File, wf_modes, nrcalib_modes):
+def read_mode_fits(f, mode):
+    """
+    Read the fit data and basis matrices of the two datapieces of one mode
+    Returns fit_data_1, fit_data_2, B_1, B_2 in the layout of load_surrogate()
+    """
+    lmode,mmode=mode
+
+    # special treatment for 22 mode; we model the mode with amp/phase decompositon
+    # so we will use arrays to store the fit info
+    if mode==(2,2):
+        # read amplitude fits
+        eim_indicies_1, B_1, h_eim_spline_1 = read_amplitude_fits(f, lmode, mmode)
+        # read phase fits
+        eim_indicies_2, B_2, h_eim_spline_2 = read_phase_fits(f, lmode, mmode)
+
+    # read other modes
+    # these modes have been modelled with real/imag decompositon
+    else:
+        # read real part fits
+        eim_indicies_1, B_1, h_eim_spline_1 = read_real_part_fits(f, lmode, mmode)
+        # read imag part fits
+        eim_indicies_2, B_2, h_eim_spline_2 = read_imag_part_fits(f, lmode, mmode)
+
+    # now combine eim_spline and eim_indicies values to get the full fit data for 
+    # all modes - this cleans up the code significantly
+    return [h_eim_spline_1, eim_indicies_1], [h_eim_spline_2, eim_indicies_2], B_1, B_2
+
+#----------------------------------------------------------------------------------------------------
+def load_surrogate(h5_data_dir, h5File, wf_modes, nrcalib_modes, workers=None):
     
     """ 
     Loads all spline interpolation data for a given set of modes
+    With workers > 1 the file is prefetched and the modes are read concurrently
+    (see parallel_io); defaults to the BHPTNRSUR_LOAD_WORKERS environment variable.
     """
 
+    workers = parallel_io.n_workers(workers)
+    path = '%s/%s'%(h5_data_dir,h5File)
+    parallel_io.prefetch_file(path, workers)
+
     # read all fit info
-    with h5py.File('%s/%s'%(h5_data_dir,h5File), 'r') as f:
+    with h5py.File(path, 'r') as f:
 
         # we will save the fit info for two datapieces
         # in dictionary for all modes
         B_dict_1, B_dict_2  = {}, {}
         fit_data_dict_1, fit_data_dict_2 = {}, {}
         
-        # loop over all modes
-        for mode in wf_modes:
+        # same times for all modes; keep the ones of the last mode
+        time = read_times(f, *wf_modes[-1])
 
-            lmode,mmode=mode
-            # read time data
-            time = read_times(f, lmode, mmode)
-            
-            # special treatment for 22 mode; we model the mode with amp/phase decompositon
-            # so we will use arrays to store the fit info
-            if mode==(2,2):
-                # read amplitude fits
-                eim_indicies_1, B_dict_1[(mode)], h_eim_spline_1 \
-                                                                = read_amplitude_fits(f, lmode, mmode)
-                # read phase fits
-                eim_indicies_2, B_dict_2[(mode)], h_eim_spline_2 \
-                                                                = read_phase_fits(f, lmode, mmode)
-
-            # read other modes
-            # these modes have been modelled with real/imag decompositon
-            # we will use dictionary to save the fit info for all modes
-            else:
-                # read real part fits
-                eim_indicies_1, B_dict_1[(mode)], h_eim_spline_1 \
-                                                                = read_real_part_fits(f, lmode, mmode)
-                # read imag part fits
-                eim_indicies_2, B_dict_2[(mode)], h_eim_spline_2 \
-                                                                = read_imag_part_fits(f, lmode, mmode)
-            
-            # now combine eim_spline and eim_indicies values to get the full fit data for 
-            # all modes - this cleans up the code significantly
-            fit_data_dict_1[mode] = [h_eim_spline_1, eim_indicies_1]
-            fit_data_dict_2[mode] = [h_eim_spline_2, eim_indicies_2]
+        # read all modes, concurrently for several workers
+        mode_fits = parallel_io.read_all(lambda mode: read_mode_fits(f, mode), wf_modes, workers)
+        for mode in wf_modes:
+            fit_data_dict_1[mode], fit_data_dict_2[mode], B_dict_1[mode], B_dict_2[mode] \
+                                                                = mode_fits[mode]
                 
         # nr calibration info
         alpha_coeffs, beta_coeffs = read_nrcalib_info(f, nrcalib_modes)
 
     return time, fit_data_dict_1, fit_data_dict_2, B_dict_1, B_dict_2, alpha_coeffs, beta_coeffs
 
+#----------------------------------------------------------------------------------------------------
+def open_surrogate(h5_data_dir, h5File, wf_modes, nrcalib_modes, workers=None):
+
+    """
+    Same as load_surrogate(), but the fit data and basis matrices of each mode are only
+    read from the h5 file, which is kept open until all modes have been read, when the
+    mode is first accessed (see lazy_modes.LazyModeDict). The time and nr calibration
+    info are read right away. With workers > 1 all modes are instead read right away,
+    concurrently, and the file is closed (see parallel_io); defaults to the
+    BHPTNRSUR_LOAD_WORKERS environment variable.
+    """
+
+    workers = parallel_io.n_workers(workers)
+    path = '%s/%s'%(h5_data_dir,h5File)
+    parallel_io.prefetch_file(path, workers)
+    f = h5py.File(path, 'r')
+    try:
+        # same times for all modes; load_surrogate() keeps the ones of the last mode
+        time = read_times(f, *wf_modes[-1])
+
+        # nr calibration info
+        alpha_coeffs, beta_coeffs = read_nrcalib_info(f, nrcalib_modes)
+    except BaseException:
+        f.close()
+        raise
+
+    # the file is closed once the last mode has been read
+    mode_fits = lazy_modes.LazyModeDict(wf_modes, lambda mode: read_mode_fits(f, mode),
+                                        on_complete=f.close)
+    mode_dicts = lazy_modes.split_mode_dict(mode_fits, 4)
+    if workers > 1:
+        lazy_modes.read_modes(mode_dicts, wf_modes, workers)
+    fit_data_dict_1, fit_data_dict_2, B_dict_1, B_dict_2 = mode_dicts
+
+    return time, fit_data_dict_1, fit_data_dict_2, B_dict_1, B_dict_2, alpha_coeffs, beta_coeffs
+
+#----------------------------------------------------------------------------------------------------
+def pack_spline_fits(fit_data_dict_1, fit_data_dict_2):
+    """
+    Repacks the per-node spline tuples of all modes and both datapieces into stacked
+    knot/coefficient arrays so that every EIM node can be evaluated at once.
+
+    Nodes sharing the same knot vector and degree are grouped together; each group is
+    evaluated with a single B-spline call (see fits.evaluate_packed_fits).
+
+    Inputs
+    ======
+        fit_data_dict_1, fit_data_dict_2 : dictionary of spline fit data for the two
+                                           datapieces as returned by load_surrogate()
+
+    Outputs
+    =======
+        packed_fits : dictionary with
+                        'fit_func' : 'spline_1d'
+                        'n_nodes'  : total number of EIM nodes
+                        'offsets'  : (datapiece, mode) -> (start, stop) slice of the nodes
+                                     in the stacked EIM values; datapiece is 0 or 1
+                        'groups'   : list of dictionaries with 'knots', 'degree',
+                                     'coefs' (n_group_nodes, n_coefs) and 'rows' (position
+                                     of each group node in the stacked EIM values)
+    """
+    groups = {}
+    offsets = {}
+    n_nodes = 0
+
+    for datapiece, fit_data_dict in enumerate([fit_data_dict_1, fit_data_dict_2]):
+        for mode in fit_data_dict.keys():
+            h_eim_spline = fit_data_dict[mode][0]
+            offsets[(datapiece, mode)] = (n_nodes, n_nodes + len(h_eim_spline))
+            for (knots, coefs, degree) in h_eim_spline:
+                key = (degree, knots.tobytes())
+                if key not in groups:
+                    groups[key] = {'knots': knots, 'degree': degree, 'coefs': [], 'rows': []}
+                # splrep pads the coefficients to the length of the knot vector; only the
+                # first len(knots)-degree-1 of them enter the spline
+                groups[key]['coefs'].append(coefs[:len(knots)-degree-1])
+                groups[key]['rows'].append(n_nodes)
+                n_nodes += 1
+
+    packed_groups = []
+    for group in groups.values():
+        packed_groups.append({'knots': np.asarray(group['knots'], dtype=float),
+                              'degree': group['degree'],
+                              'coefs': np.array(group['coefs'], dtype=float),
+                              'rows': np.array(group['rows'], dtype=int)})
+
+    return {'fit_func': 'spline_1d', 'n_nodes': n_nodes, 'offsets': offsets, 'groups': packed_groups}
@@ -6,6 +6,7 @@
 ##==============================================================================
 
 import numpy as np
+from .waveform_modes import as_waveform_modes
 
 #----------------------------------------------------------------------------------------------------
 def alpha_beta_BHPTNRSur1dq1e4(x, a, b, c, d):
@@ -43,6 +44,14 @@ def evaluate_alpha(X, l, coefs_alpha, alpha_beta_functional_form):
     return alpha
 
 
+#----------------------------------------------------------------------------------------------------
+def evaluate_alphas(X, ells, coefs_alpha, alpha_beta_functional_form):
+    """ Computes the alpha value of each mode, given by its l, at a given point in the 
+        parameter space
+    """
+    return [evaluate_alpha(X, int(l), coefs_alpha, alpha_beta_functional_form) for l in ells]
+
+
 #----------------------------------------------------------------------------------------------------
 def evaluate_beta(X, coefs_beta, alpha_beta_functional_form):
     """ Implements alpha-scaling to match NR 
@@ -80,6 +89,9 @@ def generate_calibrated_ppBHPT(X_input, raw_time, h_raw_dict, coefs_alpha, coefs
     ======
         
         X_input : array of nr calibration parameterization e.g. [1/q, spin]
+                  For a batch of N waveforms, each parameter is a column of shape (N, 1);
+                  alpha and beta are then evaluated for the whole batch at once and 
+                  t_calib has shape (N, n_times)
         time : array of uncalibrated time on which surrogate has been trained on 
         h_raw_dict : dictiornary of uncalibrated modes
         coeffs_alpha : dictionary of alpha values obtained from calibration mode-by-mode
@@ -91,17 +103,14 @@ def generate_calibrated_ppBHPT(X_input, raw_time, h_raw_dict, coefs_alpha, coefs
     =======
     
         t_calib : rescaled time array
-        hcal_dict : dictiornary of rescaled modes 
+        hcal_dict : dictiornary of rescaled modes (a waveform_modes.WaveformModes)
         
     """
-    hcal_dict = {}
-    # scale all modes
-    for mode in h_raw_dict.keys():
-        (l,m)=mode
-        # evaluate alpha
-        alpha = evaluate_alpha(X_input, l, coefs_alpha, alpha_beta_functional_form) 
-        # scale the strain
-        hcal_dict[mode] = alpha_scaling_h(h_raw_dict[mode], alpha) 
+    h_raw_dict = as_waveform_modes(h_raw_dict)
+    # evaluate alpha for all modes
+    alphas = evaluate_alphas(X_input, h_raw_dict.ell, coefs_alpha, alpha_beta_functional_form)
+    # scale the strain of all modes at once
+    hcal_dict = h_raw_dict.with_data(h_raw_dict.data*h_raw_dict.per_mode(alphas))
         
     # evaluate beta
     beta = evaluate_beta(X_input, coefs_beta, alpha_beta_functional_form)
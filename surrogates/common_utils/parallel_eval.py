@@ -0,0 +1,81 @@
+##==============================================================================
+## BHPTNRSurrogate module
+## Description : concurrent evaluation of the surrogate modes
+## Author : BHPTNRSurrogate developers, Oct 2026
+##==============================================================================
+
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+"""
+With more than one evaluation worker, fits.all_modes_surrogate evaluates the modes on a
+thread pool of that size. The work of each mode (EIM reconstruction with np.dot, the
+complex exponential or the amplitude/phase conversion, the conjugation) runs in NumPy and
+BLAS sections that release the GIL, and each mode is written into its own row of the
+output block, so the result does not depend on the number of workers. The pools are
+created on first use and shared by all calls, so that a single waveform request does not
+pay for starting threads. A forked child (e.g. a sweep worker) starts pools of its own.
+
+If NumPy uses a multithreaded BLAS, each worker may start BLAS threads of its own; limit
+them (e.g. OPENBLAS_NUM_THREADS) when using many workers.
+
+The number of workers defaults to the BHPTNRSUR_EVAL_WORKERS environment variable, or
+1 (sequential evaluation) if it is not set.
+"""
+
+# shared thread pools, by number of workers
+_executors = {}
+_executors_lock = threading.Lock()
+
+#----------------------------------------------------------------------------------------------------
+def _reset_after_fork():
+    """ The threads of the pools do not survive a fork; the child starts new pools """
+    global _executors, _executors_lock
+    _executors = {}
+    _executors_lock = threading.Lock()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+#----------------------------------------------------------------------------------------------------
+def n_workers(workers=None):
+    """
+    Number of evaluation workers: workers if given, else the BHPTNRSUR_EVAL_WORKERS
+    environment variable, else 1
+    """
+    if workers is None:
+        workers = os.environ.get('BHPTNRSUR_EVAL_WORKERS') or 1
+    workers = int(workers)
+    if workers < 1:
+        raise ValueError("The number of evaluation workers must be at least 1, got %d" % workers)
+    return workers
+
+#----------------------------------------------------------------------------------------------------
+def executor(workers):
+    """ The shared thread pool with workers threads, created on first use """
+    with _executors_lock:
+        pool = _executors.get(workers)
+        if pool is None:
+            pool = _executors[workers] = ThreadPoolExecutor(max_workers=workers,
+                                                            thread_name_prefix='BHPTNRSur-eval')
+        return pool
+
+#----------------------------------------------------------------------------------------------------
+def for_each(func, items, workers, start=0):
+    """
+    Calls func(i, item) for every item, with i counted from start, and returns the results
+    in the order of items, on the shared thread pool of workers threads (sequentially for
+    a single worker). Each thread takes every workers-th item, so that there is one task
+    per thread rather than per item. The first exception raised by func is raised again here.
+    """
+    items = list(enumerate(items, start))
+    if workers < 2 or len(items) < 2:
+        return [func(i, item) for i, item in items]
+    n_tasks = min(workers, len(items))
+    def run(task):
+        return [func(i, item) for i, item in items[task::n_tasks]]
+    results = [None]*len(items)
+    for task, task_results in enumerate(executor(workers).map(run, range(n_tasks))):
+        results[task::n_tasks] = task_results
+    return results
@@ -0,0 +1,74 @@
+##==============================================================================
+## BHPTNRSurrogate module
+## Description : concurrent ingestion of the surrogate h5 files
+## Author : BHPTNRSurrogate developers, Oct 2026
+##==============================================================================
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+"""
+With more than one load worker, the h5 file is first read with that many concurrent
+positional reads (which run without the GIL) so that it sits in the page cache, and the
+modes are then read and unpacked by a thread pool of the same size. On high-latency
+(e.g. parallel or network) filesystems the cold start then scales with the available
+I/O concurrency instead of the number of round trips made by the sequential h5 reads;
+h5py itself serializes its calls, so the gain comes from the concurrent prefetch.
+
+The number of workers defaults to the BHPTNRSUR_LOAD_WORKERS environment variable, or
+1 (sequential reads, no prefetch) if it is not set.
+"""
+
+# bytes per positional read of the prefetch
+PREFETCH_CHUNK_SIZE = 4 * 1024 * 1024
+
+#----------------------------------------------------------------------------------------------------
+def n_workers(workers=None):
+    """
+    Number of load workers: workers if given, else the BHPTNRSUR_LOAD_WORKERS environment
+    variable, else 1
+    """
+    if workers is None:
+        workers = os.environ.get('BHPTNRSUR_LOAD_WORKERS') or 1
+    workers = int(workers)
+    if workers < 1:
+        raise ValueError("The number of load workers must be at least 1, got %d" % workers)
+    return workers
+
+#----------------------------------------------------------------------------------------------------
+def prefetch_file(path, workers, chunk_size=PREFETCH_CHUNK_SIZE):
+    """
+    Read the whole file at path with workers concurrent positional reads so that later
+    reads of it are served from the page cache. Does nothing for a single worker or on
+    platforms without os.pread.
+    """
+    if workers < 2 or not hasattr(os, 'pread'):
+        return
+    size = os.path.getsize(path)
+    fd = os.open(path, os.O_RDONLY)
+
+    def read_chunk(start):
+        stop = min(start + chunk_size, size)
+        while start < stop:
+            data = os.pread(fd, stop - start, start)
+            if not data:
+                break
+            start += len(data)
+
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(read_chunk, range(0, size, chunk_size)))
+    finally:
+        os.close(fd)
+
+#----------------------------------------------------------------------------------------------------
+def read_all(read_item, items, workers):
+    """
+    Returns the dictionary item -> read_item(item) for all items, read by a thread pool
+    of workers threads (sequentially for a single worker), in the order of items
+    """
+    items = list(items)
+    if workers < 2 or len(items) < 2:
+        return {item: read_item(item) for item in items}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return dict(zip(items, executor.map(read_item, items)))
@@ -0,0 +1,248 @@
+##==============================================================================
+## BHPTNRSurrogate module
+## Description : writes and reads the parsed surrogate data as a flat binary cache
+## Author : BHPTNRSurrogate developers, Oct 2026
+##==============================================================================
+
+import os
+import json
+import struct
+import mmap
+import tempfile
+from collections.abc import Mapping
+
+import numpy as np
+
+"""
+The compiled cache holds the fully parsed surrogate data (basis matrices, fit data,
+packed fits, calibration coefficients) in a single file so that a cold start reads one
+file instead of walking thousands of small HDF5 datasets.
+
+File layout
+===========
+    magic (8 bytes) | header length (uint64, little endian) | JSON header | padding |
+    array data
+
+The JSON header records the format version, the model name, the md5 hash of the
+h5 file the data was parsed from, the nested structure of the data and the dtype,
+shape and offset of every array. Arrays are stored uncompressed and contiguously,
+each aligned to ALIGNMENT bytes.
+"""
+
+MAGIC = b'BHPTSUR\x00'
+
+# bump whenever the layout of the parsed surrogate data changes
+FORMAT_VERSION = 2
+
+ALIGNMENT = 64
+
+#----------------------------------------------------------------------------------------------------
+def cache_path(h5_data_dir, model_name, file_hash):
+    """
+    Path of the compiled cache for a given model and h5 file hash.
+    The directory can be changed with the BHPTNRSUR_CACHE_DIR environment variable;
+    by default the cache sits next to the h5 file.
+    """
+    cache_dir = os.environ.get('BHPTNRSUR_CACHE_DIR', h5_data_dir)
+    return os.path.join(cache_dir, '%s.%s.sur' % (model_name, file_hash))
+
+#----------------------------------------------------------------------------------------------------
+def _encode(obj, arrays):
+    """
+    Encode a nested structure as JSON-compatible objects, appending arrays to the arrays list
+    """
+    # mappings such as lazy_modes.LazyModeDict are read in full and stored as dicts
+    if isinstance(obj, Mapping):
+        return {'dict': [[_encode(key, arrays), _encode(value, arrays)] for key, value in obj.items()]}
+    elif isinstance(obj, (list, tuple)) and obj and all(callable(value) for value in obj):
+        # a list of fit evaluators is dropped as a whole, see below
+        return None
+    elif isinstance(obj, list):
+        return {'list': [_encode(value, arrays) for value in obj]}
+    elif isinstance(obj, tuple):
+        return {'tuple': [_encode(value, arrays) for value in obj]}
+    elif isinstance(obj, (np.ndarray, np.generic)):
+        arrays.append(np.asarray(obj))
+        return {'array': len(arrays) - 1, 'scalar': isinstance(obj, np.generic)}
+    elif obj is None or isinstance(obj, (bool, int, float, str)):
+        return obj
+    elif callable(obj):
+        # e.g. fit evaluators; these are rebuilt from the stored fit data when needed
+        return None
+    raise TypeError("Cannot store object of type %s in the surrogate cache" % type(obj).__name__)
+
+#----------------------------------------------------------------------------------------------------
+def _decode(node, arrays):
+    """
+    Inverse of _encode
+    """
+    if isinstance(node, dict):
+        if 'dict' in node:
+            return {_decode(key, arrays): _decode(value, arrays) for key, value in node['dict']}
+        elif 'list' in node:
+            return [_decode(value, arrays) for value in node['list']]
+        elif 'tuple' in node:
+            return tuple(_decode(value, arrays) for value in node['tuple'])
+        elif 'array' in node:
+            array = arrays[node['array']]
+            return array[()] if node['scalar'] else array
+    return node
+
+#----------------------------------------------------------------------------------------------------
+def _padding(position):
+    return (-position) % ALIGNMENT
+
+#----------------------------------------------------------------------------------------------------
+def set_default_mode(fd):
+    """
+    Give the file fd the permissions of a file created with open(), 0o666 & ~umask,
+    instead of the 0o600 of tempfile.mkstemp, so that other users sharing the data
+    directory can read it once it is renamed into place
+    """
+    if not hasattr(os, 'fchmod'):
+        return
+    # the umask can only be read by setting it; 0o022 keeps files created meanwhile private
+    umask = os.umask(0o022)
+    os.umask(umask)
+    os.fchmod(fd, 0o666 & ~umask)
+
+#----------------------------------------------------------------------------------------------------
+def write_cache(path, data, model_name, file_hash):
+    """
+    Write the parsed surrogate data to the compiled cache at path.
+    The file is written to a temporary file first and renamed into place, so that
+    concurrent readers never see a partially written cache.
+
+    Inputs
+    ======
+        path : path of the cache file, see cache_path()
+        data : dictionary of parsed surrogate data (nested dicts, lists, tuples, arrays)
+        model_name : name of the surrogate model
+        file_hash : md5 hash of the h5 file the data was parsed from
+    """
+    arrays = []
+    tree = _encode(data, arrays)
+
+    array_info, offset = [], 0
+    for array in arrays:
+        offset += _padding(offset)
+        order = 'F' if array.flags.f_contiguous and not array.flags.c_contiguous else 'C'
+        array_info.append({'dtype': array.dtype.str, 'shape': list(array.shape),
+                           'order': order, 'offset': offset})
+        offset += array.nbytes
+
+    header = json.dumps({'format_version': FORMAT_VERSION, 'model': model_name,
+                         'source_md5': file_hash, 'tree': tree, 'arrays': array_info}).encode()
+    prefix = MAGIC + struct.pack('<Q', len(header)) + header
+    prefix += b'\0' * _padding(len(prefix))
+
+    cache_dir = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=cache_dir, prefix='.%s.' % os.path.basename(path))
+    try:
+        set_default_mode(fd)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(prefix)
+            position = 0
+            for array, info in zip(arrays, array_info):
+                f.write(b'\0' * (info['offset'] - position))
+                f.write(array.tobytes(order=info['order']))
+                position = info['offset'] + array.nbytes
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+#----------------------------------------------------------------------------------------------------
+def read_header(path):
+    """
+    Read the JSON header of a compiled cache.
+    Returns the header and the position where the array data starts.
+    """
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError("%s is not a BHPTNRSurrogate cache file" % path)
+        (header_length,) = struct.unpack('<Q', f.read(8))
+        header = json.loads(f.read(header_length).decode())
+    data_start = len(MAGIC) + 8 + header_length
+    return header, data_start + _padding(data_start)
+
+#----------------------------------------------------------------------------------------------------
+def read_cache(path, model_name, file_hash, mmap=False):
+    """
+    Read the parsed surrogate data from the compiled cache at path.
+    All arrays are views into a single buffer holding the whole file. With mmap=True
+    the file is memory-mapped instead of read, and the arrays are read-only views of the
+    mapping; processes mapping the same cache then share one copy in the page cache.
+
+    Returns None if there is no cache, if it cannot be read (e.g. it belongs to another
+    user), is damaged or truncated, or if it was written for another model, h5 file or
+    format version; the data then has to be parsed from the h5 file again.
+    """
+    if not os.path.isfile(path):
+        return None
+    try:
+        header, data_start = read_header(path)
+        if header['format_version'] != FORMAT_VERSION or header['model'] != model_name \
+                or header['source_md5'] != file_hash:
+            return None
+
+        if mmap:
+            buffer = np.memmap(path, dtype=np.uint8, mode='r')
+        else:
+            buffer = np.fromfile(path, dtype=np.uint8)
+        # a truncated file is too small for its arrays (TypeError)
+        arrays = [np.ndarray(tuple(info['shape']), dtype=np.dtype(info['dtype']), buffer=buffer,
+                             offset=data_start + info['offset'], order=info['order'])
+                  for info in header['arrays']]
+    except (OSError, ValueError, TypeError, KeyError, struct.error):
+        return None
+    return _decode(header['tree'], arrays)
+
+#----------------------------------------------------------------------------------------------------
+def _is_mapped(array):
+    """ True if array is a view of a memory-mapped file, e.g. of a compiled cache """
+    base = array
+    while base is not None:
+        if isinstance(base, (np.memmap, mmap.mmap)):
+            return True
+        base = getattr(base, 'base', None)
+    return False
+
+#----------------------------------------------------------------------------------------------------
+def pack_contiguous(data):
+    """
+    Returns a copy of the parsed surrogate data (nested dicts, lists, tuples, arrays, as
+    for write_cache) whose arrays are read-only views of a single contiguous buffer, laid
+    out as in the compiled cache. Lazily read mappings are read in full and become dicts,
+    and callables (fit evaluators) are dropped. Arrays that are already views of a
+    memory-mapped cache are kept as they are.
+
+    After a fork, the data of the processes then stays in pages that are shared and never
+    written: reference counting only touches the few container objects, not the arrays.
+    """
+    arrays = []
+    tree = _encode(data, arrays)
+
+    offsets, offset = [], 0
+    for array in arrays:
+        offset += _padding(offset)
+        offsets.append(offset)
+        offset += 0 if _is_mapped(array) else array.nbytes
+
+    # aligned like the cache file, relative to the start of the buffer
+    buffer = np.empty(offset + ALIGNMENT, dtype=np.uint8)
+    start = _padding(buffer.ctypes.data)
+    packed = []
+    for array, offset in zip(arrays, offsets):
+        if _is_mapped(array):
+            packed.append(array)
+            continue
+        view = np.ndarray(array.shape, dtype=array.dtype, buffer=buffer, offset=start + offset,
+                          order='F' if array.flags.f_contiguous and not array.flags.c_contiguous else 'C')
+        view[...] = array
+        packed.append(view)
+    buffer.flags.writeable = False
+    for view in packed:
+        view.flags.writeable = False
+    return _decode(tree, packed)
@@ -7,10 +7,14 @@
 import warnings
 
 import numpy as np
-from gwtools import gwtools as _gwtools
-from gwtools.harmonics import sYlm as _sYlm
 from . import nr_calibration as nrcalib
-from gwtools.gwtools import geo_to_SI
+from .lazy_imports import LazyModule
+from .waveform_modes import AmpPhaseModes, WaveformModes, as_waveform_modes
+from .workspace import Workspace
+
+# gwtools is only needed for physical units and evaluation on the sphere
+_gwtools = LazyModule('gwtools.gwtools')
+_harmonics = LazyModule('gwtools.harmonics')
 
 #----------------------------------------------------------------------------------------------------
 def chars_to_string(chars):
@@ -21,80 +25,264 @@ def chars_to_string(chars):
     return "".join(chr(cc) for cc in chars)
 
 #----------------------------------------------------------------------------------------------------
-def amp_ph_to_comp(amp,phase):
+def geo_to_SI(t_geo, h_geo, M_tot, dist_mpc):
+    """ Transforms the waveform from geometric units to physical units, as
+        gwtools.gwtools.geo_to_SI (whose constants are used), with all modes scaled at once.
+        Returns t_SI, h_SI with h_SI a WaveformModes
+    """
+    h_geo = as_waveform_modes(h_geo)
+    time_geo_to_SI, strain_geo_to_SI = _geo_to_SI_factors(M_tot, dist_mpc)
+    # scaling of time and of the strain of all modes
+    return t_geo * time_geo_to_SI, h_geo.with_data(h_geo.data*strain_geo_to_SI)
+
+#----------------------------------------------------------------------------------------------------
+def _geo_to_SI_factors(M_tot, dist_mpc):
+    """ Factors that convert time and strain from geometric units to physical units """
+    # physical units
+    M = M_tot * _gwtools.MSUN_SI
+    dL = dist_mpc * 1.e6 * _gwtools.PC_SI
+    return _gwtools.G*M/_gwtools.C_SI**3, (_gwtools.G*M/_gwtools.C_SI**2)/dL
+
+#----------------------------------------------------------------------------------------------------
+def amp_ph_to_comp(amp,phase,out=None):
     """ Takes the amplitude and phase of the waveform and
-    computes the compose them together"""
+    computes the compose them together, written into out if given"""
     
-    full_wf = amp*np.exp(1j*phase)
-    return full_wf
+    if out is None:
+        return amp*np.exp(1j*phase)
+    # amp*exp(1j*phase) without temporary arrays
+    out.real = 0
+    out.imag = phase
+    np.exp(out, out=out)
+    return np.multiply(out, amp, out=out)
 
 #----------------------------------------------------------------------------------------------------
-def re_im_to_comp(re, im):
+def re_im_to_comp(re, im, out=None):
     """ Takes the real and imaginary part of the waveform and
-    combine them to obtain the coorbital frame waveform"""
+    combine them to obtain the coorbital frame waveform, written into out if given"""
+    
+    if out is None:
+        return (re+1j*im)
+    out.real = re
+    out.imag = im
+    return out
+
+#----------------------------------------------------------------------------------------------------
+def amp_ph_to_polar(amp, phase, out=None, workspace=None):
+    """ Amplitude and phase of the waveform from its amplitude and phase datapieces, written 
+    into the pair of arrays out if given (which may be amp and phase themselves) """
+    
+    if out is None:
+        return np.array(amp), np.array(phase)
+    np.copyto(out[0], amp)
+    np.copyto(out[1], phase)
+    return out
+
+#----------------------------------------------------------------------------------------------------
+def re_im_to_polar(re, im, out=None, workspace=None):
+    """ Amplitude and unwrapped phase of the waveform from its real and imaginary part, 
+    written into the pair of arrays out if given (which may be re and im themselves) """
+    
+    if workspace is None:
+        workspace = Workspace()
+    phase = np.arctan2(im, re, out=workspace.array('polar_phase', np.shape(re)))
+    amp = np.hypot(re, im, out=None if out is None else out[0])
+    if out is None:
+        return amp, _unwrap(phase.copy(), workspace)
+    np.copyto(out[1], _unwrap(phase, workspace))
+    return out
+
+#----------------------------------------------------------------------------------------------------
+def polar_decomposition(decomposition_func):
+    """ The counterpart of a decomposition function (amp_ph_to_comp, re_im_to_comp) that 
+    returns the amplitude and unwrapped phase instead of the complex waveform """
     
-    full_wf = (re+1j*im)
-    return full_wf
+    polar_funcs = {amp_ph_to_comp: amp_ph_to_polar, re_im_to_comp: re_im_to_polar}
+    if decomposition_func not in polar_funcs:
+        raise ValueError("No amplitude/phase output for the decomposition function %s"
+                         % getattr(decomposition_func, '__name__', decomposition_func))
+    return polar_funcs[decomposition_func]
 
 #----------------------------------------------------------------------------------------------------
 def coorbital_to_inertial(h_coorb):
     """ Transform the coorbital frame wf into the inertial frame"""
-    
-    h_inertial = {}
+
+    h_coorb = as_waveform_modes(h_coorb)
+    if not h_coorb.modes:
+        return h_coorb
+    if (2,2) not in h_coorb.index:
+        raise ValueError("The (2,2) mode is needed to transform the higher modes to the inertial frame")
+
     # 22 mode is in inertial frame and HMs are in coorbital phase
-    for mode in h_coorb.keys():
-        (l,m)=mode
-        if mode==(2,2):
-            # compute orbital phase
-            orbital_phase = np.unwrap(np.angle(h_coorb[mode]))/2
-            h_inertial[mode] = h_coorb[mode]
-        else:
-            # transform HMs to inertial frame
-            h_inertial[mode] = h_coorb[mode]*np.exp(1j*m*np.array(orbital_phase))
-            
-    return h_inertial
+    i22 = h_coorb.index[(2,2)]
+    # compute orbital phase
+    orbital_phase = np.unwrap(np.angle(h_coorb.data[i22]))/2
+    # transform HMs to inertial frame, all modes at once
+    # exp(1j*m*orbital_phase) is built in place, one row per mode
+    h_inertial = np.zeros(np.shape(h_coorb.data), dtype=complex)
+    np.multiply(h_coorb.per_mode(h_coorb.m), orbital_phase, out=h_inertial.imag)
+    np.exp(h_inertial, out=h_inertial)
+    h_inertial *= h_coorb.data
+    h_inertial[i22] = h_coorb.data[i22]
+
+    return h_coorb.with_data(h_inertial)
+
+#----------------------------------------------------------------------------------------------------
+def _orbital_phase(h22, workspace):
+    """ 
+    Orbital phase np.unwrap(np.angle(h22))/2 along the last axis, computed in the scratch
+    arrays of workspace (a workspace.Workspace) with the same operations as np.unwrap
+    """
+    phase = np.arctan2(h22.imag, h22.real, out=workspace.array('orbital_phase', np.shape(h22)))
+    phase = _unwrap(phase, workspace)
+    phase /= 2
+    return phase
+
+#----------------------------------------------------------------------------------------------------
+def _orbital_phase_from_phase(phase22, workspace):
+    """ 
+    Orbital phase of a 22 mode given by its continuous phase, without the complex mode: 
+    phase22/2 shifted by the multiple of pi that puts it on the branch of _orbital_phase,
+    which starts from the angle of the first sample in (-pi, pi]
+    """
+    phase_0 = phase22[...,:1]
+    branch = 2*np.pi*np.round((np.angle(np.exp(1j*phase_0)) - phase_0)/(2*np.pi))
+    phase = np.add(phase22, branch, out=workspace.array('orbital_phase', np.shape(phase22)))
+    phase /= 2
+    return phase
+
+#----------------------------------------------------------------------------------------------------
+def _unwrap(phase, workspace):
+    """ 
+    np.unwrap(phase) along the last axis, computed in place in phase with the scratch arrays
+    of workspace (a workspace.Workspace) and the same operations as np.unwrap
+    """
+    shape = np.shape(phase)
+    diff_shape = shape[:-1] + (shape[-1]-1,)
+    dd = np.subtract(phase[...,1:], phase[...,:-1], out=workspace.array('phase_diff', diff_shape))
+    mask = workspace.array('phase_mask', diff_shape, bool)
+    # nothing to correct if no jump reaches pi, e.g. for slowly varying coorbital modes
+    if not np.greater_equal(np.absolute(dd, out=workspace.array('phase_jump', diff_shape)), np.pi,
+                            out=mask).any():
+        return phase
+    correction = workspace.array('phase_correction', diff_shape)
+    positive = workspace.array('phase_positive', diff_shape, bool)
+    # jumps mapped into [-pi, pi), with +pi kept for positive jumps of exactly pi
+    np.add(dd, np.pi, out=correction)
+    np.mod(correction, 2*np.pi, out=correction)
+    np.add(correction, -np.pi, out=correction)
+    np.equal(correction, -np.pi, out=mask)
+    np.greater(dd, 0, out=positive)
+    np.logical_and(mask, positive, out=mask)
+    np.copyto(correction, np.pi, where=mask)
+    # no correction for jumps smaller than pi
+    np.subtract(correction, dd, out=correction)
+    np.less(np.absolute(dd, out=dd), np.pi, out=mask)
+    np.copyto(correction, 0, where=mask)
+    np.cumsum(correction, axis=-1, out=correction)
+    np.add(phase[...,1:], correction, out=phase[...,1:])
+    return phase
 
 #---------------------------------------------------------------------------------------------------- 
 def phase_rotation(h, delta_orb_phase):
     """
     performs an orbital phase rotation
     """
-    h_rotated = {}
-    
-    for mode in h.keys():
-        (l,m) = mode
-        # calculate the corresponding phase rotation in respective modes
-        phase_rot = m*delta_orb_phase
-        # apply phase rotation
-        h_rotated[mode] = h[mode] * np.exp(1j*phase_rot)
-        
-    return h_rotated
+    h = as_waveform_modes(h)
+    # calculate the corresponding phase rotation in respective modes
+    phase_rot = h.per_mode(h.m)*delta_orb_phase
+    # apply phase rotation
+    return h.with_data(h.data * np.exp(1j*phase_rot))
 
 #---------------------------------------------------------------------------------------------------- 
 def evaluate_on_sphere(theta, phi, h_dict):
-    """evaluate on the sphere"""
+    """evaluate on the sphere
+    The weighted m<0 modes of a WaveformModes with negative_m are written after each mode 
+    from the conjugate of the m>0 mode. To sum the modes on the sphere without forming the 
+    m<0 modes, use sum_modes(h_dict, theta, phi).
+    """
 
     if theta is not None:
         if phi is None: raise ValueError('phi must have a value')
-            
-        hdict_sphere = {}
-        for mode in h_dict.keys():
-            (ell,m)=mode
-            # compute spherical harmonics 
-            sYlm_value =  _sYlm(-2,ll=ell,mm=m,theta=theta,phi=phi)
-            # compute modes
-            hdict_sphere[mode] = sYlm_value*h_dict[mode]
+
+        h_dict = as_waveform_modes(h_dict)
+        # compute modes, all at once
+        sYlm_values = _sYlm_values(theta, phi, h_dict.modes)
+        if not h_dict.negative_m:
+            hdict_sphere = h_dict.with_data(h_dict.per_mode(sYlm_values)*h_dict.data)
+        else:
+            neg_sYlm_values = _negative_m_sYlm_values(theta, phi, h_dict)
+            data = np.empty((2*len(h_dict.modes),) + np.shape(h_dict.data)[1:], dtype=complex)
+            np.multiply(h_dict.per_mode(sYlm_values), h_dict.data, out=data[0::2])
+            np.multiply(h_dict.per_mode(neg_sYlm_values), np.conjugate(h_dict.data), out=data[1::2])
+            hdict_sphere = WaveformModes(list(h_dict.keys()), data)
             
     return hdict_sphere
 
 #---------------------------------------------------------------------------------------------------- 
-def sum_modes(h_dict):
-    """sum all the modes on a point in the sky"""
+def _sYlm_values(theta, phi, modes):
+    """ spin -2 spherical harmonics of the modes, one (N, 1) column per mode for a batch """
+    # an array of inclinations with a single orbital phase, or the other way round
+    theta, phi = np.broadcast_arrays(theta, phi)
+    sYlm_values = []
+    for (ell,m) in modes:
+        # compute spherical harmonics 
+        if np.ndim(theta) == 0:
+            sYlm_value =  _harmonics.sYlm(-2,ll=ell,mm=m,theta=theta,phi=phi)
+        # one value per waveform for a batch
+        else:
+            sYlm_value = np.reshape([_harmonics.sYlm(-2,ll=ell,mm=m,theta=th,phi=ph) for th, ph in 
+                                     zip(np.ravel(theta), np.ravel(phi))], np.shape(theta))
+        sYlm_values.append(sYlm_value)
+    return sYlm_values
+
+#---------------------------------------------------------------------------------------------------- 
+def _negative_m_sYlm_values(theta, phi, h_dict):
+    """ (-1)^l sYlm(l,-m), the factor of h(l,m)^* in the m<0 mode h(l,-m) on the sphere, for each mode of h_dict """
+    neg_sYlm_values = _sYlm_values(theta, phi, [(l,-m) for (l,m) in h_dict.modes])
+    return [(-1)**int(l) * sYlm for (l, sYlm) in zip(h_dict.ell, neg_sYlm_values)]
+
+#---------------------------------------------------------------------------------------------------- 
+def sum_modes(h_dict, theta=None, phi=None):
+    """sum all the modes on a point in the sky
+    With theta and phi, the modes are weighted with the spherical harmonics first, as in
+    evaluate_on_sphere. The m<0 modes of a WaveformModes with negative_m are summed through 
+    the orbital plane symmetry, without forming them.
+    """
     
-    h = np.zeros(len(h_dict[(2,2)]))
-    for mode in h_dict.keys():
-        h = h + h_dict[mode]
-    return h
+    h_dict = as_waveform_modes(h_dict)
+    if theta is None and not h_dict.negative_m:
+        # accumulate in place, in the order of the modes
+        h = h_dict.data[0].copy()
+        for h_mode in h_dict.data[1:]:
+            h += h_mode
+        return h
+
+    if theta is None:
+        weights = [1.0]*len(h_dict.modes)
+        conj_weights = [(-1.0)**int(l) for l in h_dict.ell]
+    else:
+        if phi is None: raise ValueError('phi must have a value')
+        weights = _sYlm_values(theta, phi, h_dict.modes)
+        conj_weights = None
+        if h_dict.negative_m:
+            conj_weights = _negative_m_sYlm_values(theta, phi, h_dict)
+    return _weighted_sum(h_dict, weights, conj_weights)
+
+
+#---------------------------------------------------------------------------------------------------- 
+def batch_column(x, n_batch, name):
+    """ 
+    Returns a per-waveform parameter of a batch as a column of shape (n_batch, 1) so that
+    it broadcasts against arrays of shape (n_batch, n_times). Scalars and None are
+    returned unchanged.
+    """
+    if x is None or np.ndim(x) == 0:
+        return x
+    x = np.asarray(x, dtype=float).reshape(-1, 1)
+    if len(x) != n_batch:
+        raise ValueError("%s has %d values but the batch has %d waveforms" % (name, len(x), n_batch))
+    return x
 
 
 #---------------------------------------------------------------------------------------------------- 
@@ -102,36 +290,37 @@ def generate_negative_m_mode(h_dict):
     """ 
     For m>0 positive modes hp_mode,hc_mode use h(l,-m) = (-1)^l h(l,m)^* to compute the m<0 mode.
     See Eq. 78 of Kidder,Physical Review D 77, 044016 (2008), arXiv:0710.0614v1 [gr-qc].
+    Returns a WaveformModes with negative_m=True that shares the data of the m>0 modes.
     """
 
-    h_dict_all_modes = {}
-    
-    for mode in h_dict.keys():
-        (l,m)=mode
-        # obtain postive m mode values
-        h_dict_all_modes[(l,m)] = h_dict[mode]
-        # sanity checks
-        if (m==0):
-            raise ValueError('m must be nonnegative. m<0 will be generated for you from the m>0 mode.')
-        elif (m<0):
-            raise ValueError('m must be nonnegative. m<0 will be generated for you from the m>0 mode.')
-        # calculate negative m mode
-        else:
-            h_dict_all_modes[(l,-m)] = np.power(-1,l) * np.conjugate(h_dict[mode])
+    h_dict = as_waveform_modes(h_dict)
+
+    # sanity checks
+    if np.any(h_dict.m==0):
+        raise ValueError('m must be nonnegative. m<0 will be generated for you from the m>0 mode.')
+    elif np.any(h_dict.m<0):
+        raise ValueError('m must be nonnegative. m<0 will be generated for you from the m>0 mode.')
 
-    return h_dict_all_modes
+    # each positive m mode is followed by its negative m mode, which is computed from the
+    # positive m mode when it is accessed; use materialize() to obtain all of them at once
+    return WaveformModes(h_dict.modes, h_dict.data, negative_m=True)
 
 
 #----------------------------------------------------------------------------------------------------
 def obtain_processed_output(X_calib, time, hsur_raw_dict, alpha_coeffs, beta_coeffs,
                             alpha_beta_functional_form, calibrated, M_tot, dist_mpc,
                             orb_phase, inclination, mode_sum, neg_modes, lmax, CoorbToInert=False,
-                            mass_factor=1.0):
+                            mass_factor=1.0, norm=1.0, in_place=False, out=None, workspace=None):
     """
     Function to process the output of raw surrogate to apply :
     (i) NR calibration;
     (ii) Conversion to SI units from geometric units;
     (iii) mode summation;
+
+    The coorbital to inertial rotation, the normalization, the NR calibration (alpha), the 
+    conversion to SI units, the negative m modes and the spherical harmonics are applied 
+    in a single pass over the modes: every mode is multiplied once by its rotation and one 
+    per-mode scale, and the mode sum is accumulated in the same pass.
     
     Inputs
     ======
@@ -153,49 +342,216 @@ def obtain_processed_output(X_calib, time, hsur_raw_dict, alpha_coeffs, beta_coe
         lmax :--: maximum value of l upto which modes should be returned.
         CoorbToInert :--: indicate whether higher modes have been modelled in coorbital frame. In that
                           case, additional processing will be performed.
+        mass_factor :--: factor applied to time and strain of uncalibrated waveforms
+        norm :--: normalization factor of the surrogate modes that is not applied yet, e.g. 
+                  when fits.all_modes_surrogate was called with norm=1
+        in_place :--: True if hsur_raw_dict is a waveform_modes.WaveformModes that may be 
+                      overwritten, e.g. the output of fits.all_modes_surrogate
+        out :--: (optional) complex array the output is written into: the summed waveform 
+                 if mode_sum, else one row per mode (with the negative m mode after each 
+                 mode if neg_modes and the modes are on the sphere); with in_place, the rows 
+                 of hsur_raw_dict may be rows of out
+        workspace :--: (optional) workspace.Workspace with the scratch arrays
     
     Outputs
     =======
     
         t_surrogate : time array 
-        h_surrogate : dictiornary of modes
+        h_surrogate : dictiornary of modes (a waveform_modes.WaveformModes, computing the 
+                      m<0 modes on access if neg_modes and the modes are not on the sphere)
     
      
     """
     
-    # transform higher modes from coorbital to inertial frame if asked
-    if CoorbToInert==True:
-        hsur_raw_dict = coorbital_to_inertial(hsur_raw_dict)
-        
-    # when nr calibration is applied
+    # amplitude and phase output, see fits.all_modes_surrogate_amp_phase
+    amp_phase = isinstance(hsur_raw_dict, AmpPhaseModes)
+    if amp_phase and mode_sum==True:
+        raise ValueError('The modes cannot be summed in the amplitude/phase representation')
+    if not amp_phase:
+        hsur_raw_dict = as_waveform_modes(hsur_raw_dict)
+    SI_units = M_tot is not None and dist_mpc is not None
+    on_sphere = SI_units and orb_phase is not None and inclination is not None
+
+    # real per-mode scale: normalization, NR calibration or mass scale, and SI units
     if calibrated==True:
-        t_sur, hsur_dict = nrcalib.generate_calibrated_ppBHPT(X_calib, time, hsur_raw_dict, alpha_coeffs, 
-                                                                  beta_coeffs, alpha_beta_functional_form)
+        scales = nrcalib.evaluate_alphas(X_calib, hsur_raw_dict.ell, alpha_coeffs, alpha_beta_functional_form)
+        beta = nrcalib.evaluate_beta(X_calib, beta_coeffs, alpha_beta_functional_form)
+        t_sur = nrcalib.beta_scaling_time(time, beta)
         if lmax>5:
             warnings.warn('Only modes up to ell=5 are NR calibrated', stacklevel=2)
-    # when no nr calibration is applied
     else:
+        scales = [mass_factor]*len(hsur_raw_dict.modes)
         t_sur = np.array(time) * mass_factor
-        hsur_dict = {mode: np.array(h) * mass_factor for mode, h in hsur_raw_dict.items()}
         warnings.warn('Modes are NOT NR calibrated - waveforms only have 0PA contribution', stacklevel=2)
+    strain_geo_to_SI = 1.0
+    if SI_units:
+        time_geo_to_SI, strain_geo_to_SI = _geo_to_SI_factors(M_tot, dist_mpc)
+        t_sur *= time_geo_to_SI
+    scales = [norm*scale*strain_geo_to_SI for scale in scales]
+
+    if neg_modes and np.any(hsur_raw_dict.m<=0):
+        raise ValueError('m must be nonnegative. m<0 will be generated for you from the m>0 mode.')
+    # spherical harmonics of the m>0 modes and, multiplied by (-1)^l, of the m<0 modes
+    if on_sphere:
+        sYlm_values = _sYlm_values(inclination, orb_phase, hsur_raw_dict.modes)
+        if neg_modes:
+            neg_sYlm_values = _negative_m_sYlm_values(inclination, orb_phase, hsur_raw_dict)
+    elif mode_sum==True:
+        return None
+
+    if amp_phase:
+        return t_sur, _process_amp_phase_modes(hsur_raw_dict, scales, sYlm_values if on_sphere else None,
+                                               neg_sYlm_values if on_sphere and neg_modes else None,
+                                               CoorbToInert, neg_modes, in_place, workspace=workspace)
+    return t_sur, _process_modes(hsur_raw_dict, scales, sYlm_values if on_sphere else None,
+                                 neg_sYlm_values if on_sphere and neg_modes else None, CoorbToInert,
+                                 neg_modes, mode_sum==True, in_place, out=out, workspace=workspace)
+
+
+#----------------------------------------------------------------------------------------------------
+def _process_modes(h_dict, scales, sYlm_values, neg_sYlm_values, CoorbToInert, neg_modes, mode_sum,
+                   in_place, out=None, workspace=None):
+    """ 
+    Single pass of obtain_processed_output over the modes of h_dict. Each mode is rotated to 
+    the inertial frame (if CoorbToInert) and multiplied by scales[i] and, on the sphere, its 
+    sYlm value. The m<0 modes (-1)^l h(l,m)^* are:
+        - computed on access (WaveformModes with negative_m) if the modes are not on the sphere;
+        - written after each mode, weighted by scales[i] and neg_sYlm_values[i] (which includes 
+          the (-1)^l), if the modes are on the sphere;
+        - summed through the symmetry, without computing them, if mode_sum.
+    The modes are written into out, or one new block (or into h_dict.data if in_place and 
+    the modes are not interleaved with the m<0 modes), or only summed (into out if given). 
+    The rows of h_dict.data may be rows of out, e.g. its even rows when the m<0 modes are 
+    interleaved.
+    """
+    if workspace is None:
+        workspace = Workspace()
+    shape = np.shape(h_dict.data)[1:]
+    interleaved = neg_modes and neg_sYlm_values is not None and not mode_sum
+    if CoorbToInert and h_dict.modes:
+        if (2,2) not in h_dict.index:
+            raise ValueError("The (2,2) mode is needed to transform the higher modes to the inertial frame")
+        # 22 mode is in inertial frame and HMs are in coorbital phase
+        orbital_phase = _orbital_phase(h_dict.data[h_dict.index[(2,2)]], workspace)
+        h_rotated = workspace.array('rotated_mode', shape, complex)
+
+    # where the output modes go: the (rotated) modes to be summed are kept in one block
+    if mode_sum:
+        if in_place:
+            h_out = h_dict.data
+        else:
+            h_out = workspace.array('modes', np.shape(h_dict.data), complex)
+    elif out is not None:
+        h_out = out
+    elif in_place and not interleaved:
+        h_out = h_dict.data
+    else:
+        h_out = np.empty(((2 if interleaved else 1)*len(h_dict.modes),) + shape, dtype=complex)
+
+    for i, (ell, m) in enumerate(h_dict.modes):
+        h_mode = h_dict.data[i]
+        k = 2*i if interleaved else i
+        h_dest = h_out[k]
+        # transform HMs to inertial frame, into their output row
+        if CoorbToInert and (ell, m) != (2,2):
+            h_rotated.real = 0
+            np.multiply(m, orbital_phase, out=h_rotated.imag)
+            np.exp(h_rotated, out=h_rotated)
+            h_mode = np.multiply(h_mode, h_rotated, out=h_dest)
+
+        if mode_sum:
+            # scales and spherical harmonics are applied in the sum
+            if h_mode is not h_dest and not in_place:
+                h_dest[...] = h_mode
+            continue
+        # negative m mode from the positive m mode using orbital plane symmetry
+        if interleaved:
+            np.conjugate(h_mode, out=h_out[k+1])
+            h_out[k+1] *= scales[i] * neg_sYlm_values[i]
+        scale = scales[i] if sYlm_values is None else scales[i] * sYlm_values[i]
+        np.multiply(h_mode, scale, out=h_dest)
+
+    if mode_sum:
+        if sYlm_values is None:
+            weights = scales
+        else:
+            weights = [scale*sYlm for scale, sYlm in zip(scales, sYlm_values)]
+        conj_weights = None
+        if neg_modes:
+            conj_weights = [scale*sYlm for scale, sYlm in zip(scales, neg_sYlm_values)]
+        return _weighted_sum(WaveformModes(h_dict.modes, h_out), weights, conj_weights, out=out,
+                             workspace=workspace)
+    if interleaved:
+        return WaveformModes([mode for (l,m) in h_dict.modes for mode in [(l,m), (l,-m)]], h_out)
+    return WaveformModes(h_dict.modes, h_out, negative_m=neg_modes)
+
+
+#----------------------------------------------------------------------------------------------------
+def _process_amp_phase_modes(h_dict, scales, sYlm_values, neg_sYlm_values, CoorbToInert, neg_modes,
+                             in_place, workspace=None):
+    """ 
+    _process_modes for modes given as amplitude and phase (a waveform_modes.AmpPhaseModes):
+    the coorbital to inertial rotation adds m times the orbital phase, obtained from the 
+    phase of the 22 mode, to the phase of the HMs, and every (complex) per-mode factor 
+    multiplies the amplitude by its modulus and adds its argument to the phase. The m<0 modes
+    are computed on access, or written after each mode if the modes are on the sphere.
+    """
+    if workspace is None:
+        workspace = Workspace()
+    if not in_place:
+        h_dict = h_dict.copy()
+    amp, phase = h_dict.amp, h_dict.phase
+    if CoorbToInert and h_dict.modes:
+        if (2,2) not in h_dict.index:
+            raise ValueError("The (2,2) mode is needed to transform the higher modes to the inertial frame")
+        # 22 mode is in inertial frame and HMs are in coorbital phase
+        orbital_phase = _orbital_phase_from_phase(phase[h_dict.index[(2,2)]], workspace)
+        rotation = workspace.array('rotation_phase', np.shape(orbital_phase))
+        for i, (ell, m) in enumerate(h_dict.modes):
+            if (ell, m) != (2,2):
+                phase[i] += np.multiply(m, orbital_phase, out=rotation)
+
+    if sYlm_values is None:
+        amp *= h_dict.per_mode(scales)
+        return type(h_dict)(h_dict.modes, h_dict.data, negative_m=neg_modes)
 
-    # get all the negative m modes from postive m modes using symmetry
+    # on the sphere, the negative m modes are weighted by their own sYlm values
     if neg_modes:
-        hsur_dict = generate_negative_m_mode(hsur_dict)
-
-    # relevant for obtaining physical waveforms
-    if M_tot is not None and dist_mpc is not None:
-        t_sur, hsur_dict = geo_to_SI(t_sur, hsur_dict, M_tot, dist_mpc)
-        # evaluate on the sphere
-        if orb_phase is not None and inclination is not None:
-            hsur_dict = evaluate_on_sphere(inclination, orb_phase, hsur_dict)
-
-    # sum up the modes if it is asked
-    if mode_sum==False:
-        return t_sur, hsur_dict
+        h_out = np.empty((2*len(h_dict.modes),) + np.shape(h_dict.data)[1:])
+        neg_weights = h_dict.per_mode([scale*sYlm for scale, sYlm in zip(scales, neg_sYlm_values)])
+        np.multiply(amp, np.abs(neg_weights), out=h_out[1::2, 0])
+        np.subtract(np.angle(neg_weights), phase, out=h_out[1::2, 1])
+        h_out[0::2] = h_dict.data
+        h_dict = type(h_dict)([mode for (l,m) in h_dict.modes for mode in [(l,m), (l,-m)]], h_out)
+        amp, phase = h_dict.data[0::2, 0], h_dict.data[0::2, 1]
+    weights = h_dict.per_mode([scale*sYlm for scale, sYlm in zip(scales, sYlm_values)])
+    amp *= np.abs(weights)
+    phase += np.angle(weights)
+    return h_dict
+
+
+#----------------------------------------------------------------------------------------------------
+def _weighted_sum(h_dict, weights, conj_weights=None, out=None, workspace=None):
+    """ 
+    sum_i weights[i]*h_i + conj_weights[i]*conj(h_i) over the rows h_i of h_dict.data, with 
+    weights of one value (or, for a batch, (N, 1) column) per mode. The sum over the modes is 
+    a matrix-vector product over the block, and sum_i conj_weights[i]*conj(h_i) is the 
+    conjugate of a second one, so the conjugate modes are never formed.
+    """
+    if workspace is None:
+        workspace = Workspace()
+    data = h_dict.data
+    # (n_modes,) or, for a batch, (n_modes, N) weights
+    def stacked(values):
+        return np.broadcast_to(h_dict.per_mode(values), np.shape(data)[:-1] + (1,))[..., 0].astype(complex)
+
+    if np.ndim(data) == 2:
+        contract = lambda w, h_sum: np.dot(w, data, out=h_sum)
     else:
-        if M_tot is not None and dist_mpc is not None and orb_phase is not None and inclination is not None:
-            h_summed = sum_modes(hsur_dict)
-            return t_sur, h_summed
-        
-        
\ No newline at end of file
+        contract = lambda w, h_sum: np.einsum('in,int->nt', w, data, out=h_sum)
+    h = contract(stacked(weights), out)
+    if conj_weights is not None:
+        h_conj = contract(np.conjugate(stacked(conj_weights)),
+                          workspace.array('conjugate_sum', np.shape(h), complex))
+        h += np.conjugate(h_conj, out=h_conj)
+    return h
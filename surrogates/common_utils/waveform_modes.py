@@ -0,0 +1,226 @@
+##==============================================================================
+## BHPTNRSurrogate module
+## Description : waveform modes stored as one contiguous block
+## Author : BHPTNRSurrogate developers, Oct 2026
+##==============================================================================
+
+from collections.abc import ItemsView, KeysView, ValuesView
+
+import numpy as np
+
+#----------------------------------------------------------------------------------------------------
+class WaveformModes(dict):
+    """
+    Waveform modes stored as one contiguous complex array. data has shape (n_modes, n_times),
+    or (n_modes, N, n_times) for a batch of N waveforms, and data[i] is the mode modes[i] = (l, m).
+
+    It is a dictionary mode -> data[i] whose values are views of data, so it can be used
+    wherever a dictionary of modes is expected, while the post-processing (utils,
+    nr_calibration) and downstream consumers (e.g. FFTs, detector projections) work on the
+    whole block at once without copies. Assigning to an existing mode writes into data;
+    modes cannot be added or removed.
+
+    With negative_m=True, the m>0 modes of data represent the m<0 modes as well through the
+    orbital plane symmetry h(l,-m) = (-1)^l h(l,m)^*: each key (l,m) is followed by the key
+    (l,-m), whose value is computed from data when it is accessed, so it always follows data.
+    Assigning to (l,-m) writes the symmetric (l,m) row. modes, ell, m and index always refer
+    to the rows of data; materialize() returns all modes as rows.
+    """
+
+    def __init__(self, modes, data, negative_m=False):
+        modes = [tuple(mode) for mode in modes]
+        if len(modes) != len(data):
+            raise ValueError("Got %d modes for %d rows of data" % (len(modes), len(data)))
+        super().__init__((mode, data[i]) for i, mode in enumerate(modes))
+        self.modes = modes
+        self.data = data
+        self.index = {mode: i for i, mode in enumerate(modes)}
+        # l and m of every row of data
+        self.ell = np.array([mode[0] for mode in modes], dtype=int)
+        self.m = np.array([mode[1] for mode in modes], dtype=int)
+        self.negative_m = negative_m
+        if negative_m:
+            if np.any(self.m <= 0):
+                raise ValueError('m must be positive for the m<0 modes to be generated from the m>0 modes')
+            self._keys = [key for (l, m) in modes for key in [(l, m), (l, -m)]]
+            self._negative_index = {(l, -m): i for i, (l, m) in enumerate(modes)}
+        else:
+            self._keys = modes
+            self._negative_index = {}
+
+    @classmethod
+    def from_dict(cls, h_dict):
+        """ Stacks a dictionary of modes of equal shape into a WaveformModes """
+        modes = list(h_dict.keys())
+        if not modes:
+            return cls([], np.empty((0,), dtype=complex))
+        data = np.empty((len(modes),) + np.shape(h_dict[modes[0]]), dtype=complex)
+        for i, mode in enumerate(modes):
+            data[i] = h_dict[mode]
+        return cls(modes, data)
+
+    def with_data(self, data):
+        """
+        Same modes with new data of the same leading length. The m<0 modes follow the new
+        data, which is correct for operations that respect the orbital plane symmetry (real
+        per-mode factors, rotations by exp(1j*m*phi))
+        """
+        return type(self)(self.modes, data, negative_m=self.negative_m)
+
+    def per_mode(self, values):
+        """
+        Stacks one value per mode (scalars, or e.g. (N, 1) columns for a batch) into an array
+        that broadcasts against data, one row per mode
+        """
+        values = np.array(np.broadcast_arrays(*[np.asarray(v) for v in values]))
+        return values.reshape(values.shape + (1,) * (np.ndim(self.data) - values.ndim))
+
+    def materialize(self):
+        """ Returns a WaveformModes with all modes, including the m<0 modes, as rows of data """
+        if not self.negative_m:
+            return self
+        data = np.empty((2*len(self.modes),) + np.shape(self.data)[1:], dtype=complex)
+        data[0::2] = self.data
+        h_neg = data[1::2]
+        np.conjugate(self.data, out=h_neg)
+        for i in np.flatnonzero(self.ell % 2):
+            np.negative(h_neg[i], out=h_neg[i])
+        return type(self)(self._keys, data)
+
+    def __missing__(self, mode):
+        # m<0 mode, computed on every access
+        i = self._negative_index.get(mode)
+        if i is None:
+            raise KeyError(mode)
+        h_neg = np.conjugate(self.data[i])
+        if self.ell[i] % 2:
+            np.negative(h_neg, out=h_neg)
+        return h_neg
+
+    def __setitem__(self, mode, value):
+        if mode in self._negative_index:
+            i = self._negative_index[mode]
+            self.data[i] = np.conjugate(value) * (-1)**int(self.ell[i])
+            return
+        if mode not in self.index:
+            raise KeyError("WaveformModes has no mode %s; modes cannot be added" % (mode,))
+        self.data[self.index[mode]] = value
+
+    # the m<0 modes are not stored in the dictionary
+    def __iter__(self):
+        return iter(self._keys)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __contains__(self, mode):
+        return mode in self.index or mode in self._negative_index
+
+    def keys(self):
+        return KeysView(self)
+
+    def values(self):
+        return ValuesView(self)
+
+    def items(self):
+        return ItemsView(self)
+
+    def get(self, mode, default=None):
+        return self[mode] if mode in self else default
+
+    def copy(self):
+        return self.with_data(self.data.copy())
+
+    def __reduce__(self):
+        return (type(self), (self.modes, self.data, self.negative_m))
+
+    def __repr__(self):
+        return '%s(%d modes%s, data shape %s)' % (type(self).__name__, len(self),
+                                                 ' (m<0 on access)' if self.negative_m else '',
+                                                 np.shape(self.data))
+
+#----------------------------------------------------------------------------------------------------
+class AmpPhaseModes(WaveformModes):
+    """
+    Waveform modes as amplitude and (unwrapped) phase, h = amp*exp(1j*phase), stored as one
+    contiguous real array. data has shape (n_modes, 2, n_times), or (n_modes, 2, N, n_times)
+    for a batch of N waveforms, so that amp, phase = h[mode]; amp and phase are the
+    (n_modes, [N,] n_times) views data[:, 0] and data[:, 1].
+
+    With negative_m=True, the m<0 modes are computed on access from the orbital plane
+    symmetry as amp and l*pi - phase (mod 2pi, the phase stays continuous).
+    to_complex() returns the modes as a complex WaveformModes.
+    """
+
+    @classmethod
+    def from_dict(cls, h_dict):
+        """ Stacks a dictionary of (amp, phase) pairs of equal shape into an AmpPhaseModes """
+        modes = list(h_dict.keys())
+        if not modes:
+            return cls([], np.empty((0,)))
+        data = np.empty((len(modes), 2) + np.shape(h_dict[modes[0]][0]))
+        for i, mode in enumerate(modes):
+            data[i] = h_dict[mode]
+        return cls(modes, data)
+
+    @property
+    def amp(self):
+        return self.data[:, 0]
+
+    @property
+    def phase(self):
+        return self.data[:, 1]
+
+    def per_mode(self, values):
+        """
+        Stacks one value per mode (scalars, or e.g. (N, 1) columns for a batch) into an array
+        that broadcasts against amp and phase, one row per mode
+        """
+        values = np.array(np.broadcast_arrays(*[np.asarray(v) for v in values]))
+        return values.reshape(values.shape + (1,) * (np.ndim(self.data) - 1 - values.ndim))
+
+    def materialize(self):
+        """ Returns an AmpPhaseModes with all modes, including the m<0 modes, as rows of data """
+        if not self.negative_m:
+            return self
+        data = np.empty((2*len(self.modes),) + np.shape(self.data)[1:])
+        data[0::2] = self.data
+        data[1::2, 0] = self.amp
+        np.subtract(self.per_mode(np.pi*(self.ell % 2)), self.phase, out=data[1::2, 1])
+        return type(self)(self._keys, data)
+
+    def to_complex(self):
+        """ The modes as a WaveformModes of complex modes amp*exp(1j*phase) """
+        data = np.empty(np.shape(self.amp), dtype=complex)
+        data.real = 0
+        data.imag = self.phase
+        np.exp(data, out=data)
+        data *= self.amp
+        return WaveformModes(self.modes, data, negative_m=self.negative_m)
+
+    def __missing__(self, mode):
+        # m<0 mode, computed on every access
+        i = self._negative_index.get(mode)
+        if i is None:
+            raise KeyError(mode)
+        return np.stack([self.data[i, 0], np.pi*(self.ell[i] % 2) - self.data[i, 1]])
+
+    def __setitem__(self, mode, value):
+        if mode in self._negative_index:
+            i = self._negative_index[mode]
+            self.data[i, 0] = value[0]
+            self.data[i, 1] = np.pi*(self.ell[i] % 2) - np.asarray(value[1])
+            return
+        super().__setitem__(mode, value)
+
+#----------------------------------------------------------------------------------------------------
+def as_waveform_modes(h_dict):
+    """ 
+    Returns h_dict as a WaveformModes of complex modes, stacking it if it is a plain 
+    dictionary of modes and converting it if it is an AmpPhaseModes
+    """
+    if isinstance(h_dict, AmpPhaseModes):
+        return h_dict.to_complex()
+    if isinstance(h_dict, WaveformModes):
+        return h_dict
+    return WaveformModes.from_dict(h_dict)
@@ -0,0 +1,60 @@
+##==============================================================================
+## BHPTNRSurrogate module
+## Description : scratch arrays reused between waveform evaluations
+## Author : BHPTNRSurrogate developers, Oct 2026
+##==============================================================================
+
+import threading
+
+import numpy as np
+
+#----------------------------------------------------------------------------------------------------
+class Workspace:
+    """
+    Scratch arrays of the waveform evaluation (datapieces, orbital phase, rotation of the
+    coorbital modes, modes to be summed), kept between calls so that repeated evaluations,
+    e.g. in a sampler loop, do not allocate them again:
+
+        workspace = Workspace()
+        for q in q_values:
+            t, h = generate_surrogate(q, mode_sum=True, ..., out=h, workspace=workspace)
+
+    An array is allocated again only when its shape or dtype changes. A workspace must
+    not be used by several threads at the same time; use one workspace per thread.
+    Work split over threads within one call (see parallel_eval.py) uses the workspaces
+    of for_thread().
+    """
+
+    def __init__(self):
+        self._arrays = {}
+        self._threads = {}
+
+    def array(self, name, shape, dtype=float):
+        """ Returns the scratch array name with the given shape and dtype; its content is undefined """
+        shape = tuple(shape)
+        array = self._arrays.get(name)
+        if array is None or array.shape != shape or array.dtype != dtype:
+            array = self._arrays[name] = np.empty(shape, dtype=dtype)
+        return array
+
+    def for_thread(self):
+        """ The workspace of the calling thread, kept in this workspace for later calls """
+        ident = threading.get_ident()
+        workspace = self._threads.get(ident)
+        if workspace is None:
+            workspace = self._threads.setdefault(ident, Workspace())
+        return workspace
+
+    def clear(self):
+        """ Releases all scratch arrays """
+        self._arrays.clear()
+        self._threads.clear()
+
+    def nbytes(self):
+        """ Size of the scratch arrays, including those of the thread workspaces """
+        return sum(a.nbytes for a in self._arrays.values()) + \
+               sum(workspace.nbytes() for workspace in list(self._threads.values()))
+
+    def __repr__(self):
+        return '%s(%d arrays, %.1f MB)' % (type(self).__name__, len(self._arrays),
+                                          self.nbytes()/1e6)
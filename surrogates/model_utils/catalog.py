@@ -0,0 +1,251 @@
+##==============================================================================
+## BHPTNRSurrogate module
+## Description : writes generated waveforms to chunked HDF5 catalogs
+## Author : BHPTNRSurrogate developers, Oct 2026
+##==============================================================================
+
+import json
+import queue
+import itertools
+import threading
+import collections
+
+import numpy as np
+
+from . import sweep
+from ..common_utils.waveform_modes import WaveformModes, AmpPhaseModes
+from ..common_utils.lazy_imports import LazyModule
+
+# imported on first use, see common_utils/lazy_imports.py
+h5py = LazyModule('h5py')
+
+"""
+A catalog is an HDF5 file holding N waveforms generated with generate_surrogate_batch,
+written batch by batch into resizable, chunked (and optionally compressed) datasets:
+
+    t          : (N, n_times) time of each waveform
+    h          : (N, n_modes, n_times) complex modes, or (N, n_times) if mode_sum=True
+    amp, phase : (N, n_modes, n_times) amplitude and phase of the modes instead of h,
+                 for output='amp_phase'
+    mode_list  : (n_modes, 2) the (l, m) of each row of the modes; with the attribute
+                 negative_m, the m<0 modes are not stored and follow from the symmetry
+                 h(l,-m) = (-1)^l h(l,m)^* (see common_utils/waveform_modes.py)
+    parameters : group with one (N,) dataset per parameter (q, spin1, M_tot, ...)
+
+The attribute n_waveforms of the file counts the waveforms that were written completely;
+it is updated after every batch, once the batch is in the file. A catalog that is opened
+again is cut back to n_waveforms, so a job that was interrupted can continue from there
+(see generate_catalog).
+"""
+
+#----------------------------------------------------------------------------------------------------
+def _mode_blocks(h):
+    """ Returns the datasets of a batch of waveforms as name -> (N, ...) array, and the modes """
+    if isinstance(h, AmpPhaseModes):
+        # (n_modes, 2, N, n_times) -> (N, n_modes, n_times)
+        return {'amp': np.moveaxis(h.amp, 1, 0), 'phase': np.moveaxis(h.phase, 1, 0)}, h
+    if isinstance(h, WaveformModes):
+        return {'h': np.moveaxis(h.data, 1, 0)}, h
+    # mode sum, (N, n_times)
+    return {'h': np.asarray(h)}, None
+
+#----------------------------------------------------------------------------------------------------
+class CatalogWriter:
+    """
+    Appends batches of waveforms to the HDF5 catalog at path (see the layout above),
+    creating it if it does not exist. With background=True the batches are written by a
+    thread while the caller generates the next ones; write() blocks only if max_queued
+    batches are already waiting, so that a slow disk holds back the generation instead of
+    filling the memory. Errors of the writing thread are raised by the next write() or by
+    close().
+
+    Inputs
+    ======
+        path : path of the HDF5 file
+        compression : (optional) HDF5 compression filter of the datasets, e.g. 'gzip' or 'lzf'
+        compression_opts : (optional) options of the filter, e.g. the gzip level
+        chunk_waveforms : number of waveforms per HDF5 chunk; each chunk holds one mode
+                          of chunk_waveforms waveforms
+        background : write in a background thread
+        max_queued : maximum number of batches waiting to be written
+        attrs : (optional) dictionary of attributes of the file, e.g. the model and its
+                options; they must match those of an existing catalog
+    """
+
+    def __init__(self, path, compression=None, compression_opts=None, chunk_waveforms=1,
+                 background=True, max_queued=2, attrs=None):
+        self.path = path
+        self.compression = compression
+        self.compression_opts = compression_opts
+        self.chunk_waveforms = chunk_waveforms
+        self._file = h5py.File(path, 'a')
+        try:
+            self._check_attrs(attrs or {})
+            self.n_written = int(self._file.attrs.get('n_waveforms', 0))
+            # drop the rest of a batch that was being written when the job stopped
+            self._resize(self.n_written)
+        except BaseException:
+            self._file.close()
+            raise
+        self._error = None
+        self._queue = None
+        if background:
+            self._queue = queue.Queue(max_queued)
+            self._thread = threading.Thread(target=self._run, name='BHPTNRSur-catalog', daemon=True)
+            self._thread.start()
+
+    def _check_attrs(self, attrs):
+        for key, value in attrs.items():
+            if key in self._file.attrs and self._file.attrs[key] != value:
+                raise ValueError("The catalog %s was written with %s=%r, not %r"
+                                 % (self.path, key, self._file.attrs[key], value))
+            self._file.attrs[key] = value
+
+    def _resize(self, n_waveforms):
+        for dataset in self._datasets():
+            dataset.resize(n_waveforms, axis=0)
+
+    def _datasets(self):
+        datasets = [self._file[name] for name in ['t', 'h', 'amp', 'phase'] if name in self._file]
+        if 'parameters' in self._file:
+            datasets += list(self._file['parameters'].values())
+        return datasets
+
+    def _dataset(self, group, name, block):
+        """ The dataset name of group for blocks like block, created on first use """
+        if name in group:
+            dataset = group[name]
+            if dataset.shape[1:] != block.shape[1:] or dataset.dtype != block.dtype:
+                raise ValueError("Cannot append %s of shape %s and type %s to the dataset %s of "
+                                 "shape %s and type %s" % (name, block.shape[1:], block.dtype,
+                                                           dataset.name, dataset.shape[1:], dataset.dtype))
+            return dataset
+        if self.n_written:
+            raise ValueError("The catalog %s has no dataset %s for the waveforms it already holds"
+                             % (self.path, name))
+        chunks = (self.chunk_waveforms,) + (1,)*(block.ndim - 2) + block.shape[-1:] \
+                 if block.ndim > 1 else None
+        return group.create_dataset(name, shape=(self.n_written,) + block.shape[1:],
+                                    maxshape=(None,) + block.shape[1:], dtype=block.dtype,
+                                    chunks=chunks, compression=self.compression,
+                                    compression_opts=self.compression_opts)
+
+    def _write(self, params, t, h):
+        blocks, modes = _mode_blocks(h)
+        t = np.asarray(t)
+        n_batch = len(t)
+        if modes is not None:
+            mode_list = np.array(modes.modes, dtype=int).reshape(-1, 2)
+            if 'mode_list' in self._file:
+                if not np.array_equal(self._file['mode_list'][()], mode_list) \
+                        or bool(self._file['mode_list'].attrs['negative_m']) != modes.negative_m:
+                    raise ValueError("The modes differ from those of the catalog %s" % self.path)
+            else:
+                self._file['mode_list'] = mode_list
+                self._file['mode_list'].attrs['negative_m'] = modes.negative_m
+        parameters = self._file.require_group('parameters')
+        if self.n_written and set(parameters) != set(params):
+            raise ValueError("The catalog %s has the parameters %s, got %s"
+                             % (self.path, sorted(parameters), sorted(params)))
+        datasets = [(self._file, 't', t)] + [(self._file, name, block) for name, block in blocks.items()] \
+                 + [(parameters, name, np.broadcast_to(np.asarray(value, dtype=float), (n_batch,)))
+                    for name, value in params.items()]
+        # all checks first, so that a batch that does not fit leaves the catalog unchanged
+        datasets = [(self._dataset(group, name, block), block) for group, name, block in datasets]
+        start, stop = self.n_written, self.n_written + n_batch
+        for dataset, block in datasets:
+            dataset.resize(stop, axis=0)
+            dataset[start:stop] = block
+        self._file.attrs['n_waveforms'] = stop
+        self._file.flush()
+        self.n_written = stop
+
+    def _run(self):
+        while True:
+            batch = self._queue.get()
+            try:
+                if batch is None:
+                    return
+                if self._error is None:
+                    self._write(*batch)
+            except BaseException as e:
+                self._error = e
+            finally:
+                self._queue.task_done()
+
+    def _raise_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def write(self, params, t, h):
+        """
+        Appends a batch of N waveforms: params is a dictionary of parameters, each an array
+        of N values or a scalar shared by the batch, and t, h are the output of
+        generate_surrogate_batch (complex modes, amplitude/phase modes or mode sum).
+        The arrays must not be modified while the batch is being written.
+        """
+        if self._queue is None:
+            self._write(params, t, h)
+            return
+        self._raise_error()
+        self._queue.put((params, t, h))
+
+    def flush(self):
+        """ Waits until all batches are written """
+        if self._queue is not None:
+            self._queue.join()
+            self._raise_error()
+
+    def close(self):
+        """ Writes the remaining batches and closes the file """
+        try:
+            if self._queue is not None and self._thread.is_alive():
+                self._queue.put(None)
+                self._thread.join()
+            self._raise_error()
+        finally:
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+#----------------------------------------------------------------------------------------------------
+def generate_catalog(path, model, params, chunk_size=64, processes=None, max_pending=None,
+                     compression=None, compression_opts=None, background=True, **kwargs):
+    """
+    Generates the waveforms of the parameter rows params (see sweep.stream) and appends
+    them to the HDF5 catalog at path (see CatalogWriter), on a pool of worker processes
+    while the previous batches are being written. If the catalog already holds waveforms,
+    e.g. of an earlier run of the same job that was interrupted, the first n_waveforms
+    parameter rows are skipped and the job continues from there; params must then yield
+    the same rows as before. The model and its options (kwargs) have to be those the
+    catalog was started with. Returns the number of waveforms in the catalog.
+
+    Inputs
+    ======
+        path : path of the HDF5 file
+        model : model module, e.g. BHPTNRSurrogate.BHPTNRSur2dq1e3
+        params : iterable of q, (q, spin1) or dictionaries of per-waveform inputs
+        compression, compression_opts, background : see CatalogWriter
+        others : see sweep.sweep()
+    """
+    attrs = {'model': model.__name__.rsplit('.', 1)[-1],
+             'options': json.dumps(kwargs, sort_keys=True, default=str)}
+    with CatalogWriter(path, compression=compression, compression_opts=compression_opts,
+                       background=background, attrs=attrs) as writer:
+        # the chunks are evaluated in order, so that the catalog always holds a prefix of params
+        submitted = collections.deque()
+
+        def chunks():
+            for chunk in sweep._row_chunks(itertools.islice(params, writer.n_written, None), chunk_size):
+                submitted.append(chunk)
+                yield chunk
+
+        for rows, t, h in sweep.stream_chunks(model, chunks(), processes=processes, ordered=True,
+                                              max_pending=max_pending, **kwargs):
+            writer.write(submitted.popleft(), t, h)
+    return writer.n_written
@@ -4,19 +4,27 @@
 ## Author : Tousif Islam, Nov 2022 [tislam@umassd.edu / tousifislam24@gmail.com]
 ##==============================================================================
 
+import numpy as np
+
 from ..common_utils import utils, fits
 from ..common_utils import check_inputs as checks
+from ..common_utils.waveform_modes import WaveformModes
+from ..common_utils.workspace import Workspace
 
 #----------------------------------------------------------------------------------------------------
 def evaluate_surrogate(X_sur, X_calib, X_bounds, time, modes, modes_available, alpha_coeffs,\
                        beta_coeffs, alpha_beta_functional_form, calibrated, M_tot, dist_mpc,
                        orb_phase, inclination, fit_data_dict_1, fit_data_dict_2, B_dict_1, \
                        B_dict_2, fit_func, decomposition_funcs, norm, mode_sum, neg_modes, \
-                       lmax, CoorbToInert, mass_factor=1.0):
+                       lmax, CoorbToInert, mass_factor=1.0, packed_fits=None, out=None, workspace=None,
+                       output='complex', workers=None):
     """
     Inputs
     ======
         X_sur : array of surrogate parameterization e.g. [log(q), spin1, spin2]
+                A batch of N waveforms is evaluated when X_sur has shape (N, n_params) and
+                X_calib, norm, mass_factor and the extrinsic parameters are scalars or 
+                columns of shape (N, 1); see generate_surrogate_batch of the models
         
         X_calib : array of nr calibration parameterization e.g. [1/q, spin]
 
@@ -74,14 +82,40 @@ def evaluate_surrogate(X_sur, X_calib, X_bounds, time, modes, modes_available, a
 
         CoorbToInert : indicate whether higher modes have been modelled in coorbital frame. In that
                        case, additional processing will be performed.
+
+        mass_factor : factor applied to time and strain of uncalibrated waveforms to change 
+                      the mass scale; see the mass_scale option of the models
+
+        packed_fits : (optional) packed fit data of all modes; see fits.all_modes_surrogate
+
+        out : (optional) preallocated output that the waveform is written into: a complex
+              array of shape (n_times,) (or (N, n_times) for a batch) if mode_sum, else a 
+              waveform_modes.WaveformModes returned by a previous call with the same modes, 
+              or a complex array with one row per m>0 mode (per returned mode if the modes 
+              are on the sphere). The evaluation from the EIM reconstruction to the mode sum then writes into out and the scratch 
+              arrays of workspace, without allocating arrays of the waveform length.
+
+        workspace : (optional) workspace.Workspace with the scratch arrays, reused between calls
+
+        output : 'complex' (default) for complex modes, or 'amp_phase' for the amplitude and 
+                 unwrapped phase of each mode (a waveform_modes.AmpPhaseModes), obtained from 
+                 the datapieces without forming the complex modes. Not available with 
+                 mode_sum or out.
+
+        workers : (optional) number of threads evaluating the modes; see 
+                  fits.all_modes_surrogate and common_utils/parallel_eval.py
     
     Outputs
     =======
     
         t_surrogate : time array
         
-        h_surrogate : dictiornary of modes if mode_sum not requested
+        h_surrogate : dictiornary of modes if mode_sum not requested (with neg_modes, a 
+                      waveform_modes.WaveformModes computing the m<0 modes on access unless 
+                      the modes are on the sphere; a waveform_modes.AmpPhaseModes if 
+                      output='amp_phase')
                       full waveform if mode_sum is requested
+                      (out, if given)
     
      
     """
@@ -90,14 +124,80 @@ def evaluate_surrogate(X_sur, X_calib, X_bounds, time, modes, modes_available, a
     checks.check_user_inputs(X_sur, X_bounds, modes, modes_available, M_tot, dist_mpc, 
                       orb_phase, inclination, mode_sum)
     
-    # uncalibrated waveforms in geometric units
+    if output not in ('complex', 'amp_phase'):
+        raise ValueError("output must be 'complex' or 'amp_phase', got %r" % (output,))
+    if workspace is None:
+        workspace = Workspace()
+
+    if output == 'amp_phase':
+        if mode_sum:
+            raise ValueError("mode_sum is not available with output='amp_phase'")
+        if out is not None:
+            raise ValueError("out is not available with output='amp_phase'")
+        # uncalibrated amplitudes and phases in geometric units, without the normalization
+        hsur_raw_dict = fits.all_modes_surrogate_amp_phase(modes, X_sur, fit_data_dict_1, fit_data_dict_2,
+                               B_dict_1, B_dict_2, lmax, fit_func, decomposition_funcs, 1.0,
+                               packed_fits=packed_fits, workspace=workspace, workers=workers)
+        return utils.obtain_processed_output(X_calib, time, hsur_raw_dict, alpha_coeffs,
+                                    beta_coeffs, alpha_beta_functional_form, calibrated, M_tot, dist_mpc,
+                                    orb_phase, inclination, mode_sum, neg_modes, lmax, CoorbToInert,
+                                    mass_factor=mass_factor, norm=norm, in_place=True,
+                                    workspace=workspace)
+
+    # output block and the rows of it (or of the workspace) the raw modes are written into
+    # the m<0 modes are only written out when weighted by the spherical harmonics; otherwise
+    # they are computed on access or summed through the orbital plane symmetry
+    interleaved = neg_modes and not mode_sum and \
+        all(x is not None for x in (M_tot, dist_mpc, orb_phase, inclination))
+    h_block, raw_block = _output_blocks(out, fits.evaluated_modes(modes, lmax), len(time),
+                                        len(X_sur) if np.ndim(X_sur) == 2 else None, interleaved, mode_sum,
+                                        workspace)
+
+    # uncalibrated waveforms in geometric units, without the normalization
     hsur_raw_dict = fits.all_modes_surrogate(modes, X_sur, fit_data_dict_1, fit_data_dict_2, \
-                           B_dict_1, B_dict_2, lmax, fit_func, decomposition_funcs, norm)
+                           B_dict_1, B_dict_2, lmax, fit_func, decomposition_funcs, 1.0,
+                           packed_fits=packed_fits, out=raw_block, workspace=workspace,
+                           workers=workers)
     
-    # process the raw surrogate output depending on the user inputs
+    # process the raw surrogate output depending on the user inputs; the normalization is
+    # part of the single per-mode scale and the raw modes are overwritten
     t_surrogate, h_surrogate = utils.obtain_processed_output(X_calib, time, hsur_raw_dict, alpha_coeffs,
                                     beta_coeffs, alpha_beta_functional_form, calibrated, M_tot, dist_mpc,
                                     orb_phase, inclination, mode_sum, neg_modes, lmax, CoorbToInert,
-                                    mass_factor=mass_factor)
+                                    mass_factor=mass_factor, norm=norm, in_place=True,
+                                    out=h_block, workspace=workspace)
+
+    # return the container that was passed in
+    if isinstance(out, WaveformModes) and isinstance(h_surrogate, WaveformModes) \
+            and out.modes == h_surrogate.modes:
+        h_surrogate = out
     
     return t_surrogate, h_surrogate
+
+
+#----------------------------------------------------------------------------------------------------
+def _output_blocks(out, eval_modes, n_times, n_batch, interleaved, mode_sum, workspace):
+    """
+    Returns the block the output of evaluate_surrogate is written into (out, or a new block
+    unless mode_sum) and the block of the raw modes: the rows (or even rows, if the m<0 modes
+    are interleaved) of the output block, or a workspace array if mode_sum. 
+    """
+    if not eval_modes:
+        return None, None
+    mode_shape = (n_batch, n_times) if n_batch else (n_times,)
+    if isinstance(out, WaveformModes):
+        out = out.data
+    if mode_sum:
+        shape = mode_shape
+    else:
+        shape = (len(eval_modes)*(2 if interleaved else 1),) + mode_shape
+    if out is not None and (np.shape(out) != shape or np.result_type(out) != complex):
+        raise ValueError("out must be a complex array of shape %s, got %s of shape %s"
+                         % (shape, np.result_type(out), np.shape(out)))
+    if mode_sum and out is not None and not out.flags.c_contiguous:
+        raise ValueError("out must be C-contiguous to hold the mode sum")
+
+    if mode_sum:
+        return out, workspace.array('modes', (len(eval_modes),) + mode_shape, complex)
+    h_block = np.empty(shape, dtype=complex) if out is None else out
+    return h_block, (h_block[0::2] if interleaved else h_block)
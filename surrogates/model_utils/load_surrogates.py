@@ -6,12 +6,20 @@
 ##==============================================================================
 
 import numpy as np
-import h5py
 import os
+import gc
 import hashlib
+import warnings
+import threading
+from concurrent.futures import Future
 from ..common_utils import load_splines as load_spl
 from ..common_utils import load_GPRs as load_gpr
 from ..common_utils import filehash
+from ..common_utils import surrogate_cache
+from ..common_utils.lazy_imports import LazyModule
+
+# imported on first use, see common_utils/lazy_imports.py
+h5py = LazyModule('h5py')
 
 """
 A collection of functions that loads the surrogate fit data from their respective h5 file
@@ -41,19 +49,27 @@ have been constrcuted using splines or GPR).
         beta_coeffs : beta value obtain from calibration - used in time rescaling
 """
 
-#----------------------------------------------------------------------------------------------------
-def load_BHPTNRSur1dq1e4_surrogate(h5_data_dir):
+# h5 file name, current zenodo hash and zenodo url of each model
+h5_file_info = {
+    'BHPTNRSur1dq1e4': ('BHPTNRSur1dq1e4.h5', "58a3a75e8fd18786ecc88cf98f694d4a",
+                        'https://zenodo.org/records/13340319'),
+    'BHPTNRSur2dq1e3': ('BHPTNRSur2dq1e3.h5', "404db59dbfc49e88ebd7d5e258f25f3c",
+                        'https://zenodo.org/records/13340319'),
+}
+
+# BHPTNRSur2dq1e3: modes to read fit data for, and modes used in nr calibration
+BHPTNRSur2dq1e3_wf_modes = [(2,2),(2,1),(3,1),(3,2),(3,3),(4,2),(4,3),(4,4)]
+BHPTNRSur2dq1e3_nrcalib_modes = [(2,2),(3,3),(4,4)]
 
+#----------------------------------------------------------------------------------------------------
+def check_h5_file(model_name, h5_data_dir):
     """
-    Assumes the file BHPTNRSur1dq1e4.h5 is located in the h5_data_dir directory.
+    Downloads the h5 file of a model if it doesn't exist in h5_data_dir and checks that its
+    hash is the most recent one. Returns the md5 hash of the file.
+    The file is only rehashed if it changed since it was last verified, or if
+    BHPTNRSUR_STRICT_HASH=1 is set (see filehash.md5).
     """
-
-    # h5 file name
-    fname = 'BHPTNRSur1dq1e4.h5'
-    # provide current zenodo hash
-    zenodo_current_hash = "58a3a75e8fd18786ecc88cf98f694d4a"
-    # zenodo url
-    url = 'https://zenodo.org/records/13340319'
+    fname, zenodo_current_hash, url = h5_file_info[model_name]
     # obtain zenodo ID
     zenodo_ID = url.rsplit("/")[-1]
     # obtain the hash for the current file; also downloads the file
@@ -61,6 +77,115 @@ def load_BHPTNRSur1dq1e4_surrogate(h5_data_dir):
     file_hash = filehash.md5(fname, h5_data_dir, zenodo_ID)
     # check hash is the most recent
     filehash.check_current_hash(file_hash, zenodo_current_hash, url, fname)
+    # later loads skip rehashing while the file is unchanged
+    filehash.record_verified_hash(fname, h5_data_dir, file_hash)
+    return file_hash
+
+#----------------------------------------------------------------------------------------------------
+def resolve_mmap(mmap=None):
+    """ mmap if it is given, else True if the BHPTNRSUR_MMAP environment variable is set (not 0) """
+    if mmap is None:
+        mmap = os.environ.get('BHPTNRSUR_MMAP', '0') not in ('', '0')
+    return mmap
+
+#----------------------------------------------------------------------------------------------------
+def load_surrogate_data(model_name, h5_data_dir, parse_h5, mmap=None, part=None, file_hash=None):
+    """
+    Returns the parsed surrogate data of a model as a dictionary. The data is read from the
+    compiled cache (see compile_surrogate_data) when one exists for the current h5 file,
+    otherwise it is parsed from the h5 file.
+
+    Inputs
+    ======
+        model_name : name of the surrogate model, e.g. 'BHPTNRSur1dq1e4'
+        h5_data_dir : directory hosting h5 files
+        parse_h5 : function of h5_data_dir that parses the (already checked) h5 file and
+                   returns the surrogate data as a dictionary
+        mmap : if True, the arrays are read-only views of the memory-mapped cache, which is
+               compiled first if needed. Defaults to the BHPTNRSUR_MMAP environment variable.
+        part : (optional) name of a part of the model that is loaded and cached on its own,
+               e.g. a sub-surrogate; parse_h5 then parses only that part
+        file_hash : (optional) hash of the h5 file if it has already been checked
+    """
+    mmap = resolve_mmap(mmap)
+    if file_hash is None:
+        file_hash = check_h5_file(model_name, h5_data_dir)
+    cache_name = model_name if part is None else '%s-%s' % (model_name, part)
+    path = surrogate_cache.cache_path(h5_data_dir, cache_name, file_hash)
+    data = surrogate_cache.read_cache(path, cache_name, file_hash, mmap=mmap)
+    if data is None:
+        data = parse_h5(h5_data_dir)
+        if mmap:
+            try:
+                surrogate_cache.write_cache(path, data, cache_name, file_hash)
+            except OSError as e:
+                warnings.warn("Could not write the compiled cache %s (%s); the surrogate data "
+                              "is not memory-mapped" % (path, e), stacklevel=2)
+            else:
+                data = surrogate_cache.read_cache(path, cache_name, file_hash, mmap=True)
+    return data
+
+#----------------------------------------------------------------------------------------------------
+def compile_surrogate_data(model_name, h5_data_dir, parse_h5, part=None):
+    """
+    Parses the h5 file of a model (or one part of it) once and writes the result to the
+    compiled cache so that later loads skip the h5 parsing. Takes the same inputs as
+    load_surrogate_data. Returns the path of the cache file.
+    """
+    file_hash = check_h5_file(model_name, h5_data_dir)
+    cache_name = model_name if part is None else '%s-%s' % (model_name, part)
+    path = surrogate_cache.cache_path(h5_data_dir, cache_name, file_hash)
+    surrogate_cache.write_cache(path, parse_h5(h5_data_dir), cache_name, file_hash)
+    return path
+
+#----------------------------------------------------------------------------------------------------
+def run_in_background(func, name, **kwargs):
+    """
+    Calls func(**kwargs) in a daemon thread and returns a concurrent.futures.Future
+    holding its result (or the exception it raised).
+    """
+    future = Future()
+
+    def run():
+        if not future.set_running_or_notify_cancel():
+            return
+        try:
+            future.set_result(func(**kwargs))
+        except BaseException as e:
+            future.set_exception(e)
+
+    threading.Thread(target=run, name=name, daemon=True).start()
+    return future
+
+#----------------------------------------------------------------------------------------------------
+def freeze_surrogate_data(surrogate_data, load_lock, gc_freeze=True):
+    """
+    Replaces the loaded surrogate data of a model, in place, by a copy whose arrays are
+    read-only views of one contiguous buffer (see surrogate_cache.pack_contiguous), so
+    that processes forked afterwards share its pages instead of copying them on write.
+    With gc_freeze=True all objects that exist now are moved out of reach of the garbage
+    collector (gc.freeze), which would otherwise write to them in every child.
+    """
+    with load_lock:
+        surrogate_data.update(surrogate_cache.pack_contiguous(surrogate_data))
+    if gc_freeze:
+        gc.collect()
+        gc.freeze()
+
+#----------------------------------------------------------------------------------------------------
+def load_BHPTNRSur1dq1e4_surrogate(h5_data_dir, check_hash=True, lazy=False, workers=None):
+
+    """
+    Assumes the file BHPTNRSur1dq1e4.h5 is located in the h5_data_dir directory.
+    The file hash is not checked again if check_hash=False.
+    With lazy=True the data of each mode is read from the h5 file on first access.
+    With workers > 1 the modes are read concurrently (see common_utils/parallel_io.py).
+    """
+
+    # h5 file name
+    fname = h5_file_info['BHPTNRSur1dq1e4'][0]
+    if check_hash:
+        check_h5_file('BHPTNRSur1dq1e4', h5_data_dir)
 
     # modes to read fit data for
     wf_modes = [(2,2),(2,1),(3,1),(3,2),(3,3), (4,2),(4,3),(4,4),
@@ -71,44 +196,65 @@ def load_BHPTNRSur1dq1e4_surrogate(h5_data_dir):
     nrcalib_modes = [(2,2),(3,3),(4,4),(5,5)]
 
     # obtain all fit data
+    load_func = load_spl.open_surrogate if lazy else load_spl.load_surrogate
     time, fit_data_dict_1, fit_data_dict_2, B_dict_1, B_dict_2, alpha_coeffs, beta_coeffs \
-                    = load_spl.load_surrogate(h5_data_dir, fname, wf_modes, nrcalib_modes)
+                    = load_func(h5_data_dir, fname, wf_modes, nrcalib_modes, workers=workers)
 
     return time, fit_data_dict_1, fit_data_dict_2, B_dict_1, B_dict_2, alpha_coeffs, beta_coeffs
 
 
 #----------------------------------------------------------------------------------------------------
-def load_BHPTNRSur2dq1e3_surrogate(h5_data_dir):
+def load_BHPTNRSur2dq1e3_surrogate(h5_data_dir, check_hash=True, lazy=False, workers=None):
 
     """
     Assumes the file BHPTNRSur2dq1e3.h5 is located in the h5_data_dir directory.
+    The file hash is not checked again if check_hash=False.
+    With lazy=True the data of each mode is read from the h5 file on first access.
+    With workers > 1 the modes are read concurrently (see common_utils/parallel_io.py).
 
     NOTE: times is dictionary with times.keys() = ['negative_spin', 'positive_spin']
     """
 
     # h5 file name
-    fname = 'BHPTNRSur2dq1e3.h5'
-    # provide current zenodo hash
-    zenodo_current_hash = "404db59dbfc49e88ebd7d5e258f25f3c"
-    # zenodo url
-    url = 'https://zenodo.org/records/13340319'
-    # obtain zenodo ID
-    zenodo_ID = url.rsplit("/")[-1]
-    # obtain the hash for the current file; also downloads the file
-    # if it doesn't exist in h5_data_dir
-    file_hash = filehash.md5(fname, h5_data_dir, zenodo_ID)
-    # check hash is the most recent
-    filehash.check_current_hash(file_hash, zenodo_current_hash, url, fname)
-    
-
-    # modes to read fit data for
-    wf_modes = [(2,2),(2,1),(3,1),(3,2),(3,3),(4,2),(4,3),(4,4)]
-
-    # modes used in nr calibration
-    nrcalib_modes = [(2,2),(3,3),(4,4)]
+    fname = h5_file_info['BHPTNRSur2dq1e3'][0]
+    if check_hash:
+        check_h5_file('BHPTNRSur2dq1e3', h5_data_dir)
 
     # obtain all fit data
+    load_func = load_gpr.open_surrogate if lazy else load_gpr.load_surrogate
     times, fit_data_dict_1, fit_data_dict_2, B_dict_1, B_dict_2, alpha_coeffs, beta_coeffs \
-                    = load_gpr.load_surrogate(h5_data_dir, fname, wf_modes, nrcalib_modes)
+                    = load_func(h5_data_dir, fname, BHPTNRSur2dq1e3_wf_modes, BHPTNRSur2dq1e3_nrcalib_modes,
+                                workers=workers)
 
     return times, fit_data_dict_1, fit_data_dict_2, B_dict_1, B_dict_2, alpha_coeffs, beta_coeffs
+
+
+#----------------------------------------------------------------------------------------------------
+def load_BHPTNRSur2dq1e3_sub_surrogate(h5_data_dir, spin_sign, workers=None):
+
+    """
+    Opens one sub-surrogate of BHPTNRSur2dq1e3, spin_sign = 'negative_spin' or 'positive_spin'.
+    The data of each mode is read from the h5 file on first access, or right away and
+    concurrently with workers > 1. The file hash is not checked here, see check_h5_file.
+
+    Returns times, fit_data_dict_1, fit_data_dict_2, B_dict_1, B_dict_2 of the sub-surrogate
+    """
+
+    fname = h5_file_info['BHPTNRSur2dq1e3'][0]
+    return load_gpr.open_sub_surrogate(h5_data_dir, fname, spin_sign, BHPTNRSur2dq1e3_wf_modes,
+                                       workers=workers)
+
+
+#----------------------------------------------------------------------------------------------------
+def load_BHPTNRSur2dq1e3_nrcalib_info(h5_data_dir):
+
+    """
+    Reads the nr calibration info of BHPTNRSur2dq1e3, shared by both sub-surrogates.
+    The file hash is not checked here, see check_h5_file.
+
+    Returns alpha_coeffs, beta_coeffs
+    """
+
+    fname = h5_file_info['BHPTNRSur2dq1e3'][0]
+    with h5py.File('%s/%s'%(h5_data_dir,fname), 'r') as f:
+        return load_spl.read_nrcalib_info(f, BHPTNRSur2dq1e3_nrcalib_modes)
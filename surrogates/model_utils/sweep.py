@@ -0,0 +1,316 @@
+##==============================================================================
+## BHPTNRSurrogate module
+## Description : parameter sweeps over a process pool sharing the surrogate data
+## Author : BHPTNRSurrogate developers, Oct 2026
+##==============================================================================
+
+import os
+import queue
+import warnings
+import itertools
+import importlib
+import collections
+import multiprocessing
+from collections.abc import Mapping
+
+import numpy as np
+
+from . import load_surrogates
+from ..common_utils import lazy_modes, surrogate_cache
+
+"""
+sweep(), stream() and stream_chunks() evaluate a model over a large set of parameters with
+a pool of worker processes. The parameters are split into chunks of chunk_size waveforms,
+each evaluated with one call to generate_surrogate_batch in a worker, and the results are
+yielded chunk by chunk as (rows, t, h), where rows is the slice of the parameters the
+chunk covers.
+
+The parameters are read lazily and at most max_pending chunks are submitted to the
+workers and not yet consumed at any time. A slow consumer (e.g. a disk writer) therefore
+holds back the evaluation instead of letting results pile up: the memory used by the
+results stays below max_pending chunks plus the one the consumer is working on, however
+many waveforms are generated.
+
+The surrogate data is not copied into every worker: the parent loads the model with
+mmap=True, which compiles the cache files (see common_utils/surrogate_cache.py) if needed,
+and every worker maps the same files. The basis matrices and fit data of all processes are
+then read-only views of one copy in the page cache, whether the workers are forked (they
+inherit the mapping) or spawned (they map the files when they start). Only the packed fits
+of the evaluated modes, which are built from the fit data on first use, are per process.
+If the model was already loaded without mmap, its data cannot be mapped any more: forked
+workers inherit it, and for spawned workers the compiled cache is written first so that
+they map it instead of each parsing the h5 file (see _preload).
+"""
+
+# model and shared options of a worker process, set by _init_worker
+_worker_state = {}
+
+# inputs of generate_surrogate_batch that may have one value per waveform
+_PER_WAVEFORM_KWARGS = ('M_tot', 'dist_mpc', 'orb_phase', 'inclination')
+
+#----------------------------------------------------------------------------------------------------
+def _init_worker(model_name, mmap, kwargs):
+    """ Loads the model in a worker process (a no-op for forked workers) """
+    model = importlib.import_module(model_name)
+    model.preload(mmap=mmap)
+    _worker_state.update(model=model, kwargs=kwargs)
+
+#----------------------------------------------------------------------------------------------------
+def _arrays(data):
+    """ Yields the arrays of loaded surrogate data, without reading modes that are not loaded """
+    if isinstance(data, np.ndarray):
+        yield data
+    elif isinstance(data, lazy_modes.LazyModeDict):
+        for mode in data.loaded_modes():
+            yield from _arrays(data[mode])
+    elif isinstance(data, Mapping):
+        for value in data.values():
+            yield from _arrays(value)
+    elif isinstance(data, (list, tuple)):
+        for value in data:
+            yield from _arrays(value)
+
+#----------------------------------------------------------------------------------------------------
+def _preload(model, processes, mmap, mp_context):
+    """
+    Loads the model in this process before the workers start, and returns the
+    multiprocessing context of the pool. model.preload() keeps data that was already
+    loaded without mmap; the workers then share no mapping. Forked workers inherit the
+    loaded data, but spawned workers would each parse the h5 file and race to write the
+    compiled cache, so the cache is compiled here for them to map.
+    """
+    # the compiled cache is written here once, so that the workers only map it
+    model.preload(mmap=mmap)
+    if mp_context is None or isinstance(mp_context, str):
+        mp_context = multiprocessing.get_context(mp_context)
+    if processes > 1 and load_surrogates.resolve_mmap(mmap) and \
+            not any(surrogate_cache._is_mapped(array) for array in _arrays(model._surrogate_data)):
+        forked = mp_context.get_start_method() == 'fork'
+        warnings.warn("%s was loaded without mmap, so the worker processes do not share a "
+                      "memory-mapped copy of the surrogate data%s" % (model.__name__,
+                      '' if forked else '; compiling the cache for them to map'), stacklevel=3)
+        if not forked:
+            model.compile_surrogate()
+    return mp_context
+
+#----------------------------------------------------------------------------------------------------
+def _evaluate_chunk(chunk):
+    """ Evaluates one chunk (rows, q, spin1, per-waveform inputs) in a worker process """
+    rows, q, spin1, chunk_kwargs = chunk
+    model = _worker_state['model']
+    if spin1 is not None:
+        chunk_kwargs = dict(chunk_kwargs, spin1=spin1)
+    t, h = model.generate_surrogate_batch(q, **chunk_kwargs, **_worker_state['kwargs'])
+    return rows, t, h
+
+#----------------------------------------------------------------------------------------------------
+def _chunks(q, spin1, per_waveform, chunk_size):
+    """ Splits the parameters into chunks of chunk_size waveforms """
+    for start in range(0, len(q), chunk_size):
+        rows = slice(start, min(start + chunk_size, len(q)))
+        yield (rows, q[rows], None if spin1 is None else spin1[rows],
+               {key: value[rows] for key, value in per_waveform.items()})
+
+#----------------------------------------------------------------------------------------------------
+def _check_chunk(chunk, start):
+    """ Returns the chunk (rows, q, spin1, per-waveform inputs) of a dictionary of arrays """
+    unknown = set(chunk) - {'q', 'spin1'} - set(_PER_WAVEFORM_KWARGS)
+    if unknown:
+        raise ValueError("Unknown per-waveform parameters %s; use one of q, spin1, %s"
+                         % (', '.join(sorted(unknown)), ', '.join(_PER_WAVEFORM_KWARGS)))
+    q = np.atleast_1d(np.asarray(chunk['q'], dtype=float))
+    if q.ndim != 1:
+        raise ValueError("q must be a 1d array of mass ratios")
+    values = {}
+    for key, value in chunk.items():
+        value = np.asarray(value, dtype=float)
+        if key != 'q' and value.ndim > 0:
+            if value.shape != q.shape:
+                raise ValueError("%s must be a scalar or an array of %d values" % (key, len(q)))
+        values[key] = value
+    spin1 = values.pop('spin1', None)
+    if spin1 is not None:
+        spin1 = np.broadcast_to(spin1, q.shape)
+    del values['q']
+    return slice(start, start + len(q)), q, spin1, values
+
+#----------------------------------------------------------------------------------------------------
+def _row_chunks(params, chunk_size):
+    """ Groups an iterable of parameter rows into dictionaries of arrays of chunk_size rows """
+    params = iter(params)
+    while True:
+        rows = list(itertools.islice(params, chunk_size))
+        if not rows:
+            return
+        if all(isinstance(row, Mapping) for row in rows):
+            keys = list(rows[0])
+            if any(list(row) != keys for row in rows):
+                raise ValueError("All parameter rows must have the same keys")
+            yield {key: [row[key] for row in rows] for key in keys}
+        elif not any(isinstance(row, Mapping) for row in rows):
+            # q, or (q, spin1)
+            sizes = {np.size(row) for row in rows}
+            if len(sizes) != 1 or not sizes <= {1, 2} or any(np.ndim(row) > 1 for row in rows):
+                raise ValueError("Parameter rows must be q, (q, spin1) or dictionaries")
+            columns = np.array(rows, dtype=float).reshape(len(rows), -1).T
+            yield dict(zip(['q', 'spin1'], columns))
+        else:
+            raise ValueError("Parameter rows must be q, (q, spin1) or dictionaries")
+
+#----------------------------------------------------------------------------------------------------
+def _check_options(processes, max_pending, chunk_size=1):
+    """ Validates chunk_size and returns the number of processes and max_pending """
+    if chunk_size < 1:
+        raise ValueError("chunk_size must be at least 1, got %d" % chunk_size)
+    processes = (os.cpu_count() or 1) if processes is None else int(processes)
+    if processes < 1:
+        raise ValueError("The number of processes must be at least 1, got %d" % processes)
+    max_pending = 2*processes if max_pending is None else int(max_pending)
+    if max_pending < 1:
+        raise ValueError("max_pending must be at least 1, got %d" % max_pending)
+    return processes, max_pending
+
+#----------------------------------------------------------------------------------------------------
+def sweep(model, q, spin1=None, chunk_size=64, processes=None, ordered=True, max_pending=None,
+          mmap=True, mp_context=None, **kwargs):
+    """
+    Evaluates model.generate_surrogate_batch over the parameters (q, spin1) in chunks of
+    chunk_size waveforms on a pool of worker processes, and yields (rows, t, h) for every
+    chunk, where rows is the slice of the parameters the chunk covers and t, h are the
+    output of generate_surrogate_batch for those parameters.
+
+    Inputs
+    ======
+        model : model module, e.g. BHPTNRSurrogate.BHPTNRSur2dq1e3
+        q : array of N mass ratios
+        spin1 : (optional) array of N spins, or a scalar shared by all waveforms;
+                omitted for models without spin
+        chunk_size : number of waveforms evaluated together by a worker
+        processes : number of worker processes, default: os.cpu_count().
+                    With processes=1 the chunks are evaluated in this process.
+        ordered : if True, the chunks are yielded in the order of the parameters;
+                  otherwise as soon as each one completes
+        max_pending : maximum number of chunks submitted to the workers and not yet
+                      yielded, default: 2*processes
+        mmap : load the surrogate data as views of the memory-mapped compiled cache,
+               shared by all worker processes (default)
+        mp_context : (optional) multiprocessing context or start method of the pool,
+                     e.g. 'spawn'; default: the default context
+        kwargs : other inputs of generate_surrogate_batch. M_tot, dist_mpc, orb_phase and
+                 inclination can be scalars or arrays with one value per waveform.
+    """
+    q = np.atleast_1d(np.asarray(q, dtype=float))
+    if q.ndim != 1:
+        raise ValueError("q must be a scalar or a 1d array of mass ratios")
+    if spin1 is not None:
+        spin1 = np.broadcast_to(np.asarray(spin1, dtype=float), q.shape)
+    processes, max_pending = _check_options(processes, max_pending, chunk_size)
+
+    # per-waveform inputs are split with the chunks, the others are sent to each worker once
+    per_waveform = {}
+    for key in _PER_WAVEFORM_KWARGS:
+        if np.ndim(kwargs.get(key)) > 0:
+            value = np.asarray(kwargs.pop(key))
+            if value.shape != q.shape:
+                raise ValueError("%s must be a scalar or an array of %d values" % (key, len(q)))
+            per_waveform[key] = value
+
+    mp_context = _preload(model, processes, mmap, mp_context)
+    return _run(model, _chunks(q, spin1, per_waveform, chunk_size), processes, ordered,
+                max_pending, mmap, mp_context, kwargs)
+
+#----------------------------------------------------------------------------------------------------
+def stream(model, params, chunk_size=64, processes=None, ordered=True, max_pending=None,
+           mmap=True, mp_context=None, **kwargs):
+    """
+    Like sweep(), for parameters given as an iterable of rows instead of arrays, e.g. a
+    generator over millions of waveforms. The rows are read chunk_size at a time, only
+    when a chunk can be submitted, and (rows, t, h) is yielded for every chunk, where rows
+    is the slice of the chunk in the sequence of parameter rows.
+
+    Inputs
+    ======
+        params : iterable of q, (q, spin1) or dictionaries of per-waveform inputs with
+                 the keys q, spin1, M_tot, dist_mpc, orb_phase and inclination (the same
+                 keys in all rows)
+        others : see sweep()
+    """
+    processes, max_pending = _check_options(processes, max_pending, chunk_size)
+    mp_context = _preload(model, processes, mmap, mp_context)
+    return _run(model, _numbered(_row_chunks(params, chunk_size)), processes, ordered,
+                max_pending, mmap, mp_context, kwargs)
+
+#----------------------------------------------------------------------------------------------------
+def stream_chunks(model, chunks, processes=None, ordered=True, max_pending=None, mmap=True,
+                  mp_context=None, **kwargs):
+    """
+    Like stream(), for parameters that already come in chunks: every item of chunks is a
+    dictionary of arrays of per-waveform inputs (keys as for stream(); spin1 and the
+    extrinsic inputs may also be scalars), evaluated with one call to
+    generate_surrogate_batch. See sweep() for the other inputs.
+    """
+    processes, max_pending = _check_options(processes, max_pending)
+    mp_context = _preload(model, processes, mmap, mp_context)
+    return _run(model, _numbered(chunks), processes, ordered, max_pending, mmap, mp_context,
+                kwargs)
+
+#----------------------------------------------------------------------------------------------------
+def _numbered(chunks):
+    """ Checks dictionaries of arrays and numbers their rows consecutively """
+    start = 0
+    for chunk in chunks:
+        chunk = _check_chunk(chunk, start)
+        start = chunk[0].stop
+        yield chunk
+
+#----------------------------------------------------------------------------------------------------
+def _run(model, chunks, processes, ordered, max_pending, mmap, mp_context, kwargs):
+    """ Yields the evaluated chunks, see sweep() """
+    if processes == 1:
+        _worker_state.update(model=model, kwargs=kwargs)
+        try:
+            for chunk in chunks:
+                yield _evaluate_chunk(chunk)
+        finally:
+            _worker_state.clear()
+        return
+
+    with mp_context.Pool(processes, initializer=_init_worker,
+                         initargs=(model.__name__, mmap, kwargs)) as pool:
+        if ordered:
+            yield from _bounded_ordered(pool, chunks, max_pending)
+        else:
+            yield from _bounded_unordered(pool, chunks, max_pending)
+
+#----------------------------------------------------------------------------------------------------
+def _bounded_ordered(pool, chunks, max_pending):
+    """ Evaluates the chunks on pool, with at most max_pending not yet yielded, in order """
+    pending = collections.deque()
+    for chunk in chunks:
+        pending.append(pool.apply_async(_evaluate_chunk, (chunk,)))
+        if len(pending) >= max_pending:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+#----------------------------------------------------------------------------------------------------
+def _bounded_unordered(pool, chunks, max_pending):
+    """ Evaluates the chunks on pool, with at most max_pending not yet yielded, as they complete """
+    done = queue.Queue()
+    n_pending = 0
+
+    def next_result():
+        result = done.get()
+        if isinstance(result, BaseException):
+            raise result
+        return result
+
+    for chunk in chunks:
+        pool.apply_async(_evaluate_chunk, (chunk,), callback=done.put, error_callback=done.put)
+        n_pending += 1
+        if n_pending >= max_pending:
+            n_pending -= 1
+            yield next_result()
+    while n_pending:
+        n_pending -= 1
+        yield next_result()
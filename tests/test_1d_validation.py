@@ -66,3 +66,23 @@ class TestMassScaleValidation:
         from BHPTNRSurrogate.surrogates import BHPTNRSur1dq1e4
         t, h = BHPTNRSur1dq1e4.generate_surrogate(q=10, calibrated=False, mass_scale='m1')
         assert isinstance(h, dict)
+
+
+class TestBatchValidation:
+    def test_extrinsic_length_mismatch_raises(self):
+        from BHPTNRSurrogate.surrogates import BHPTNRSur1dq1e4
+        with pytest.raises(ValueError, match="M_tot has 3 values"):
+            BHPTNRSur1dq1e4.generate_surrogate_batch([10, 20], M_tot=[1, 2, 3], dist_mpc=100)
+
+    def test_2d_q_raises(self):
+        from BHPTNRSurrogate.surrogates import BHPTNRSur1dq1e4
+        with pytest.raises(ValueError, match="1d array"):
+            BHPTNRSur1dq1e4.generate_surrogate_batch([[10, 20]])
+
+    def test_batch_passes_columns(self):
+        from BHPTNRSurrogate.surrogates import BHPTNRSur1dq1e4
+        BHPTNRSur1dq1e4.generate_surrogate_batch([10, 20])
+        args = BHPTNRSur1dq1e4.eval_sur.evaluate_surrogate.call_args[0]
+        X_sur, X_calib = args[0], args[1]
+        np.testing.assert_allclose(X_sur, np.log10([[10], [20]]))
+        np.testing.assert_allclose(X_calib, [[0.1], [0.05]])
@@ -59,3 +59,171 @@ class TestMassScaleBehavior:
         # strain ratio for (2,2) mode
         strain_ratio = h_M[(2, 2)][-1] / h_m1[(2, 2)][-1]
         np.testing.assert_allclose(np.abs(strain_ratio), expected_ratio, rtol=1e-10)
+
+
+class TestBatchGeneration:
+    def test_batch_matches_single(self, model_1d):
+        qs = np.array([3.0, 10.0, 100.0])
+        t, h = model_1d.generate_surrogate_batch(qs, modes=[(2, 2), (3, 3)])
+        assert t.shape[0] == len(qs)
+        for i, q in enumerate(qs):
+            t_i, h_i = model_1d.generate_surrogate(q=q, modes=[(2, 2), (3, 3)])
+            np.testing.assert_allclose(t[i], t_i, rtol=1e-12)
+            for mode in h_i:
+                np.testing.assert_allclose(h[mode][i], h_i[mode], rtol=1e-10, atol=1e-14)
+
+    def test_batch_per_waveform_extrinsics(self, model_1d):
+        qs = np.array([5.0, 50.0])
+        M_tot, dist_mpc = np.array([20.0, 60.0]), np.array([100.0, 400.0])
+        t, h = model_1d.generate_surrogate_batch(qs, M_tot=M_tot, dist_mpc=dist_mpc,
+                                                 orb_phase=0.3, inclination=0.5, mode_sum=True)
+        for i, q in enumerate(qs):
+            t_i, h_i = model_1d.generate_surrogate(q=q, M_tot=M_tot[i], dist_mpc=dist_mpc[i],
+                                                   orb_phase=0.3, inclination=0.5, mode_sum=True)
+            np.testing.assert_allclose(t[i], t_i, rtol=1e-12)
+            np.testing.assert_allclose(h[i], h_i, rtol=1e-10, atol=1e-14 * np.max(np.abs(h_i)))
+
+    def test_batch_per_waveform_extrinsics_modes(self, model_1d):
+        qs = np.array([5.0, 50.0])
+        extrinsics = dict(M_tot=np.array([20.0, 60.0]), dist_mpc=np.array([100.0, 400.0]),
+                          orb_phase=np.array([0.3, 1.2]), inclination=np.array([0.5, 2.0]))
+        # default neg_modes=True, mode_sum=False
+        t, h = model_1d.generate_surrogate_batch(qs, modes=[(2, 2), (3, 3)], **extrinsics)
+        for i, q in enumerate(qs):
+            t_i, h_i = model_1d.generate_surrogate(q=q, modes=[(2, 2), (3, 3)],
+                                                   **{key: value[i] for key, value in extrinsics.items()})
+            np.testing.assert_allclose(t[i], t_i, rtol=1e-12)
+            for mode in h_i:
+                np.testing.assert_allclose(h[mode][i], h_i[mode], rtol=1e-10,
+                                           atol=1e-14 * np.max(np.abs(h_i[mode])))
+
+
+class TestCompiledCache:
+    def test_cached_model_matches_h5(self, model_1d, tmp_path, monkeypatch):
+        monkeypatch.setenv('BHPTNRSUR_CACHE_DIR', str(tmp_path))
+        t_ref, h_ref = model_1d.generate_surrogate(q=10)
+        path = model_1d.compile_surrogate()
+        assert path.startswith(str(tmp_path))
+
+        parsed = dict(model_1d._surrogate_data)
+        model_1d._surrogate_data.clear()
+        try:
+            model_1d._ensure_loaded()
+            t, h = model_1d.generate_surrogate(q=10)
+        finally:
+            model_1d._surrogate_data.clear()
+            model_1d._surrogate_data.update(parsed)
+        np.testing.assert_array_equal(t, t_ref)
+        for mode in h_ref:
+            np.testing.assert_array_equal(h[mode], h_ref[mode])
+
+    def test_mmap_model_matches_h5(self, model_1d, tmp_path, monkeypatch):
+        monkeypatch.setenv('BHPTNRSUR_CACHE_DIR', str(tmp_path))
+        t_ref, h_ref = model_1d.generate_surrogate_batch([3.0, 30.0])
+
+        parsed = dict(model_1d._surrogate_data)
+        model_1d._surrogate_data.clear()
+        try:
+            model_1d._ensure_loaded(mmap=True)
+            assert isinstance(model_1d._surrogate_data['B_dict_1'][(2, 2)].base, np.memmap)
+            t, h = model_1d.generate_surrogate_batch([3.0, 30.0])
+        finally:
+            model_1d._surrogate_data.clear()
+            model_1d._surrogate_data.update(parsed)
+        np.testing.assert_array_equal(t, t_ref)
+        for mode in h_ref:
+            np.testing.assert_array_equal(h[mode], h_ref[mode])
+
+
+class TestLazyLoading:
+    def test_only_requested_modes_are_read(self, model_1d, tmp_path, monkeypatch):
+        monkeypatch.setenv('BHPTNRSUR_CACHE_DIR', str(tmp_path))
+        t_ref, h_ref = model_1d.generate_surrogate(q=10, modes=[(2, 2)], lmax=2)
+
+        parsed = dict(model_1d._surrogate_data)
+        model_1d._surrogate_data.clear()
+        try:
+            model_1d._ensure_loaded()
+            t, h = model_1d.generate_surrogate(q=10, modes=[(2, 2)], lmax=2)
+            for key in ['fit_data_dict_1', 'fit_data_dict_2', 'B_dict_1', 'B_dict_2']:
+                assert model_1d._surrogate_data[key].loaded_modes() == [(2, 2)]
+        finally:
+            model_1d._surrogate_data.clear()
+            model_1d._surrogate_data.update(parsed)
+        np.testing.assert_array_equal(t, t_ref)
+        for mode in h_ref:
+            np.testing.assert_array_equal(h[mode], h_ref[mode])
+
+
+class TestOutputBuffers:
+    extrinsics = dict(M_tot=60, dist_mpc=100, orb_phase=0.3, inclination=0.7)
+
+    def test_modes_written_into_out(self, model_1d):
+        workspace = model_1d.Workspace()
+        _, h_out = model_1d.generate_surrogate(q=8, workspace=workspace)
+        t, h = model_1d.generate_surrogate(q=20, out=h_out, workspace=workspace)
+        t_ref, h_ref = model_1d.generate_surrogate(q=20)
+        assert h is h_out
+        np.testing.assert_array_equal(t, t_ref)
+        for mode in h_ref:
+            np.testing.assert_array_equal(h[mode], h_ref[mode])
+
+    def test_mode_sum_written_into_out(self, model_1d):
+        workspace = model_1d.Workspace()
+        t_ref, h_ref = model_1d.generate_surrogate(q=20, mode_sum=True, **self.extrinsics)
+        out = np.full(len(t_ref), np.nan, dtype=complex)
+        for _ in range(2):
+            t, h = model_1d.generate_surrogate(q=20, mode_sum=True, out=out, workspace=workspace,
+                                               **self.extrinsics)
+            assert h is out
+            np.testing.assert_array_equal(h, h_ref)
+
+    def test_out_of_wrong_shape(self, model_1d):
+        with pytest.raises(ValueError, match="out must be"):
+            model_1d.generate_surrogate(q=8, modes=[(2, 2)], out=np.empty((1, 10), dtype=complex))
+
+
+class TestAmpPhaseOutput:
+    def test_matches_complex_modes(self, model_1d):
+        t_ref, h_ref = model_1d.generate_surrogate(q=8, M_tot=60, dist_mpc=100)
+        t, h = model_1d.generate_surrogate(q=8, M_tot=60, dist_mpc=100, output='amp_phase')
+        np.testing.assert_array_equal(t, t_ref)
+        assert list(h.keys()) == list(h_ref.keys())
+        for mode in h_ref:
+            amp, phase = h[mode]
+            np.testing.assert_allclose(np.abs(amp), np.abs(h_ref[mode]), rtol=1e-12)
+        amp, phase = h[(2, 2)]
+        np.testing.assert_allclose(amp * np.exp(1j * phase), h_ref[(2, 2)], rtol=1e-12)
+
+    def test_mode_sum_is_not_available(self, model_1d):
+        with pytest.raises(ValueError, match="mode_sum"):
+            model_1d.generate_surrogate(q=8, M_tot=60, dist_mpc=100, orb_phase=0.3, inclination=0.7,
+                                        mode_sum=True, output='amp_phase')
+        with pytest.raises(ValueError, match="output"):
+            model_1d.generate_surrogate(q=8, output='polar')
+
+
+class TestParallelModes:
+    def test_workers_do_not_change_the_waveform(self, model_1d):
+        for kwargs in [dict(), dict(M_tot=60, dist_mpc=100, orb_phase=0.3, inclination=0.7, mode_sum=True)]:
+            t_ref, h_ref = model_1d.generate_surrogate(q=8, workers=1, **kwargs)
+            t, h = model_1d.generate_surrogate(q=8, workers=4, **kwargs)
+            np.testing.assert_array_equal(t, t_ref)
+            if kwargs:
+                np.testing.assert_array_equal(h, h_ref)
+            else:
+                np.testing.assert_array_equal(h.data, h_ref.data)
+
+
+class TestFreeze:
+    def test_frozen_model_matches(self, model_1d, monkeypatch):
+        t_ref, h_ref = model_1d.generate_surrogate(q=8)
+        # the frozen copy replaces the data of the module for this test only
+        monkeypatch.setattr(model_1d, '_surrogate_data', dict(model_1d._surrogate_data))
+        model_1d.freeze(gc_freeze=False)
+        B = model_1d._surrogate_data['B_dict_1'][(2, 2)]
+        assert not B.flags.writeable
+        assert isinstance(model_1d._surrogate_data['B_dict_1'], dict)
+        t, h = model_1d.generate_surrogate(q=8)
+        np.testing.assert_array_equal(t, t_ref)
+        np.testing.assert_array_equal(h.data, h_ref.data)
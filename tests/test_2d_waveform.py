@@ -39,3 +39,162 @@ class TestOutOfRange:
     def test_spin_out_of_range_warns(self, model_2d):
         with pytest.warns(UserWarning, match="outside bounds"):
             model_2d.generate_surrogate(q=10, spin1=0.9)
+
+
+class TestBatchGeneration:
+    def test_batch_mixed_spin_signs_matches_single(self, model_2d):
+        qs = np.array([4.0, 20.0, 200.0])
+        spins = np.array([0.5, -0.5, 0.0])
+        t, h = model_2d.generate_surrogate_batch(qs, spins, modes=[(2, 2), (3, 3)])
+        for i in range(len(qs)):
+            t_i, h_i = model_2d.generate_surrogate(q=qs[i], spin1=spins[i], modes=[(2, 2), (3, 3)])
+            np.testing.assert_allclose(t[i], t_i, rtol=1e-12)
+            for mode in h_i:
+                np.testing.assert_allclose(h[mode][i], h_i[mode], rtol=1e-10, atol=1e-14)
+
+
+class TestCompiledCache:
+    def test_cached_model_matches_h5(self, model_2d, tmp_path, monkeypatch):
+        monkeypatch.setenv('BHPTNRSUR_CACHE_DIR', str(tmp_path))
+        refs = {spin: model_2d.generate_surrogate(q=10, spin1=spin) for spin in (-0.5, 0.5)}
+        import h5py
+        n_open = h5py.h5f.get_obj_count(types=h5py.h5f.OBJ_FILE)
+        paths = model_2d.compile_surrogate()
+        assert len(paths) == 3
+        # the h5 file of each sub-surrogate is closed once all its modes are written
+        assert h5py.h5f.get_obj_count(types=h5py.h5f.OBJ_FILE) == n_open
+
+        parsed = dict(model_2d._surrogate_data)
+        model_2d._surrogate_data.clear()
+        try:
+            model_2d._ensure_loaded()
+            for spin, (t_ref, h_ref) in refs.items():
+                t, h = model_2d.generate_surrogate(q=10, spin1=spin)
+                np.testing.assert_array_equal(t, t_ref)
+                for mode in h_ref:
+                    np.testing.assert_array_equal(h[mode], h_ref[mode])
+        finally:
+            model_2d._surrogate_data.clear()
+            model_2d._surrogate_data.update(parsed)
+
+
+class TestLazyLoading:
+    def test_only_requested_modes_are_read(self, model_2d, tmp_path, monkeypatch):
+        monkeypatch.setenv('BHPTNRSUR_CACHE_DIR', str(tmp_path))
+        parsed = dict(model_2d._surrogate_data)
+        model_2d._surrogate_data.clear()
+        try:
+            model_2d._ensure_loaded()
+            model_2d.generate_surrogate(q=10, spin1=0.4, modes=[(2, 2), (3, 3)])
+            fit_data_dict_1_sign = model_2d._surrogate_data['fit_data_dict_1_sign']
+            # the negative spin sub-surrogate is never loaded
+            assert fit_data_dict_1_sign.loaded_modes() == ['positive_spin']
+            assert fit_data_dict_1_sign['positive_spin'].loaded_modes() == [(2, 2), (3, 3)]
+            # the packed GPR evaluation needs no fit evaluators, so none are built
+            for fit_data_dict in [fit_data_dict_1_sign, model_2d._surrogate_data['fit_data_dict_2_sign']]:
+                for mode in [(2, 2), (3, 3)]:
+                    assert fit_data_dict['positive_spin'][mode][2] is None
+        finally:
+            model_2d._surrogate_data.clear()
+            model_2d._surrogate_data.update(parsed)
+
+
+class TestOutputBuffers:
+    def test_modes_written_into_out(self, model_2d):
+        workspace = model_2d.Workspace()
+        _, h_out = model_2d.generate_surrogate(q=8, spin1=0.2, workspace=workspace)
+        t, h = model_2d.generate_surrogate(q=20, spin1=0.4, out=h_out, workspace=workspace)
+        t_ref, h_ref = model_2d.generate_surrogate(q=20, spin1=0.4)
+        assert h is h_out
+        np.testing.assert_array_equal(t, t_ref)
+        for mode in h_ref:
+            np.testing.assert_array_equal(h[mode], h_ref[mode])
+
+
+class TestAmpPhaseOutput:
+    def test_matches_complex_modes(self, model_2d):
+        for kwargs in [dict(), dict(M_tot=60.0, dist_mpc=100.0, orb_phase=0.4, inclination=1.0)]:
+            t_ref, h_ref = model_2d.generate_surrogate(q=8, spin1=-0.3, **kwargs)
+            t, h = model_2d.generate_surrogate(q=8, spin1=-0.3, output='amp_phase', **kwargs)
+            np.testing.assert_array_equal(t, t_ref)
+            assert list(h.keys()) == list(h_ref.keys())
+            h_complex = h.to_complex()
+            for mode in h_ref:
+                np.testing.assert_allclose(h_complex[mode], h_ref[mode], rtol=1e-12,
+                                           atol=1e-12 * np.abs(h_ref[mode]).max())
+
+    def test_batch(self, model_2d):
+        t_ref, h_ref = model_2d.generate_surrogate_batch([8.0, 20.0], spin1=[-0.3, 0.4], modes=[(2, 2), (3, 3)])
+        t, h = model_2d.generate_surrogate_batch([8.0, 20.0], spin1=[-0.3, 0.4], modes=[(2, 2), (3, 3)],
+                                                 output='amp_phase')
+        np.testing.assert_array_equal(t, t_ref)
+        amp, phase = h[(3, -3)]
+        assert amp.shape == (2, len(t[0]))
+        np.testing.assert_allclose(amp * np.exp(1j * phase), h_ref[(3, -3)], rtol=1e-12,
+                                   atol=1e-12 * np.abs(h_ref[(3, -3)]).max())
+
+
+class TestSweep:
+    def test_matches_batch(self, model_2d):
+        from BHPTNRSurrogate.surrogates.model_utils import sweep
+        q = np.array([8.0, 20.0, 50.0, 12.0, 30.0])
+        spin1 = np.array([-0.3, 0.4, 0.1, -0.5, 0.0])
+        M_tot = np.linspace(40.0, 80.0, 5)
+        t_ref, h_ref = model_2d.generate_surrogate_batch(q, spin1=spin1, modes=[(2, 2), (3, 3)],
+                                                         M_tot=M_tot, dist_mpc=100.0, orb_phase=0.4,
+                                                         inclination=0.5, mode_sum=True)
+        for ordered in [True, False]:
+            # the fixture loads the model without mmap; forked workers inherit that data
+            with pytest.warns(UserWarning, match="loaded without mmap"):
+                results = list(sweep.sweep(model_2d, q, spin1, chunk_size=2, processes=2,
+                                           ordered=ordered, mp_context='fork', modes=[(2, 2), (3, 3)],
+                                           M_tot=M_tot, dist_mpc=100.0, orb_phase=0.4,
+                                           inclination=0.5, mode_sum=True))
+            for rows, t, h in results:
+                np.testing.assert_array_equal(t, t_ref[rows])
+                np.testing.assert_allclose(h, h_ref[rows], rtol=1e-12, atol=1e-12 * np.abs(h_ref).max())
+
+    def test_spawned_workers_map_the_cache(self, model_2d, tmp_path, monkeypatch):
+        from BHPTNRSurrogate.surrogates.model_utils import sweep
+        monkeypatch.setenv('BHPTNRSUR_CACHE_DIR', str(tmp_path))
+        q = np.array([8.0, 20.0, 50.0])
+        spin1 = np.array([-0.3, 0.4, 0.1])
+        t_ref, h_ref = model_2d.generate_surrogate_batch(q, spin1=spin1, modes=[(2, 2)])
+        # the model was loaded without mmap, so the caches are compiled for the workers
+        with pytest.warns(UserWarning, match="compiling the cache"):
+            results = list(sweep.sweep(model_2d, q, spin1, chunk_size=1, processes=2,
+                                       mp_context='spawn', modes=[(2, 2)]))
+        assert len(list(tmp_path.iterdir())) == 1 + len(model_2d._SPIN_SIGNS)
+        for rows, t, h in results:
+            np.testing.assert_array_equal(t, t_ref[rows])
+            np.testing.assert_allclose(h[(2, 2)], h_ref[(2, 2)][rows], rtol=1e-12,
+                                       atol=1e-12 * np.abs(h_ref[(2, 2)]).max())
+
+
+class TestFreeze:
+    def test_frozen_model_matches(self, model_2d, monkeypatch):
+        t_ref, h_ref = model_2d.generate_surrogate_batch([8.0, 20.0], spin1=[-0.3, 0.4])
+        # the frozen copy replaces the data of the module for this test only
+        monkeypatch.setattr(model_2d, '_surrogate_data', dict(model_2d._surrogate_data))
+        model_2d.freeze(gc_freeze=False)
+        for spin_sign in model_2d._SPIN_SIGNS:
+            assert not model_2d._surrogate_data['B_dict_1_sign'][spin_sign][(2, 2)].flags.writeable
+        t, h = model_2d.generate_surrogate_batch([8.0, 20.0], spin1=[-0.3, 0.4])
+        np.testing.assert_array_equal(t, t_ref)
+        np.testing.assert_array_equal(h.data, h_ref.data)
+
+
+class TestCatalog:
+    def test_catalog_matches_batch(self, model_2d, tmp_path):
+        import h5py
+        from BHPTNRSurrogate.surrogates.model_utils import catalog
+        params = [(8.0, 0.3), (20.0, 0.4), (50.0, 0.1), (12.0, 0.5), (30.0, 0.0)]
+        path = str(tmp_path / 'catalog.h5')
+        with pytest.warns(UserWarning, match="loaded without mmap"):
+            assert catalog.generate_catalog(path, model_2d, params, chunk_size=2, processes=2,
+                                            compression='gzip', modes=[(2, 2), (3, 3)]) == 5
+        t_ref, h_ref = model_2d.generate_surrogate_batch(*zip(*params), modes=[(2, 2), (3, 3)])
+        with h5py.File(path, 'r') as f:
+            np.testing.assert_array_equal(f['t'][()], t_ref)
+            np.testing.assert_allclose(f['h'][()], np.moveaxis(h_ref.data, 1, 0), rtol=1e-12,
+                                       atol=1e-12 * np.abs(h_ref.data).max())
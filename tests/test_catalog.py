@@ -0,0 +1,128 @@
+"""Tests of the HDF5 waveform catalogs (no h5 data needed)"""
+
+import sys
+import types
+
+import h5py
+import numpy as np
+import pytest
+
+from BHPTNRSurrogate.surrogates.common_utils.waveform_modes import WaveformModes, AmpPhaseModes
+from BHPTNRSurrogate.surrogates.model_utils import catalog
+
+MODES = [(2, 2), (3, 3)]
+
+
+def _batch(q, n_times=6):
+    """ t and complex modes of a batch of mass ratios, as returned by generate_surrogate_batch """
+    q = np.asarray(q, dtype=float)
+    t = np.tile(np.arange(n_times, dtype=float), (len(q), 1))
+    data = np.array([q[:, None] * np.exp(1j * m * t) for l, m in MODES])
+    return t, WaveformModes(MODES, data, negative_m=True)
+
+
+@pytest.fixture
+def fake_model(monkeypatch):
+    """ A model module returning _batch(q) """
+    model = types.ModuleType('fake_catalog_model')
+    model.calls = []
+    model.preload = lambda mmap=None: None
+
+    def generate_surrogate_batch(q, spin1=0.0, modes=None):
+        model.calls.append(list(q))
+        return _batch(q)
+
+    model.generate_surrogate_batch = generate_surrogate_batch
+    monkeypatch.setitem(sys.modules, model.__name__, model)
+    return model
+
+
+@pytest.mark.parametrize('background', [True, False])
+def test_write_and_append(tmp_path, background):
+    path = str(tmp_path / 'catalog.h5')
+    with catalog.CatalogWriter(path, compression='gzip', background=background) as writer:
+        writer.write({'q': [1.0, 2.0], 'M_tot': 60.0}, *_batch([1.0, 2.0]))
+        writer.write({'q': [3.0], 'M_tot': 60.0}, *_batch([3.0]))
+    with catalog.CatalogWriter(path, background=background) as writer:
+        assert writer.n_written == 3
+        writer.write({'q': [4.0], 'M_tot': 50.0}, *_batch([4.0]))
+
+    t, h = _batch([1.0, 2.0, 3.0, 4.0])
+    with h5py.File(path, 'r') as f:
+        assert f.attrs['n_waveforms'] == 4
+        assert f['h'].shape == (4, 2, 6) and f['h'].chunks == (1, 1, 6)
+        assert f['h'].compression == 'gzip'
+        np.testing.assert_array_equal(f['h'][()], np.moveaxis(h.data, 1, 0))
+        np.testing.assert_array_equal(f['t'][()], t)
+        np.testing.assert_array_equal(f['mode_list'][()], MODES)
+        assert f['mode_list'].attrs['negative_m']
+        np.testing.assert_array_equal(f['parameters/q'][()], [1.0, 2.0, 3.0, 4.0])
+        np.testing.assert_array_equal(f['parameters/M_tot'][()], [60.0, 60.0, 60.0, 50.0])
+
+
+def test_amp_phase_and_mode_sum(tmp_path):
+    t, h = _batch([1.0, 2.0])
+    h_amp_phase = AmpPhaseModes(MODES, np.stack([np.abs(h.data), np.angle(h.data)], axis=1))
+    with catalog.CatalogWriter(str(tmp_path / 'amp_phase.h5')) as writer:
+        writer.write({'q': [1.0, 2.0]}, t, h_amp_phase)
+    with catalog.CatalogWriter(str(tmp_path / 'sum.h5')) as writer:
+        writer.write({'q': [1.0, 2.0]}, t, h.data.sum(axis=0))
+    with h5py.File(str(tmp_path / 'amp_phase.h5'), 'r') as f:
+        np.testing.assert_array_equal(f['amp'][()], np.moveaxis(np.abs(h.data), 1, 0))
+        np.testing.assert_array_equal(f['phase'][()], np.moveaxis(np.angle(h.data), 1, 0))
+    with h5py.File(str(tmp_path / 'sum.h5'), 'r') as f:
+        assert 'mode_list' not in f
+        np.testing.assert_array_equal(f['h'][()], h.data.sum(axis=0))
+
+
+def test_mismatched_batches_are_rejected(tmp_path):
+    path = str(tmp_path / 'catalog.h5')
+    with catalog.CatalogWriter(path, background=False) as writer:
+        writer.write({'q': [1.0]}, *_batch([1.0]))
+        with pytest.raises(ValueError, match="Cannot append"):
+            writer.write({'q': [2.0]}, *_batch([2.0], n_times=7))
+        with pytest.raises(ValueError, match="parameters"):
+            writer.write({'q': [2.0], 'spin1': [0.1]}, *_batch([2.0]))
+        assert writer.n_written == 1
+
+    # errors of the background thread are raised by the next call
+    writer = catalog.CatalogWriter(path)
+    writer.write({'q': [2.0]}, *_batch([2.0], n_times=7))
+    with pytest.raises(ValueError, match="Cannot append"):
+        writer.close()
+    with h5py.File(path, 'r') as f:
+        assert f.attrs['n_waveforms'] == 1 and len(f['h']) == 1
+
+
+def test_interrupted_batch_is_dropped(tmp_path):
+    path = str(tmp_path / 'catalog.h5')
+    with catalog.CatalogWriter(path) as writer:
+        writer.write({'q': [1.0, 2.0]}, *_batch([1.0, 2.0]))
+    # a batch that was being written when the job stopped
+    with h5py.File(path, 'a') as f:
+        f['h'].resize(3, axis=0)
+    with catalog.CatalogWriter(path) as writer:
+        assert writer.n_written == 2
+    with h5py.File(path, 'r') as f:
+        assert len(f['h']) == 2
+
+
+def test_generate_catalog_resumes(tmp_path, fake_model):
+    path = str(tmp_path / 'catalog.h5')
+    params = [(q, 0.1 * q) for q in np.arange(1.0, 11.0)]
+    assert catalog.generate_catalog(path, fake_model, params[:4], chunk_size=3, processes=1,
+                                    modes=MODES) == 4
+    fake_model.calls.clear()
+    assert catalog.generate_catalog(path, fake_model, iter(params), chunk_size=3, processes=1,
+                                    modes=MODES) == 10
+    # the first four rows are not generated again
+    assert fake_model.calls == [[5.0, 6.0, 7.0], [8.0, 9.0, 10.0]]
+
+    t, h = _batch(np.arange(1.0, 11.0))
+    with h5py.File(path, 'r') as f:
+        assert f.attrs['model'] == 'fake_catalog_model'
+        np.testing.assert_array_equal(f['h'][()], np.moveaxis(h.data, 1, 0))
+        np.testing.assert_allclose(f['parameters/spin1'][()], 0.1 * np.arange(1.0, 11.0))
+
+    with pytest.raises(ValueError, match="options"):
+        catalog.generate_catalog(path, fake_model, params, processes=1, modes=[(2, 2)])
@@ -87,3 +87,14 @@ class TestCheckExtrinsicParams:
     def test_mode_sum_without_params_raises(self):
         with pytest.raises(ValueError, match="should NOT be None"):
             check_extrinsic_params(None, None, None, None, mode_sum=True)
+
+    def test_batch_within_bounds(self):
+        X_bounds = [[0.0, -1.0], [10.0, 1.0]]
+        with warnings.catch_warnings():
+            warnings.simplefilter("error")
+            check_domain_of_validity([[5.0, 0.0], [1.0, 0.5]], X_bounds)
+
+    def test_batch_one_row_out(self):
+        X_bounds = [[0.0, -1.0], [10.0, 1.0]]
+        with pytest.warns(UserWarning, match="index 1"):
+            check_domain_of_validity([[5.0, 0.0], [1.0, 1.5]], X_bounds)
@@ -0,0 +1,131 @@
+"""Tests of the h5 file downloader against a local HTTP server (no network needed)."""
+
+import http.server
+import json
+import os
+import re
+import threading
+
+import pytest
+
+from BHPTNRSurrogate.surrogates.common_utils import download, filehash
+
+CONTENT = os.urandom(100_000)
+CHUNK_SIZE = 16_384
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    """Serves CONTENT at /<any name>, with byte ranges unless the server disables them."""
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.requests.append(self.headers.get('Range'))
+            fail = server.fail_after is not None and len(server.requests) > server.fail_after
+        if fail:
+            self.send_error(500)
+            return
+        match = re.match(r'bytes=(\d+)-(\d+)', self.headers.get('Range') or '')
+        if match and server.ranges:
+            start, stop = int(match.group(1)), int(match.group(2)) + 1
+            body = CONTENT[start:stop]
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, stop - 1, len(CONTENT)))
+        else:
+            body = CONTENT
+            self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    httpd = http.server.ThreadingHTTPServer(('127.0.0.1', 0), _Handler)
+    httpd.lock, httpd.requests, httpd.ranges, httpd.fail_after = threading.Lock(), [], True, None
+    httpd.url = 'http://127.0.0.1:%d' % httpd.server_address[1]
+    thread = threading.Thread(target=httpd.serve_forever, kwargs={"poll_interval": 0.01}, daemon=True)
+    thread.start()
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def _data_requests(server):
+    """Range requests other than the initial size probe."""
+    return [r for r in server.requests if r != 'bytes=0-0']
+
+
+class TestDownloadFile:
+    def test_parallel_chunks(self, server, tmp_path):
+        path = str(tmp_path / 'model.h5')
+        download.download_file(server.url + '/model.h5', path, chunk_size=CHUNK_SIZE, n_connections=4)
+        assert open(path, 'rb').read() == CONTENT
+        assert len(_data_requests(server)) == 7
+        assert sorted(os.listdir(tmp_path)) == ['model.h5', 'model.h5.lock']
+
+    def test_without_range_support(self, server, tmp_path):
+        server.ranges = False
+        path = str(tmp_path / 'model.h5')
+        download.download_file(server.url + '/model.h5', path, chunk_size=CHUNK_SIZE)
+        assert open(path, 'rb').read() == CONTENT
+
+    def test_interrupted_download_resumes(self, server, tmp_path):
+        path = str(tmp_path / 'model.h5')
+        server.fail_after = 4
+        with pytest.raises(Exception):
+            download.download_file(server.url + '/model.h5', path, chunk_size=CHUNK_SIZE, n_connections=1)
+        # nothing is installed, the partial download is kept
+        assert not os.path.exists(path)
+        with open(path + '.part.json') as f:
+            done = json.load(f)['done']
+        assert done == [0, 1, 2]
+
+        server.fail_after, server.requests = None, []
+        download.download_file(server.url + '/model.h5', path, chunk_size=CHUNK_SIZE, n_connections=1)
+        assert open(path, 'rb').read() == CONTENT
+        assert len(_data_requests(server)) == 4
+        assert not os.path.exists(path + '.part.json')
+
+    def test_concurrent_downloads_fetch_once(self, server, tmp_path):
+        path = str(tmp_path / 'model.h5')
+        threads = [threading.Thread(target=download.download_file,
+                                    args=(server.url + '/model.h5', path),
+                                    kwargs={'chunk_size': CHUNK_SIZE}) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert open(path, 'rb').read() == CONTENT
+        assert len(_data_requests(server)) == 7
+
+
+class TestMirror:
+    def test_mirror_url(self, server, tmp_path, monkeypatch):
+        monkeypatch.setenv('BHPTNRSUR_MIRROR', server.url + '/mirror/')
+        assert download.fetch_data_file('model.h5', str(tmp_path), '123') == server.url + '/mirror/model.h5'
+        assert open(tmp_path / 'model.h5', 'rb').read() == CONTENT
+
+    @pytest.mark.parametrize("prefix", ['', 'file://'])
+    def test_mirror_directory(self, tmp_path, monkeypatch, prefix):
+        mirror, data = tmp_path / 'mirror', tmp_path / 'data'
+        mirror.mkdir()
+        data.mkdir()
+        (mirror / 'model.h5').write_bytes(CONTENT)
+        monkeypatch.setenv('BHPTNRSUR_MIRROR', prefix + str(mirror))
+        download.fetch_data_file('model.h5', str(data), '123')
+        assert (data / 'model.h5').read_bytes() == CONTENT
+
+    def test_md5_downloads_missing_file(self, server, tmp_path, monkeypatch, capsys):
+        monkeypatch.setenv('BHPTNRSUR_MIRROR', server.url)
+        file_hash = filehash.md5('model.h5', str(tmp_path), '123')
+        assert file_hash == __import__('hashlib').md5(CONTENT).hexdigest()
+        assert 'Download complete' in capsys.readouterr().out
+
+    def test_md5_download_failure(self, tmp_path, monkeypatch):
+        monkeypatch.setenv('BHPTNRSUR_MIRROR', str(tmp_path / 'missing'))
+        with pytest.raises(RuntimeError, match="Failed to download model.h5"):
+            filehash.md5('model.h5', str(tmp_path), '123')
@@ -0,0 +1,77 @@
+"""Unit tests for surrogates/common_utils/filehash.py (no h5 data needed)."""
+
+import hashlib
+import os
+
+import pytest
+
+from BHPTNRSurrogate.surrogates.common_utils import filehash
+
+
+@pytest.fixture
+def h5_file(tmp_path, monkeypatch):
+    monkeypatch.delenv('BHPTNRSUR_STRICT_HASH', raising=False)
+    content = os.urandom(3 << 20)
+    (tmp_path / 'model.h5').write_bytes(content)
+    return str(tmp_path), hashlib.md5(content).hexdigest()
+
+
+def _overwrite_keeping_signature(path):
+    """Change the content of a file but keep its size, mtime and inode."""
+    stat = os.stat(path)
+    with open(path, 'r+b') as f:
+        f.write(b'corrupted')
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+
+
+class TestVerificationManifest:
+    def test_hash_without_manifest(self, h5_file):
+        h5_data_dir, expected = h5_file
+        assert filehash.md5('model.h5', h5_data_dir, None) == expected
+        assert not os.path.exists(os.path.join(h5_data_dir, '.model.h5.verified'))
+
+    def test_recorded_hash_skips_rehashing(self, h5_file):
+        h5_data_dir, expected = h5_file
+        filehash.record_verified_hash('model.h5', h5_data_dir, expected)
+        _overwrite_keeping_signature(os.path.join(h5_data_dir, 'model.h5'))
+        assert filehash.md5('model.h5', h5_data_dir, None) == expected
+
+    @pytest.mark.parametrize("use_env", [False, True])
+    def test_strict_mode_rehashes(self, h5_file, monkeypatch, use_env):
+        h5_data_dir, expected = h5_file
+        filehash.record_verified_hash('model.h5', h5_data_dir, expected)
+        _overwrite_keeping_signature(os.path.join(h5_data_dir, 'model.h5'))
+        if use_env:
+            monkeypatch.setenv('BHPTNRSUR_STRICT_HASH', '1')
+        assert filehash.md5('model.h5', h5_data_dir, None, strict=None if use_env else True) != expected
+
+    def test_manifest_is_readable_by_other_users(self, h5_file):
+        h5_data_dir, expected = h5_file
+        umask = os.umask(0o022)
+        try:
+            filehash.record_verified_hash('model.h5', h5_data_dir, expected)
+        finally:
+            os.umask(umask)
+        assert os.stat(os.path.join(h5_data_dir, '.model.h5.verified')).st_mode & 0o777 == 0o644
+
+    def test_changed_file_is_rehashed(self, h5_file):
+        h5_data_dir, expected = h5_file
+        filehash.record_verified_hash('model.h5', h5_data_dir, expected)
+        with open(os.path.join(h5_data_dir, 'model.h5'), 'ab') as f:
+            f.write(b'appended')
+        assert filehash.md5('model.h5', h5_data_dir, None) != expected
+
+    def test_corrupt_manifest_is_ignored(self, h5_file):
+        h5_data_dir, expected = h5_file
+        with open(os.path.join(h5_data_dir, '.model.h5.verified'), 'w') as f:
+            f.write('{not json')
+        assert filehash.md5('model.h5', h5_data_dir, None) == expected
+
+    def test_read_only_data_dir(self, h5_file, monkeypatch):
+        h5_data_dir, expected = h5_file
+
+        def mkstemp(*args, **kwargs):
+            raise PermissionError("read-only file system")
+        monkeypatch.setattr(filehash.tempfile, 'mkstemp', mkstemp)
+        filehash.record_verified_hash('model.h5', h5_data_dir, expected)
+        assert sorted(os.listdir(h5_data_dir)) == ['model.h5']
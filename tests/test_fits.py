@@ -0,0 +1,228 @@
+"""Unit tests for surrogates/common_utils/fits.py (no h5 data needed)."""
+
+import numpy as np
+import pytest
+from scipy.interpolate import splrep
+
+from BHPTNRSurrogate.surrogates.common_utils import fits, load_splines, utils
+from BHPTNRSurrogate.surrogates.common_utils.workspace import Workspace
+
+
+def _spline_fit_data(x_train, n_nodes, seed):
+    """Return [h_eim_spline, eim_indicies] in the layout of load_splines.load_surrogate."""
+    rng = np.random.default_rng(seed)
+    phases = rng.uniform(0, np.pi, n_nodes)
+    h_eim_spline = [splrep(x_train, np.sin(x_train + phases[j]) + j, k=3) for j in range(n_nodes)]
+    return [h_eim_spline, np.arange(n_nodes)]
+
+
+@pytest.fixture
+def spline_model():
+    """Toy two-mode spline model where the modes use different knot vectors."""
+    n_times = 200
+    rng = np.random.default_rng(0)
+    x_fine = np.linspace(0.4, 4.0, 30)
+    x_coarse = np.linspace(0.4, 4.0, 12)
+    modes = [(2, 2), (3, 3)]
+    fit_data_dict_1 = {(2, 2): _spline_fit_data(x_fine, 6, 1), (3, 3): _spline_fit_data(x_coarse, 4, 2)}
+    fit_data_dict_2 = {(2, 2): _spline_fit_data(x_fine, 5, 3), (3, 3): _spline_fit_data(x_coarse, 4, 4)}
+    B_dict_1 = {mode: rng.normal(size=(len(fit_data_dict_1[mode][1]), n_times)) for mode in modes}
+    B_dict_2 = {mode: rng.normal(size=(len(fit_data_dict_2[mode][1]), n_times)) for mode in modes}
+    return modes, fit_data_dict_1, fit_data_dict_2, B_dict_1, B_dict_2
+
+
+class TestPackedSplines:
+    def test_groups_by_knot_vector(self, spline_model):
+        _, fit_data_dict_1, fit_data_dict_2, _, _ = spline_model
+        packed = load_splines.pack_spline_fits(fit_data_dict_1, fit_data_dict_2)
+        assert packed['n_nodes'] == 19
+        assert len(packed['groups']) == 2
+
+    @pytest.mark.parametrize("X", [0.1, 1.3, 3.9, 4.5])
+    def test_matches_per_node_splev(self, spline_model, X):
+        _, fit_data_dict_1, fit_data_dict_2, _, _ = spline_model
+        packed = load_splines.pack_spline_fits(fit_data_dict_1, fit_data_dict_2)
+        h_eim_dict = fits.evaluate_packed_fits(X, packed)
+        for datapiece, fit_data_dict in enumerate([fit_data_dict_1, fit_data_dict_2]):
+            for mode, fit_data in fit_data_dict.items():
+                expected = fits._evaluate_splines_at_EIM_nodes(X, fit_data)
+                np.testing.assert_allclose(h_eim_dict[(datapiece, mode)], expected, rtol=1e-14)
+
+    def test_all_modes_surrogate_matches(self, spline_model):
+        modes, fit_data_dict_1, fit_data_dict_2, B_dict_1, B_dict_2 = spline_model
+        packed = load_splines.pack_spline_fits(fit_data_dict_1, fit_data_dict_2)
+        args = (modes, 1.7, fit_data_dict_1, fit_data_dict_2, B_dict_1, B_dict_2, 5, 'spline_1d',
+                [utils.amp_ph_to_comp, utils.re_im_to_comp], 0.1)
+        h_ref = fits.all_modes_surrogate(*args)
+        h_packed = fits.all_modes_surrogate(*args, packed_fits=packed)
+        for mode in modes:
+            np.testing.assert_allclose(h_packed[mode], h_ref[mode], rtol=1e-13)
+
+    def test_batch_matches_single(self, spline_model):
+        modes, fit_data_dict_1, fit_data_dict_2, B_dict_1, B_dict_2 = spline_model
+        packed = load_splines.pack_spline_fits(fit_data_dict_1, fit_data_dict_2)
+        X = np.array([[0.5], [1.7], [3.2]])
+        norm = np.array([[1.0], [0.5], [0.1]])
+        decomposition_funcs = [utils.amp_ph_to_comp, utils.re_im_to_comp]
+        h_batch = fits.all_modes_surrogate(modes, X, fit_data_dict_1, fit_data_dict_2, B_dict_1,
+                                           B_dict_2, 5, 'spline_1d', decomposition_funcs, norm,
+                                           packed_fits=packed)
+        for i in range(len(X)):
+            h_i = fits.all_modes_surrogate(modes, X[i, 0], fit_data_dict_1, fit_data_dict_2, B_dict_1,
+                                           B_dict_2, 5, 'spline_1d', decomposition_funcs, norm[i, 0])
+            for mode in modes:
+                assert h_batch[mode].shape == (3, 200)
+                np.testing.assert_allclose(h_batch[mode][i], h_i[mode], rtol=1e-12)
+
+    @pytest.mark.parametrize("packed", [True, False])
+    @pytest.mark.parametrize("X", [1.7, np.array([[0.5], [3.2]])])
+    def test_workers_do_not_change_the_modes(self, spline_model, packed, X):
+        modes, fit_data_dict_1, fit_data_dict_2, B_dict_1, B_dict_2 = spline_model
+        # more modes than workers, sharing the toy fit data
+        for mode, copy_of in [((4, 4), (3, 3)), ((5, 5), (3, 3)), ((5, 4), (2, 2))]:
+            for fit_data_dict in [fit_data_dict_1, fit_data_dict_2, B_dict_1, B_dict_2]:
+                fit_data_dict[mode] = fit_data_dict[copy_of]
+        modes = [(2, 2), (3, 3), (4, 4), (5, 5), (5, 4)]
+        packed_fits = load_splines.pack_spline_fits(fit_data_dict_1, fit_data_dict_2) if packed else None
+        args = (modes, X, fit_data_dict_1, fit_data_dict_2, B_dict_1, B_dict_2, 5, 'spline_1d',
+                [utils.amp_ph_to_comp, utils.re_im_to_comp], 0.1)
+        h_ref = fits.all_modes_surrogate(*args, packed_fits=packed_fits, workers=1)
+        h = fits.all_modes_surrogate(*args, packed_fits=packed_fits, workers=3)
+        np.testing.assert_array_equal(h.data, h_ref.data)
+        out = np.empty_like(h_ref.data)
+        workspace = Workspace()
+        h = fits.all_modes_surrogate(*args, packed_fits=packed_fits, out=out, workspace=workspace, workers=3)
+        assert h.data is out
+        np.testing.assert_array_equal(out, h_ref.data)
+        h_ref = fits.all_modes_surrogate_amp_phase(*args, packed_fits=packed_fits, workers=1)
+        h = fits.all_modes_surrogate_amp_phase(*args, packed_fits=packed_fits, workspace=workspace, workers=3)
+        np.testing.assert_array_equal(h.data, h_ref.data)
+
+    def test_packed_fits_for_modes(self, spline_model):
+        modes, fit_data_dict_1, fit_data_dict_2, _, _ = spline_model
+        packed_fits_by_modes = {}
+        packed = fits.packed_fits_for_modes(packed_fits_by_modes, [(3, 3), (2, 2), (5, 5)], 2,
+                                            fit_data_dict_1, fit_data_dict_2,
+                                            load_splines.pack_spline_fits)
+        assert list(packed_fits_by_modes) == [((2, 2),)]
+        assert set(packed['offsets']) == {(0, (2, 2)), (1, (2, 2))}
+        assert packed['n_nodes'] == 11
+        again = fits.packed_fits_for_modes(packed_fits_by_modes, [(2, 2)], 5, fit_data_dict_1,
+                                           fit_data_dict_2, load_splines.pack_spline_fits)
+        assert again is packed
+        assert fits.packed_fits_for_modes(packed_fits_by_modes, [(5, 5)], 5, fit_data_dict_1,
+                                          fit_data_dict_2, load_splines.pack_spline_fits) is None
+
+
+class TestGPRFitEvaluators:
+    def test_cached_evaluators_are_used(self):
+        calls = []
+
+        def make_evaluator(i):
+            def evaluator(x):
+                calls.append(i)
+                return i + x[0] + 10 * x[1]
+            return evaluator
+
+        fit_data = [None, np.arange(3), [make_evaluator(i) for i in range(3)]]
+        np.testing.assert_allclose(fits._evaluate_GPR_at_EIM_nodes([1.0, 0.5], fit_data), [6, 7, 8])
+        assert calls == [0, 1, 2]
+
+    def test_cached_evaluators_batch(self):
+        fit_data = [None, np.arange(2), [lambda x: x[0], lambda x: x[1]]]
+        vals = fits._evaluate_GPR_at_EIM_nodes(np.array([[1.0, 0.1], [2.0, 0.2]]), fit_data)
+        np.testing.assert_allclose(vals, [[1.0, 0.1], [2.0, 0.2]])
+
+
+class TestPackedGPRs:
+    @pytest.fixture
+    def gpr_fit_data(self):
+        """Toy GPR fit data for two modes laid out as in load_GPRs.load_surrogate."""
+        pytest.importorskip("sklearn")
+        from sklearn.gaussian_process import GaussianProcessRegressor
+        from sklearn.gaussian_process.kernels import ConstantKernel, RBF, WhiteKernel
+
+        rng = np.random.default_rng(5)
+        predictors = {}
+
+        def node(n_train):
+            X = np.column_stack([rng.uniform(0.5, 3, n_train), rng.uniform(-0.8, 0.8, n_train)])
+            y = np.sin(X[:, 0]) + X[:, 1] ** 2
+            kernel = ConstantKernel(1.0) * RBF([1.0, 1.0]) + WhiteKernel(1e-6)
+            gpr = GaussianProcessRegressor(kernel=kernel, optimizer=None).fit(X, y)
+            settings = {
+                'fitType': 'GPR', 'data_mean': 0.3, 'data_std': 2.0,
+                'lin_reg_params': {'coef_': np.array([0.1, -0.2]), 'intercept_': 0.05},
+                'GPR_params': {'X_train_': gpr.X_train_, 'alpha_': gpr.alpha_, 'L_': gpr.L_,
+                               '_y_train_mean': gpr._y_train_mean,
+                               '_y_train_std': gpr._y_train_std,
+                               'kernel_': {'name': 'Sum', 'k1': {'name': 'Product',
+                                                                 'k1': {'name': 'ConstantKernel',
+                                                                        'constant_value': gpr.kernel_.k1.k1.constant_value},
+                                                                 'k2': {'name': 'RBF',
+                                                                        'length_scale': gpr.kernel_.k1.k2.length_scale}},
+                                           'k2': {'name': 'WhiteKernel',
+                                                  'noise_level': gpr.kernel_.k2.noise_level}}},
+            }
+            predict = lambda x: (gpr.predict(np.atleast_2d(x)) * 2.0 + 0.3
+                                 + np.dot(np.atleast_2d(x), [0.1, -0.2]) + 0.05)[0]
+            return settings, predict
+
+        fit_data_dict_1, fit_data_dict_2 = {}, {}
+        for mode, n_nodes in [((2, 2), 3), ((3, 3), 2)]:
+            for datapiece, fit_data_dict in enumerate([fit_data_dict_1, fit_data_dict_2]):
+                nodes = [node(8 + 3 * i) for i in range(n_nodes)]
+                fit_data_dict[mode] = [{'node%s' % i: nodes[i][0] for i in range(n_nodes)},
+                                       np.arange(n_nodes)]
+                predictors[(datapiece, mode)] = [predict for _, predict in nodes]
+        return fit_data_dict_1, fit_data_dict_2, predictors
+
+    def test_matches_sklearn(self, gpr_fit_data):
+        from BHPTNRSurrogate.surrogates.common_utils import load_GPRs
+        fit_data_dict_1, fit_data_dict_2, predictors = gpr_fit_data
+        packed = load_GPRs.pack_gpr_fits(fit_data_dict_1, fit_data_dict_2)
+        assert packed['n_nodes'] == 10
+
+        X = [1.2, 0.3]
+        h_eim_dict = fits.evaluate_packed_fits(X, packed)
+        for key, node_predictors in predictors.items():
+            expected = [predict(X) for predict in node_predictors]
+            np.testing.assert_allclose(h_eim_dict[key], expected, rtol=1e-12)
+
+    def test_batch_matches_single(self, gpr_fit_data):
+        from BHPTNRSurrogate.surrogates.common_utils import load_GPRs
+        fit_data_dict_1, fit_data_dict_2, _ = gpr_fit_data
+        packed = load_GPRs.pack_gpr_fits(fit_data_dict_1, fit_data_dict_2)
+        X = np.array([[0.7, -0.4], [1.2, 0.3], [2.5, 0.7]])
+        batch = fits._evaluate_packed_GPRs(X, packed, chunk_size=1)
+        for i in range(len(X)):
+            np.testing.assert_allclose(batch[i], fits._evaluate_packed_GPRs(X[i], packed), rtol=1e-14)
+
+    def test_evaluators_are_rebuilt_for_cached_fit_data(self, gpr_fit_data, tmp_path):
+        pytest.importorskip("BHPTNRSurrogate.surrogates.common_utils.eval_pysur.evaluate_fit")
+        from BHPTNRSurrogate.surrogates.common_utils import surrogate_cache
+        fit_data_dict_1, _, predictors = gpr_fit_data
+        # fit data with evaluators, which are not stored in the cache
+        fit_data = fit_data_dict_1[(2, 2)] + [[len] * 3]
+        X = [1.2, 0.3]
+        expected = [predict(X) for predict in predictors[(0, (2, 2))]]
+
+        path = str(tmp_path / 'model.abc.sur')
+        surrogate_cache.write_cache(path, {'fit_data': fit_data}, 'model', 'abc')
+        for loaded in [surrogate_cache.read_cache(path, 'model', 'abc')['fit_data'],
+                       surrogate_cache.pack_contiguous({'fit_data': fit_data})['fit_data']]:
+            assert loaded[2] is None
+            np.testing.assert_allclose(fits._evaluate_GPR_at_EIM_nodes(X, loaded), expected, rtol=1e-10)
+            # the rebuilt evaluators are kept
+            assert len(loaded[2]) == 3 and all(callable(evaluator) for evaluator in loaded[2])
+
+        # caches written before the evaluator slot was stored as None
+        np.testing.assert_allclose(fits._evaluate_GPR_at_EIM_nodes(X, fit_data[:2] + [[None] * 3]),
+                                   expected, rtol=1e-10)
+
+    def test_unsupported_kernel_raises(self, gpr_fit_data):
+        from BHPTNRSurrogate.surrogates.common_utils import load_GPRs
+        fit_data_dict_1, fit_data_dict_2, _ = gpr_fit_data
+        fit_data_dict_1[(2, 2)][0]['node0']['GPR_params']['kernel_']['k1']['k2']['name'] = 'Matern'
+        with pytest.raises(ValueError, match="ConstantKernel \\* RBF \\+ WhiteKernel"):
+            load_GPRs.pack_gpr_fits(fit_data_dict_1, fit_data_dict_2)
@@ -1,5 +1,12 @@
 """Smoke tests: verify that the package and its submodules are importable."""
 
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
 
 def test_import_top_level():
     import BHPTNRSurrogate  # noqa: F401
@@ -25,3 +32,37 @@ def test_generate_surrogate_callable_1d():
 def test_generate_surrogate_callable_2d():
     from BHPTNRSurrogate.surrogates import BHPTNRSur2dq1e3
     assert callable(BHPTNRSur2dq1e3.generate_surrogate)
+
+
+# modules that importing a model must not pull in (see common_utils/lazy_imports.py)
+HEAVY_MODULES = ['gwtools', 'scipy', 'h5py', 'sklearn', 'urllib.request',
+                 'BHPTNRSurrogate.surrogates.common_utils.eval_pysur']
+
+# import time budget of the package on top of numpy, in seconds
+IMPORT_BUDGET = 0.25
+
+
+def test_import_is_cheap():
+    code = """if True:
+        import json, sys, time
+        import numpy
+        start = time.perf_counter()
+        import BHPTNRSurrogate.surrogates.BHPTNRSur1dq1e4
+        import BHPTNRSurrogate.surrogates.BHPTNRSur2dq1e3
+        elapsed = time.perf_counter() - start
+        print(json.dumps({'elapsed': elapsed, 'modules': sorted(sys.modules)}))
+    """
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(p for p in sys.path if p))
+    output = subprocess.run([sys.executable, '-c', code], env=env, capture_output=True,
+                            text=True, check=True).stdout
+    result = json.loads(output.splitlines()[-1])
+    assert [m for m in HEAVY_MODULES if m in result['modules']] == []
+    assert result['elapsed'] < IMPORT_BUDGET
+
+
+def test_common_utils_submodules_load_on_access():
+    from BHPTNRSurrogate.surrogates import common_utils
+    assert callable(common_utils.fits.all_modes_surrogate)
+    assert callable(common_utils.utils.geo_to_SI)
+    with pytest.raises(AttributeError):
+        common_utils.not_a_module
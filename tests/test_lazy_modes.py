@@ -0,0 +1,152 @@
+"""Unit tests for surrogates/common_utils/lazy_modes.py and the lazy h5 loaders."""
+
+import threading
+import time
+
+import h5py
+import numpy as np
+import pytest
+from scipy.interpolate import splrep
+
+from BHPTNRSurrogate.surrogates.common_utils import lazy_modes, load_splines
+
+MODES = [(2, 2), (3, 3), (4, 4)]
+
+
+class TestLazyModeDict:
+    def test_reads_each_mode_once_on_first_access(self):
+        reads = []
+        mode_dict = lazy_modes.LazyModeDict(MODES, lambda mode: reads.append(mode) or mode[0] * 10)
+        assert list(mode_dict) == MODES
+        assert len(mode_dict) == 3
+        assert (3, 3) in mode_dict and (5, 5) not in mode_dict
+        assert reads == []
+
+        assert mode_dict[(3, 3)] == 30
+        assert mode_dict[(3, 3)] == 30
+        assert reads == [(3, 3)]
+        assert mode_dict.loaded_modes() == [(3, 3)]
+
+    def test_unknown_mode_raises_key_error(self):
+        mode_dict = lazy_modes.LazyModeDict(MODES, lambda mode: 0)
+        with pytest.raises(KeyError):
+            mode_dict[(5, 5)]
+        assert mode_dict.get((5, 5)) is None
+
+    def test_concurrent_access_reads_once(self):
+        reads = []
+
+        def read_mode(mode):
+            reads.append(mode)
+            time.sleep(0.02)
+            return mode
+
+        mode_dict = lazy_modes.LazyModeDict(MODES, read_mode)
+        threads = [threading.Thread(target=mode_dict.__getitem__, args=((2, 2),)) for _ in range(6)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert reads == [(2, 2)]
+
+    def test_split_mode_dict(self):
+        reads = []
+        mode_dict = lazy_modes.LazyModeDict(MODES, lambda mode: reads.append(mode) or (mode[0], mode[1] * 2))
+        first, second = lazy_modes.split_mode_dict(mode_dict, 2)
+        assert first[(4, 4)] == 4 and second[(4, 4)] == 8
+        assert reads == [(4, 4)]
+        assert list(second) == MODES
+
+    def test_on_complete_is_called_once_after_the_last_mode(self):
+        completed = []
+        mode_dict = lazy_modes.LazyModeDict(MODES, lambda mode: mode, on_complete=lambda: completed.append(True))
+        mode_dict[(2, 2)]
+        mode_dict[(3, 3)]
+        mode_dict[(3, 3)]
+        assert completed == []
+        lazy_modes.read_modes([mode_dict], MODES, 3)
+        mode_dict[(4, 4)]
+        assert completed == [True]
+
+
+@pytest.fixture
+def spline_h5(tmp_path):
+    """Small h5 file in the layout of BHPTNRSur1dq1e4.h5."""
+    rng = np.random.default_rng(1)
+    x = np.linspace(0.4, 4.0, 15)
+    n_times = 50
+    with h5py.File(tmp_path / 'toy.h5', 'w') as f:
+        for (l, m) in MODES:
+            # (datapiece, suffix of the EIM indices and B matrix)
+            pieces = [('amp', ''), ('phase', '_phase')] if (l, m) == (2, 2) else [('re', ''), ('im', '_im')]
+            g = f.create_group('l%s_m%s' % (l, m))
+            g['times'] = np.linspace(-100, 10, n_times)
+            g['degree'] = np.array([3])
+            for piece, suffix in pieces:
+                knots, coefs, _ = splrep(x, np.sin(x * l + m), k=3)
+                g['eim_indices' + suffix] = np.arange(3)
+                g['B' + suffix] = rng.normal(size=(n_times, 3))
+                g['spline_knots_' + piece] = np.tile(knots, (3, 1))
+                g['fitparams_' + piece] = np.tile(coefs, (3, 1)) + rng.normal(size=(3, len(coefs)))
+        for mode in [(2, 2), (3, 3)]:
+            f['nr_calib_params/(%d,%d)/alpha' % mode] = rng.normal(size=4)
+        f['nr_calib_params/(2,2)/beta'] = rng.normal(size=4)
+    return str(tmp_path), 'toy.h5'
+
+
+class TestOpenSurrogate:
+    def test_matches_load_surrogate(self, spline_h5):
+        h5_data_dir, fname = spline_h5
+        eager = load_splines.load_surrogate(h5_data_dir, fname, MODES, [(2, 2), (3, 3)])
+        lazy = load_splines.open_surrogate(h5_data_dir, fname, MODES, [(2, 2), (3, 3)])
+
+        np.testing.assert_array_equal(lazy[0], eager[0])
+        assert lazy[1].loaded_modes() == []
+        for mode in MODES:
+            for B_lazy, B_eager in [(lazy[3], eager[3]), (lazy[4], eager[4])]:
+                np.testing.assert_array_equal(B_lazy[mode], B_eager[mode])
+            for fit_lazy, fit_eager in [(lazy[1], eager[1]), (lazy[2], eager[2])]:
+                np.testing.assert_array_equal(fit_lazy[mode][1], fit_eager[mode][1])
+                for (t_l, c_l, k_l), (t_e, c_e, k_e) in zip(fit_lazy[mode][0], fit_eager[mode][0]):
+                    np.testing.assert_array_equal(t_l, t_e)
+                    np.testing.assert_array_equal(c_l, c_e)
+                    assert k_l == k_e
+        np.testing.assert_array_equal(lazy[6], eager[6])
+
+    def test_reads_only_requested_modes(self, spline_h5):
+        h5_data_dir, fname = spline_h5
+        _, fit_data_dict_1, fit_data_dict_2, B_dict_1, B_dict_2, _, _ = \
+            load_splines.open_surrogate(h5_data_dir, fname, MODES, [(2, 2)])
+        B_dict_2[(3, 3)]
+        for mode_dict in [fit_data_dict_1, fit_data_dict_2, B_dict_1]:
+            assert mode_dict.loaded_modes() == []
+        assert B_dict_2.loaded_modes() == [(3, 3)]
+
+    def test_parallel_ingestion_matches_sequential(self, spline_h5):
+        h5_data_dir, fname = spline_h5
+        sequential = load_splines.load_surrogate(h5_data_dir, fname, MODES, [(2, 2)], workers=1)
+        for load_func in [load_splines.load_surrogate, load_splines.open_surrogate]:
+            parallel = load_func(h5_data_dir, fname, MODES, [(2, 2)], workers=4)
+            for mode in MODES:
+                np.testing.assert_array_equal(parallel[3][mode], sequential[3][mode])
+                np.testing.assert_array_equal(parallel[2][mode][1], sequential[2][mode][1])
+        # all modes were read right away
+        assert parallel[1].loaded_modes() == MODES
+
+    def test_file_is_closed_once_all_modes_are_read(self, spline_h5):
+        h5_data_dir, fname = spline_h5
+
+        def n_open_files():
+            return h5py.h5f.get_obj_count(types=h5py.h5f.OBJ_FILE)
+
+        n_open = n_open_files()
+        _, fit_data_dict_1, _, B_dict_1, _, _, _ = \
+            load_splines.open_surrogate(h5_data_dir, fname, MODES, [(2, 2)])
+        B_dict_1[(2, 2)]
+        fit_data_dict_1[(3, 3)]
+        assert n_open_files() == n_open + 1
+        B_dict_1[(4, 4)]
+        assert n_open_files() == n_open
+        # with several workers all modes are read right away
+        load_splines.open_surrogate(h5_data_dir, fname, MODES, [(2, 2)], workers=2)
+        assert n_open_files() == n_open
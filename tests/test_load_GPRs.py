@@ -0,0 +1,82 @@
+"""Tests for reading the GPR fit settings from the h5 files"""
+
+import h5py
+import numpy as np
+import pytest
+
+from BHPTNRSurrogate.surrogates.common_utils import load_GPRs
+
+
+def _chars(string):
+    return np.array([ord(c) for c in string])
+
+
+def _write_node(node, rng, n_train):
+    node['data_mean'] = rng.normal()
+    node['data_std'] = rng.normal()
+    node['lin_reg_params/coef_'] = rng.normal(size=2)
+    node['lin_reg_params/intercept_'] = rng.normal()
+    params = node.create_group('GPR_params')
+    params['X_train_'] = rng.normal(size=(n_train, 2))
+    params['alpha_'] = rng.normal(size=n_train)
+    params['_y_train_mean'] = rng.normal()
+    params['L_'] = rng.normal(size=(n_train, n_train))
+    # not part of the GPR settings
+    params['unused'] = rng.normal(size=3)
+    for group, keys in load_GPRs._GPR_NODE_DATASETS:
+        if not group.startswith('GPR_params/kernel_'):
+            continue
+        for key in keys:
+            path = '%s/%s' % (group, key)
+            if key == 'name':
+                node[path] = _chars('Product')
+            elif key.endswith('_bounds'):
+                node[path] = rng.uniform(size=(2, 2))
+            elif key.endswith('length_scale'):
+                node[path] = rng.uniform(size=2)
+            else:
+                node[path] = rng.uniform()
+
+
+@pytest.fixture
+def gpr_h5(tmp_path):
+    """ gpr_amp group of a toy mode with three nodes, the last with a different training set size """
+    rng = np.random.default_rng(3)
+    with h5py.File(tmp_path / 'toy.h5', 'w') as f:
+        group = f.create_group('l2_m2/gpr_amp')
+        group['fitType'] = _chars('GPR_fit')
+        for i, n_train in enumerate([4, 4, 5]):
+            _write_node(group.create_group('node%d' % i), rng, n_train)
+    with h5py.File(tmp_path / 'toy.h5', 'r') as f:
+        yield f['l2_m2/gpr_amp']
+
+
+def _assert_same(a, b):
+    if isinstance(a, dict):
+        assert a.keys() == b.keys()
+        for key in a:
+            _assert_same(a[key], b[key])
+    elif isinstance(a, str):
+        assert a == b
+    else:
+        assert type(a) is type(b)
+        assert np.shape(a) == np.shape(b) and np.asarray(a).dtype == np.asarray(b).dtype
+        np.testing.assert_array_equal(a, b)
+
+
+def test_read_gpr_settings_matches_extract(gpr_h5):
+    expected = {}
+    load_GPRs.extract_h5filegprsettings_to_emptydict(expected, dict(gpr_h5), 3)
+    _assert_same(expected, load_GPRs.read_gpr_settings(gpr_h5, 3))
+
+
+def test_read_gpr_settings_stacks_nodes(gpr_h5):
+    h_gpr = load_GPRs.read_gpr_settings(gpr_h5, 3)
+    coef_0 = h_gpr['node0']['lin_reg_params']['coef_']
+    coef_1 = h_gpr['node1']['lin_reg_params']['coef_']
+    # rows of one buffer
+    assert coef_0.base is not None and coef_0.base is coef_1.base
+    # the last node does not fit the stacked training data
+    X_train_2 = h_gpr['node2']['GPR_params']['X_train_']
+    assert X_train_2.shape == (5, 2)
+    assert X_train_2.base is not h_gpr['node0']['GPR_params']['X_train_'].base
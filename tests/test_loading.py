@@ -0,0 +1,154 @@
+"""Tests of the lazy loading of the surrogate data (no h5 data needed)."""
+
+import threading
+import time
+from unittest.mock import patch
+
+import pytest
+
+from BHPTNRSurrogate.surrogates import BHPTNRSur1dq1e4, BHPTNRSur2dq1e3
+
+
+@pytest.fixture(params=[BHPTNRSur1dq1e4, BHPTNRSur2dq1e3], ids=lambda m: m.__name__.rsplit('.')[-1])
+def model(request):
+    with patch.object(request.param.load, 'check_h5_file', lambda model_name, h5_data_dir: 'abc'):
+        yield request.param
+
+
+def _slow_loader(calls, keys):
+    def load_surrogate_data(model_name, h5_data_dir, parse_h5, mmap=None, part=None, file_hash=None):
+        calls.append(mmap)
+        time.sleep(0.05)
+        if part is not None:
+            # a sub-surrogate of BHPTNRSur2dq1e3
+            return {key: object() for key in BHPTNRSur2dq1e3._SUB_SURROGATE_KEYS.values()}
+        return {key: object() for key in keys}
+    return load_surrogate_data
+
+
+class TestSingleFlightLoading:
+    def test_concurrent_first_calls_load_once(self, model):
+        calls, seen = [], []
+        start = threading.Barrier(8)
+
+        def worker():
+            start.wait()
+            model._ensure_loaded()
+            seen.append(set(model._surrogate_data))
+
+        with patch.object(model, '_surrogate_data', {}), \
+             patch.object(model.load, 'load_surrogate_data', _slow_loader(calls, model._SURROGATE_KEYS)):
+            threads = [threading.Thread(target=worker) for _ in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        assert len(calls) == 1
+        assert seen == [set(model._SURROGATE_KEYS)] * 8
+
+    def test_preload(self, model):
+        calls = []
+        with patch.object(model, '_surrogate_data', {}), \
+             patch.object(model.load, 'load_surrogate_data', _slow_loader(calls, model._SURROGATE_KEYS)):
+            model.preload(mmap=True)
+            model.preload()
+            assert set(model._surrogate_data) == set(model._SURROGATE_KEYS)
+        # with mmap=True, both sub-surrogates of BHPTNRSur2dq1e3 are loaded as well
+        assert calls == [True] * (1 + len(getattr(model, '_SPIN_SIGNS', ())))
+
+    def test_failed_load_leaves_no_partial_data(self, model):
+        def failing_loader(*args, **kwargs):
+            raise OSError("h5 file unavailable")
+
+        data = {}
+        with patch.object(model, '_surrogate_data', data), \
+             patch.object(model.load, 'load_surrogate_data', failing_loader):
+            with pytest.raises(OSError):
+                model.preload()
+        assert data == {}
+
+
+class TestSubSurrogates:
+    def test_spin_signs_are_loaded_independently(self):
+        model = BHPTNRSur2dq1e3
+        parts = []
+
+        def load_surrogate_data(model_name, h5_data_dir, parse_h5, mmap=None, part=None, file_hash=None):
+            parts.append(part)
+            assert file_hash == 'abc'
+            if part is None:
+                return {'alpha_coeffs': {}, 'beta_coeffs': None}
+            return {'times': part, 'fit_data_dict_1': {}, 'fit_data_dict_2': {}, 'B_dict_1': {},
+                    'B_dict_2': {}, 'packed_fits': {}}
+
+        with patch.object(model, '_surrogate_data', {}), \
+             patch.object(model.load, 'check_h5_file', lambda model_name, h5_data_dir: 'abc'), \
+             patch.object(model.load, 'load_surrogate_data', load_surrogate_data):
+            model.preload()
+            assert parts == [None]
+            assert model._surrogate_data['times_dict']['positive_spin'] == 'positive_spin'
+            assert model._surrogate_data['B_dict_1_sign']['positive_spin'] == {}
+            assert parts == [None, 'positive_spin']
+            assert set(model._surrogate_data) == set(model._SURROGATE_KEYS)
+
+    def test_preload_with_workers_loads_both_spin_signs(self):
+        model = BHPTNRSur2dq1e3
+        parts = []
+
+        def load_surrogate_data(model_name, h5_data_dir, parse_h5, mmap=None, part=None, file_hash=None):
+            parts.append(part)
+            if part is None:
+                return {'alpha_coeffs': {}, 'beta_coeffs': None}
+            # the worker count reaches the h5 parser of the sub-surrogate
+            assert parse_h5.keywords['workers'] == 2
+            return {'times': part}
+
+        with patch.object(model, '_surrogate_data', {}), \
+             patch.object(model.load, 'check_h5_file', lambda model_name, h5_data_dir: 'abc'), \
+             patch.object(model.load, 'load_surrogate_data', load_surrogate_data):
+            model.preload(workers=2)
+            assert sorted(parts[1:]) == ['negative_spin', 'positive_spin']
+
+    @pytest.mark.parametrize("use_env", [False, True])
+    def test_preload_with_mmap_loads_both_spin_signs(self, monkeypatch, use_env):
+        model = BHPTNRSur2dq1e3
+        parts = []
+
+        def load_surrogate_data(model_name, h5_data_dir, parse_h5, mmap=None, part=None, file_hash=None):
+            parts.append(part)
+            return {'alpha_coeffs': {}, 'beta_coeffs': None} if part is None else {'times': part}
+
+        monkeypatch.delenv('BHPTNRSUR_LOAD_WORKERS', raising=False)
+        monkeypatch.delenv('BHPTNRSUR_MMAP', raising=False)
+        if use_env:
+            monkeypatch.setenv('BHPTNRSUR_MMAP', '1')
+        with patch.object(model, '_surrogate_data', {}), \
+             patch.object(model.load, 'check_h5_file', lambda model_name, h5_data_dir: 'abc'), \
+             patch.object(model.load, 'load_surrogate_data', load_surrogate_data):
+            model.preload(mmap=None if use_env else True)
+            # both caches are compiled before worker processes map them
+            assert sorted(parts[1:]) == ['negative_spin', 'positive_spin']
+
+
+class TestPreloadAsync:
+    def test_returns_future_and_loads_once(self, model):
+        calls = []
+        with patch.object(model, '_surrogate_data', {}), \
+             patch.object(model.load, 'load_surrogate_data', _slow_loader(calls, model._SURROGATE_KEYS)):
+            future = model.preload_async()
+            # a waveform call in the meantime waits for the background load
+            model._ensure_loaded()
+            assert set(model._surrogate_data) == set(model._SURROGATE_KEYS)
+            assert future.result(timeout=5) is None
+        assert len(calls) == 1
+
+    def test_exception_is_set_on_future(self, model):
+        def failing_loader(*args, **kwargs):
+            raise OSError("h5 file unavailable")
+
+        with patch.object(model, '_surrogate_data', {}), \
+             patch.object(model.load, 'load_surrogate_data', failing_loader):
+            future = model.preload_async()
+            with pytest.raises(OSError, match="unavailable"):
+                future.result(timeout=5)
@@ -0,0 +1,72 @@
+"""Tests of the concurrent mode evaluation helpers"""
+
+import os
+import signal
+import threading
+
+import pytest
+
+from BHPTNRSurrogate.surrogates.common_utils import parallel_eval
+
+
+def test_n_workers(monkeypatch):
+    monkeypatch.delenv('BHPTNRSUR_EVAL_WORKERS', raising=False)
+    assert parallel_eval.n_workers() == 1
+    assert parallel_eval.n_workers(3) == 3
+    monkeypatch.setenv('BHPTNRSUR_EVAL_WORKERS', '4')
+    assert parallel_eval.n_workers() == 4
+    assert parallel_eval.n_workers(2) == 2
+    with pytest.raises(ValueError):
+        parallel_eval.n_workers(0)
+
+
+def test_for_each_keeps_order_and_uses_threads():
+    threads = set()
+
+    def func(i, item):
+        threads.add(threading.current_thread().name)
+        return (i, 2 * item)
+
+    assert parallel_eval.for_each(func, range(20), 4, start=5) == [(i + 5, 2 * i) for i in range(20)]
+    assert threading.current_thread().name not in threads
+
+    threads.clear()
+    assert parallel_eval.for_each(func, [1, 2], 1) == [(0, 2), (1, 4)]
+    assert threads == {threading.current_thread().name}
+
+
+def test_executor_is_shared_and_errors_propagate():
+    assert parallel_eval.executor(3) is parallel_eval.executor(3)
+
+    def func(i, item):
+        if item == 7:
+            raise KeyError(item)
+
+    with pytest.raises(KeyError):
+        parallel_eval.for_each(func, range(10), 3)
+
+
+@pytest.mark.skipif(not hasattr(os, 'fork'), reason="needs os.fork")
+def test_pools_work_after_fork():
+    def func(i, item):
+        return 2 * item
+
+    # both threads of the pool run in the parent before the fork
+    both_running = threading.Barrier(2)
+
+    def wait_for_both(i, item):
+        both_running.wait(timeout=10)
+        return item
+
+    assert parallel_eval.for_each(wait_for_both, range(2), 2) == [0, 1]
+    r, w = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        # the pool of the parent has no threads in the child
+        signal.alarm(10)
+        ok = parallel_eval.for_each(func, range(6), 2) == [0, 2, 4, 6, 8, 10]
+        os.write(w, b'1' if ok else b'0')
+        os._exit(0)
+    os.close(w)
+    _, status = os.waitpid(pid, 0)
+    assert os.read(r, 1) == b'1' and status == 0
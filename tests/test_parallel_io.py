@@ -0,0 +1,42 @@
+"""Tests of the concurrent ingestion helpers"""
+
+import threading
+
+import pytest
+
+from BHPTNRSurrogate.surrogates.common_utils import parallel_io
+
+
+def test_n_workers(monkeypatch):
+    monkeypatch.delenv('BHPTNRSUR_LOAD_WORKERS', raising=False)
+    assert parallel_io.n_workers() == 1
+    assert parallel_io.n_workers(3) == 3
+    monkeypatch.setenv('BHPTNRSUR_LOAD_WORKERS', '4')
+    assert parallel_io.n_workers() == 4
+    assert parallel_io.n_workers(2) == 2
+    with pytest.raises(ValueError):
+        parallel_io.n_workers(0)
+
+
+def test_read_all_keeps_order_and_uses_threads():
+    threads = set()
+
+    def read_item(item):
+        threads.add(threading.current_thread().name)
+        return item * 2
+
+    result = parallel_io.read_all(read_item, range(20), 4)
+    assert list(result.items()) == [(i, 2 * i) for i in range(20)]
+    assert threading.current_thread().name not in threads
+
+    threads.clear()
+    assert parallel_io.read_all(read_item, [1, 2], 1) == {1: 2, 2: 4}
+    assert threads == {threading.current_thread().name}
+
+
+def test_prefetch_file(tmp_path):
+    path = tmp_path / 'data.bin'
+    data = bytes(range(256)) * 1000
+    path.write_bytes(data)
+    parallel_io.prefetch_file(str(path), 4, chunk_size=1000)
+    assert path.read_bytes() == data
@@ -0,0 +1,194 @@
+"""Unit tests for surrogates/common_utils/surrogate_cache.py (no h5 data needed)."""
+
+import os
+
+import numpy as np
+import pytest
+
+from BHPTNRSurrogate.surrogates.common_utils import surrogate_cache
+from BHPTNRSurrogate.surrogates.model_utils import load_surrogates
+
+
+@pytest.fixture
+def data():
+    """Nested data in the layout of the parsed surrogate data."""
+    rng = np.random.default_rng(0)
+    B = rng.normal(size=(4, 7))
+    return {
+        'time': np.linspace(-10, 1, 7),
+        'B_dict_1': {(2, 2): B.T, (3, 3): B[:2]},
+        'fit_data_dict_1': {(2, 2): [[(rng.normal(size=9), rng.normal(size=9), 3)], np.arange(1)],
+                            (3, 3): [{'node0': {'fitType': 'GPR', 'data_mean': np.float64(0.5)}},
+                                     np.arange(1), [len]]},
+        'packed_fits': {'fit_func': 'spline_1d', 'n_nodes': 5,
+                        'offsets': {(0, (2, 2)): (0, 3), (1, (2, 2)): (3, 5)}},
+        'beta_coeffs': np.array(1.25),
+        'alpha_coeffs': {(2, 2): rng.normal(size=3).astype(np.float32)},
+    }
+
+
+def _assert_same(a, b):
+    assert type(a) is type(b)
+    if isinstance(a, dict):
+        assert list(a.keys()) == list(b.keys())
+        for key in a:
+            _assert_same(a[key], b[key])
+    elif isinstance(a, (list, tuple)):
+        assert len(a) == len(b)
+        for x, y in zip(a, b):
+            _assert_same(x, y)
+    elif isinstance(a, np.ndarray):
+        assert a.dtype == b.dtype and a.shape == b.shape
+        np.testing.assert_array_equal(a, b)
+    else:
+        assert a == b
+
+
+class TestRoundTrip:
+    def test_round_trip(self, data, tmp_path):
+        path = str(tmp_path / 'model.abc.sur')
+        surrogate_cache.write_cache(path, data, 'model', 'abc')
+        loaded = surrogate_cache.read_cache(path, 'model', 'abc')
+
+        # evaluators are not stored
+        assert loaded['fit_data_dict_1'][(3, 3)][2] is None
+        data['fit_data_dict_1'][(3, 3)][2] = None
+        _assert_same(loaded, data)
+
+    def test_arrays_are_aligned_and_keep_memory_order(self, data, tmp_path):
+        path = str(tmp_path / 'model.abc.sur')
+        surrogate_cache.write_cache(path, data, 'model', 'abc')
+        loaded = surrogate_cache.read_cache(path, 'model', 'abc')
+        assert loaded['B_dict_1'][(2, 2)].flags.f_contiguous
+        _, data_start = surrogate_cache.read_header(path)
+        assert data_start % surrogate_cache.ALIGNMENT == 0
+        assert loaded['time'].ctypes.data % 8 == 0
+
+    @pytest.mark.parametrize("model_name, file_hash", [('other', 'abc'), ('model', 'def')])
+    def test_stale_cache_is_ignored(self, data, tmp_path, model_name, file_hash):
+        path = str(tmp_path / 'model.abc.sur')
+        surrogate_cache.write_cache(path, data, 'model', 'abc')
+        assert surrogate_cache.read_cache(path, model_name, file_hash) is None
+
+    def test_other_format_version_is_ignored(self, data, tmp_path, monkeypatch):
+        path = str(tmp_path / 'model.abc.sur')
+        surrogate_cache.write_cache(path, data, 'model', 'abc')
+        monkeypatch.setattr(surrogate_cache, 'FORMAT_VERSION', surrogate_cache.FORMAT_VERSION + 1)
+        assert surrogate_cache.read_cache(path, 'model', 'abc') is None
+
+    def test_missing_cache(self, tmp_path):
+        assert surrogate_cache.read_cache(str(tmp_path / 'none.sur'), 'model', 'abc') is None
+
+    def test_unsupported_object_raises(self, tmp_path):
+        with pytest.raises(TypeError, match="Cannot store"):
+            surrogate_cache.write_cache(str(tmp_path / 'x.sur'), {'a': {1, 2}}, 'model', 'abc')
+        assert list(tmp_path.iterdir()) == []
+
+    def test_mmap_views_are_read_only(self, data, tmp_path):
+        path = str(tmp_path / 'model.abc.sur')
+        surrogate_cache.write_cache(path, data, 'model', 'abc')
+        loaded = surrogate_cache.read_cache(path, 'model', 'abc', mmap=True)
+        B = loaded['B_dict_1'][(3, 3)]
+        assert isinstance(B.base, np.memmap)
+        assert not B.flags.writeable
+        np.testing.assert_array_equal(B, data['B_dict_1'][(3, 3)])
+
+    def test_cache_is_readable_by_other_users(self, data, tmp_path):
+        path = str(tmp_path / 'model.abc.sur')
+        umask = os.umask(0o022)
+        try:
+            surrogate_cache.write_cache(path, data, 'model', 'abc')
+        finally:
+            os.umask(umask)
+        assert os.stat(path).st_mode & 0o777 == 0o644
+
+    @pytest.mark.parametrize("size", [4, 12, 40, -8])
+    def test_damaged_cache_is_ignored(self, data, tmp_path, size):
+        path = str(tmp_path / 'model.abc.sur')
+        surrogate_cache.write_cache(path, data, 'model', 'abc')
+        with open(path, 'r+b') as f:
+            # cut into the magic, the header length, the header or the array data
+            f.truncate(size if size > 0 else os.path.getsize(path) + size)
+        for mmap in [False, True]:
+            assert surrogate_cache.read_cache(path, 'model', 'abc', mmap=mmap) is None
+        with open(path, 'wb') as f:
+            f.write(b'not a cache file')
+        assert surrogate_cache.read_cache(path, 'model', 'abc') is None
+
+    def test_unreadable_cache_is_ignored(self, data, tmp_path, monkeypatch):
+        path = str(tmp_path / 'model.abc.sur')
+        surrogate_cache.write_cache(path, data, 'model', 'abc')
+
+        def permission_denied(*args, **kwargs):
+            raise PermissionError(13, 'Permission denied', path)
+
+        monkeypatch.setattr(surrogate_cache, 'open', permission_denied, raising=False)
+        assert surrogate_cache.read_cache(path, 'model', 'abc') is None
+
+
+
+class TestPackContiguous:
+    def test_arrays_share_one_read_only_buffer(self, data):
+        packed = surrogate_cache.pack_contiguous(data)
+        data['fit_data_dict_1'][(3, 3)][2] = None
+        _assert_same(packed, data)
+
+        arrays = [packed['time'], packed['B_dict_1'][(2, 2)], packed['fit_data_dict_1'][(2, 2)][0][0][0]]
+        assert len({id(array.base) for array in arrays}) == 1
+        assert all(not array.flags.writeable for array in arrays)
+        assert all(array.ctypes.data % surrogate_cache.ALIGNMENT == 0 for array in arrays)
+        assert packed['B_dict_1'][(2, 2)].flags.f_contiguous
+
+    def test_mapped_arrays_are_kept(self, data, tmp_path):
+        path = str(tmp_path / 'model.abc.sur')
+        surrogate_cache.write_cache(path, data, 'model', 'abc')
+        loaded = surrogate_cache.read_cache(path, 'model', 'abc', mmap=True)
+        loaded['packed_fits'][(2, 2)] = {'coefs': np.ones(3)}
+        packed = surrogate_cache.pack_contiguous(loaded)
+        assert packed['time'] is loaded['time']
+        assert not isinstance(packed['packed_fits'][(2, 2)]['coefs'].base, np.memmap)
+
+
+class TestLoadSurrogateData:
+    @pytest.fixture
+    def h5_data_dir(self, tmp_path, monkeypatch):
+        monkeypatch.delenv('BHPTNRSUR_CACHE_DIR', raising=False)
+        monkeypatch.delenv('BHPTNRSUR_MMAP', raising=False)
+        monkeypatch.setattr(load_surrogates, 'check_h5_file', lambda model_name, h5_data_dir: 'abc')
+        return str(tmp_path)
+
+    def test_parses_h5_without_cache(self, data, h5_data_dir):
+        calls = []
+        parse_h5 = lambda h5_data_dir: calls.append(h5_data_dir) or data
+        assert load_surrogates.load_surrogate_data('model', h5_data_dir, parse_h5) is data
+        assert calls == [h5_data_dir]
+
+    def test_reads_compiled_cache(self, data, h5_data_dir):
+        path = load_surrogates.compile_surrogate_data('model', h5_data_dir, lambda d: data)
+        assert path == surrogate_cache.cache_path(h5_data_dir, 'model', 'abc')
+        loaded = load_surrogates.load_surrogate_data('model', h5_data_dir, None)
+        np.testing.assert_array_equal(loaded['time'], data['time'])
+
+    @pytest.mark.parametrize("use_env", [False, True])
+    def test_mmap_compiles_cache(self, data, h5_data_dir, monkeypatch, use_env):
+        if use_env:
+            monkeypatch.setenv('BHPTNRSUR_MMAP', '1')
+        loaded = load_surrogates.load_surrogate_data('model', h5_data_dir, lambda d: data,
+                                                     mmap=None if use_env else True)
+        assert isinstance(loaded['time'].base, np.memmap)
+        assert loaded['time'].base.filename == surrogate_cache.cache_path(h5_data_dir, 'model', 'abc')
+
+    def test_mmap_falls_back_when_cache_is_not_writable(self, data, h5_data_dir, monkeypatch):
+        def write_cache(*args):
+            raise PermissionError("read-only file system")
+        monkeypatch.setattr(surrogate_cache, 'write_cache', write_cache)
+        with pytest.warns(UserWarning, match="not memory-mapped"):
+            loaded = load_surrogates.load_surrogate_data('model', h5_data_dir, lambda d: data, mmap=True)
+        assert loaded is data
+
+
+def test_cache_dir_env(monkeypatch, tmp_path):
+    monkeypatch.setenv('BHPTNRSUR_CACHE_DIR', str(tmp_path))
+    assert surrogate_cache.cache_path('/data', 'model', 'abc') == str(tmp_path / 'model.abc.sur')
+    monkeypatch.delenv('BHPTNRSUR_CACHE_DIR')
+    assert surrogate_cache.cache_path('/data', 'model', 'abc') == '/data/model.abc.sur'
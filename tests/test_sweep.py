@@ -0,0 +1,170 @@
+"""Tests of the process-pool parameter sweeps"""
+
+import os
+import sys
+import types
+
+import numpy as np
+import pytest
+
+from BHPTNRSurrogate.surrogates.model_utils import sweep
+
+
+@pytest.fixture
+def fake_model(monkeypatch):
+    """ A model module whose batch evaluation returns its inputs """
+    model = types.ModuleType('fake_sweep_model')
+    model.preloads = []
+    model.preload = lambda mmap=None: model.preloads.append(mmap)
+
+    def generate_surrogate_batch(q, spin1=0.0, M_tot=None, orb_phase=None, modes=None):
+        if np.any(q < 0):
+            raise ValueError("negative q")
+        t = np.tile(np.arange(3.0), (len(q), 1))
+        return t, {'q': q, 'spin1': spin1, 'M_tot': M_tot, 'orb_phase': orb_phase,
+                   'modes': modes, 'pid': os.getpid()}
+
+    model.generate_surrogate_batch = generate_surrogate_batch
+    # worker processes find the model by its name
+    monkeypatch.setitem(sys.modules, model.__name__, model)
+    return model
+
+
+def test_chunks_in_process(fake_model):
+    q = np.arange(1.0, 11.0)
+    results = list(sweep.sweep(fake_model, q, spin1=0.5, chunk_size=4, processes=1,
+                               M_tot=np.arange(10.0), orb_phase=0.3, modes=[(2, 2)]))
+    assert fake_model.preloads == [True]
+    assert [rows for rows, t, h in results] == [slice(0, 4), slice(4, 8), slice(8, 10)]
+    for rows, t, h in results:
+        assert t.shape == (len(q[rows]), 3)
+        np.testing.assert_array_equal(h['q'], q[rows])
+        np.testing.assert_array_equal(h['spin1'], 0.5)
+        np.testing.assert_array_equal(h['M_tot'], np.arange(10.0)[rows])
+        assert h['orb_phase'] == 0.3 and h['modes'] == [(2, 2)]
+        assert h['pid'] == os.getpid()
+
+
+@pytest.mark.parametrize('ordered', [True, False])
+def test_process_pool(fake_model, ordered):
+    q = np.arange(1.0, 21.0)
+    results = list(sweep.sweep(fake_model, q, chunk_size=3, processes=2, ordered=ordered,
+                               mmap=False, mp_context='fork', M_tot=5.0))
+    if ordered:
+        assert [rows.start for rows, t, h in results] == list(range(0, 20, 3))
+    else:
+        results.sort(key=lambda result: result[0].start)
+    np.testing.assert_array_equal(np.concatenate([h['q'] for rows, t, h in results]), q)
+    assert all(h['M_tot'] == 5.0 for rows, t, h in results)
+    assert os.getpid() not in {h['pid'] for rows, t, h in results}
+
+
+def test_invalid_inputs(fake_model):
+    with pytest.raises(ValueError):
+        sweep.sweep(fake_model, np.ones(5), M_tot=np.ones(4))
+    with pytest.raises(ValueError):
+        sweep.sweep(fake_model, np.ones(5), chunk_size=0)
+    with pytest.raises(ValueError):
+        sweep.sweep(fake_model, np.ones(5), processes=0)
+
+
+@pytest.mark.parametrize('params', [
+    [1.0, 2.0, 3.0, 4.0, 5.0],
+    [(1.0, 0.1), (2.0, 0.2), (3.0, 0.3), (4.0, 0.4), (5.0, 0.5)],
+    [{'q': q, 'spin1': q / 10, 'M_tot': 10 * q} for q in [1.0, 2.0, 3.0, 4.0, 5.0]],
+])
+def test_stream_rows(fake_model, params):
+    results = list(sweep.stream(fake_model, iter(params), chunk_size=2, processes=1))
+    assert [rows for rows, t, h in results] == [slice(0, 2), slice(2, 4), slice(4, 5)]
+    q = np.concatenate([h['q'] for rows, t, h in results])
+    np.testing.assert_array_equal(q, [1.0, 2.0, 3.0, 4.0, 5.0])
+    if not np.isscalar(params[0]):
+        np.testing.assert_allclose(np.concatenate([h['spin1'] for rows, t, h in results]), q / 10)
+    if isinstance(params[0], dict):
+        np.testing.assert_array_equal(np.concatenate([h['M_tot'] for rows, t, h in results]), 10 * q)
+
+
+def test_stream_chunks(fake_model):
+    chunks = [{'q': np.arange(1.0, 4.0), 'spin1': 0.2}, {'q': np.arange(4.0, 6.0), 'M_tot': [1.0, 2.0]}]
+    results = list(sweep.stream_chunks(fake_model, chunks, processes=1, orb_phase=0.5))
+    assert [rows for rows, t, h in results] == [slice(0, 3), slice(3, 5)]
+    np.testing.assert_array_equal(results[0][2]['spin1'], [0.2] * 3)
+    np.testing.assert_array_equal(results[1][2]['M_tot'], [1.0, 2.0])
+    assert results[1][2]['orb_phase'] == 0.5
+
+    with pytest.raises(ValueError, match="Unknown"):
+        list(sweep.stream_chunks(fake_model, [{'q': [1.0], 'ecc': [0.1]}], processes=1))
+    with pytest.raises(ValueError):
+        list(sweep.stream(fake_model, [1.0, {'q': 2.0}], processes=1))
+
+
+@pytest.mark.parametrize('ordered', [True, False])
+def test_back_pressure(fake_model, ordered):
+    consumed = []
+
+    def params():
+        for q in range(1, 41):
+            consumed.append(q)
+            yield float(q)
+
+    n_waveforms = 0
+    for rows, t, h in sweep.stream(fake_model, params(), chunk_size=2, processes=2, ordered=ordered,
+                                   max_pending=3, mmap=False, mp_context='fork'):
+        # only the chunks submitted and not yet consumed have been read from the parameters
+        n_waveforms += len(h['q'])
+        assert len(consumed) <= n_waveforms + 3 * 2
+    assert n_waveforms == 40
+
+
+@pytest.mark.parametrize('ordered', [True, False])
+def test_worker_errors_propagate(fake_model, ordered):
+    with pytest.raises(ValueError, match="negative q"):
+        list(sweep.sweep(fake_model, [1.0, 2.0, -1.0, 3.0], chunk_size=1, processes=2,
+                         ordered=ordered, mmap=False, mp_context='fork'))
+
+
+@pytest.mark.parametrize('mp_context', ['fork', 'spawn'])
+def test_model_loaded_without_mmap(fake_model, mp_context):
+    compiled = []
+    fake_model.compile_surrogate = lambda: compiled.append(True)
+    fake_model._surrogate_data = {'B_dict_1': {(2, 2): np.ones(3)}}
+    with pytest.warns(UserWarning, match="loaded without mmap"):
+        context = sweep._preload(fake_model, 2, True, mp_context)
+    assert context.get_start_method() == mp_context
+    # spawned workers map the compiled cache, forked workers inherit the loaded data
+    assert compiled == ([] if mp_context == 'fork' else [True])
+
+
+def test_mapped_model_is_not_compiled(fake_model, tmp_path, recwarn):
+    fake_model.compile_surrogate = lambda: pytest.fail("compiled again")
+    np.ones(3).tofile(str(tmp_path / 'B.bin'))
+    fake_model._surrogate_data = {'B_dict_1': {(2, 2): np.memmap(str(tmp_path / 'B.bin'), mode='r')}}
+    sweep._preload(fake_model, 2, True, 'spawn')
+    # in this process or without mmap, nothing is shared
+    fake_model._surrogate_data = {'B_dict_1': {(2, 2): np.ones(3)}}
+    sweep._preload(fake_model, 1, True, 'spawn')
+    sweep._preload(fake_model, 2, False, 'spawn')
+    assert len(recwarn) == 0
+
+
+@pytest.mark.slow
+def test_real_model_per_waveform_extrinsics(model_1d):
+    q = np.array([5.0, 20.0, 50.0])
+    M_tot, inclination = np.array([50.0, 60.0, 70.0]), np.array([0.3, 1.0, 2.0])
+    refs = [model_1d.generate_surrogate(q=q[i], modes=[(2, 2), (3, 3)], M_tot=M_tot[i], dist_mpc=100.0,
+                                        orb_phase=0.4, inclination=inclination[i]) for i in range(len(q))]
+    rows = [{'q': q[i], 'M_tot': M_tot[i], 'inclination': inclination[i]} for i in range(len(q))]
+    for results in [sweep.sweep(model_1d, q, chunk_size=2, processes=1, modes=[(2, 2), (3, 3)],
+                                M_tot=M_tot, dist_mpc=100.0, orb_phase=0.4, inclination=inclination),
+                    sweep.stream(model_1d, rows, chunk_size=2, processes=1, modes=[(2, 2), (3, 3)],
+                                 dist_mpc=100.0, orb_phase=0.4)]:
+        n_waveforms = 0
+        for chunk_rows, t, h in results:
+            for j, i in enumerate(range(len(q))[chunk_rows]):
+                t_ref, h_ref = refs[i]
+                np.testing.assert_allclose(t[j], t_ref, rtol=1e-12)
+                for mode in h_ref:
+                    np.testing.assert_allclose(h[mode][j], h_ref[mode], rtol=1e-10,
+                                               atol=1e-14 * np.max(np.abs(h_ref[mode])))
+                n_waveforms += 1
+        assert n_waveforms == len(q)
@@ -0,0 +1,322 @@
+"""Tests of the WaveformModes container and the block post-processing (no h5 data needed)."""
+
+import pickle
+
+import numpy as np
+import pytest
+
+from BHPTNRSurrogate.surrogates.common_utils import nr_calibration, utils
+from BHPTNRSurrogate.surrogates.common_utils.waveform_modes import (AmpPhaseModes, WaveformModes,
+                                                                    as_waveform_modes)
+from BHPTNRSurrogate.surrogates.common_utils.workspace import Workspace
+
+MODES = [(2, 2), (2, 1), (3, 3)]
+
+
+@pytest.fixture
+def h_dict():
+    rng = np.random.default_rng(5)
+    t = np.linspace(0, 20, 200)
+    h = {mode: (1 + 0.1 * rng.normal()) * np.exp(-1j * mode[1] * t) for mode in MODES}
+    # coorbital higher modes
+    return {mode: (h[mode] if mode == (2, 2) else rng.normal(size=200) + 1j * rng.normal(size=200))
+            for mode in MODES}
+
+
+class TestWaveformModes:
+    def test_values_are_views_of_the_block(self, h_dict):
+        h = WaveformModes.from_dict(h_dict)
+        assert isinstance(h, dict)
+        assert list(h.keys()) == MODES
+        assert h.data.shape == (3, 200)
+        for i, mode in enumerate(MODES):
+            np.testing.assert_array_equal(h[mode], h_dict[mode])
+            assert np.shares_memory(h[mode], h.data[i])
+        np.testing.assert_array_equal(h.ell, [2, 2, 3])
+        np.testing.assert_array_equal(h.m, [2, 1, 3])
+
+    def test_setitem_writes_into_the_block(self, h_dict):
+        h = WaveformModes.from_dict(h_dict)
+        h[(2, 1)] = 0.0
+        assert np.all(h.data[1] == 0)
+        with pytest.raises(KeyError):
+            h[(4, 4)] = 0.0
+
+    def test_pickle_and_copy(self, h_dict):
+        h = WaveformModes.from_dict(h_dict)
+        for h_new in [pickle.loads(pickle.dumps(h)), h.copy()]:
+            assert h_new.modes == h.modes
+            np.testing.assert_array_equal(h_new.data, h.data)
+            assert np.shares_memory(h_new[(3, 3)], h_new.data)
+            assert not np.shares_memory(h_new.data, h.data)
+
+    def test_per_mode_broadcasts_against_a_batch(self):
+        h = WaveformModes(MODES, np.ones((3, 4, 10), dtype=complex))
+        factors = h.per_mode([2.0, np.arange(4.0).reshape(4, 1), 1.0])
+        assert factors.shape == (3, 4, 1)
+        np.testing.assert_array_equal((h.data * factors)[1, :, 0], np.arange(4.0))
+
+    def test_as_waveform_modes(self, h_dict):
+        h = as_waveform_modes(h_dict)
+        assert as_waveform_modes(h) is h
+
+
+class TestBlockProcessing:
+    def test_negative_m_modes(self, h_dict):
+        h = utils.generate_negative_m_mode(h_dict)
+        assert list(h.keys()) == [(2, 2), (2, -2), (2, 1), (2, -1), (3, 3), (3, -3)]
+        for (l, m) in MODES:
+            np.testing.assert_array_equal(h[(l, m)], h_dict[(l, m)])
+            np.testing.assert_array_equal(h[(l, -m)], (-1)**l * np.conj(h_dict[(l, m)]))
+        with pytest.raises(ValueError):
+            utils.generate_negative_m_mode({(2, -2): h_dict[(2, 2)]})
+
+    def test_negative_m_modes_are_computed_on_access(self, h_dict):
+        h = utils.generate_negative_m_mode(h_dict)
+        assert h.negative_m and h.data.shape == (3, 200)
+        assert len(h) == 6 and (3, -3) in h and (3, -2) not in h
+        assert dict.__len__(h) == 3
+        # the m<0 modes follow the data
+        h.data *= 2
+        np.testing.assert_array_equal(h[(3, -3)], -2 * np.conj(h_dict[(3, 3)]))
+        h[(3, -3)] = 1j * np.ones(200)
+        np.testing.assert_array_equal(h[(3, 3)], 1j * np.ones(200))
+        h_all = h.materialize()
+        assert not h_all.negative_m and h_all.data.shape == (6, 200)
+        assert list(h_all.keys()) == list(h.keys())
+        for mode in h:
+            np.testing.assert_array_equal(h_all[mode], h[mode])
+        assert dict(h).keys() == h_all.keys()
+        h_new = pickle.loads(pickle.dumps(h))
+        assert h_new.negative_m
+        np.testing.assert_array_equal(h_new[(2, -2)], h[(2, -2)])
+
+    def test_sums_use_the_symmetry(self, h_dict):
+        h = utils.generate_negative_m_mode(h_dict)
+        h_all = h.materialize()
+        np.testing.assert_allclose(utils.sum_modes(h), utils.sum_modes(h_all), rtol=1e-14)
+        h_sphere = utils.evaluate_on_sphere(0.7, 0.3, h)
+        np.testing.assert_allclose(h_sphere.data, utils.evaluate_on_sphere(0.7, 0.3, h_all).data, rtol=1e-14)
+        np.testing.assert_allclose(utils.sum_modes(h, 0.7, 0.3), utils.sum_modes(h_sphere), rtol=1e-13)
+        # batch of two waveforms
+        h_batch = h.with_data(np.stack([h.data, 2 * h.data], axis=1))
+        np.testing.assert_allclose(utils.sum_modes(h_batch, 0.7, 0.3)[1], 2 * utils.sum_modes(h, 0.7, 0.3),
+                                   rtol=1e-13)
+
+    def test_batch_with_array_inclination_and_scalar_phase(self, h_dict):
+        h = utils.generate_negative_m_mode(h_dict)
+        h_batch = h.with_data(np.stack([h.data, 2 * h.data], axis=1))
+        inclination = np.array([[0.7], [1.9]])
+        for theta, phi, angles in [(inclination, 0.3, [(0.7, 0.3), (1.9, 0.3)]),
+                                   (0.3, inclination, [(0.3, 0.7), (0.3, 1.9)])]:
+            h_sphere = utils.evaluate_on_sphere(theta, phi, h_batch)
+            h_sum = utils.sum_modes(h_batch, theta, phi)
+            for i, (theta_i, phi_i) in enumerate(angles):
+                np.testing.assert_allclose(h_sphere.data[:, i],
+                                           (i + 1) * utils.evaluate_on_sphere(theta_i, phi_i, h).data, rtol=1e-13)
+                np.testing.assert_allclose(h_sum[i], (i + 1) * utils.sum_modes(h, theta_i, phi_i), rtol=1e-13)
+
+    def test_coorbital_to_inertial(self, h_dict):
+        h = utils.coorbital_to_inertial(h_dict)
+        orbital_phase = np.unwrap(np.angle(h_dict[(2, 2)])) / 2
+        np.testing.assert_array_equal(h[(2, 2)], h_dict[(2, 2)])
+        for (l, m) in [(2, 1), (3, 3)]:
+            np.testing.assert_allclose(h[(l, m)], h_dict[(l, m)] * np.exp(1j * m * orbital_phase),
+                                       rtol=1e-14)
+
+    def test_phase_rotation_and_sum(self, h_dict):
+        h = utils.phase_rotation(h_dict, 0.3)
+        for (l, m) in MODES:
+            np.testing.assert_allclose(h[(l, m)], h_dict[(l, m)] * np.exp(1j * m * 0.3), rtol=1e-14)
+        np.testing.assert_array_equal(utils.sum_modes(h_dict),
+                                      h_dict[(2, 2)] + h_dict[(2, 1)] + h_dict[(3, 3)])
+
+    def test_alpha_scaling(self, h_dict):
+        coefs_alpha = {(2, 2): [0.1, 0, 0, 0], (3, 3): [0.2, 0, 0, 0]}
+        t, h = nr_calibration.generate_calibrated_ppBHPT(0.5, np.arange(3.0), h_dict, coefs_alpha,
+                                                         [0.0, 0, 0, 0], nr_calibration.alpha_beta_BHPTNRSur1dq1e4)
+        np.testing.assert_array_equal(h[(2, 2)], h_dict[(2, 2)] * 1.05)
+        np.testing.assert_array_equal(h[(2, 1)], h_dict[(2, 1)] * 1.05)
+        np.testing.assert_array_equal(h[(3, 3)], h_dict[(3, 3)] * 1.1)
+
+
+class TestFusedProcessing:
+    """obtain_processed_output applies all steps in one pass; compare with the separate steps"""
+
+    coefs_alpha = {(2, 2): [0.1, 0, 0, 0], (3, 3): [0.2, 0, 0, 0]}
+
+    def process(self, h_dict, calibrated, neg_modes, physical, mode_sum, in_place=False):
+        kw = dict(M_tot=60.0, dist_mpc=100.0, orb_phase=0.3, inclination=0.7) if physical else \
+            dict(M_tot=None, dist_mpc=None, orb_phase=None, inclination=None)
+        return utils.obtain_processed_output(0.5, np.arange(200.0), h_dict, self.coefs_alpha, [0.1, 0, 0, 0],
+                                             nr_calibration.alpha_beta_BHPTNRSur1dq1e4, calibrated,
+                                             mode_sum=mode_sum, neg_modes=neg_modes, lmax=3, CoorbToInert=True,
+                                             mass_factor=0.9, norm=0.25, in_place=in_place, **kw)
+
+    @pytest.mark.filterwarnings("ignore:Modes are NOT NR calibrated")
+    @pytest.mark.parametrize("calibrated", [True, False])
+    @pytest.mark.parametrize("neg_modes", [True, False])
+    @pytest.mark.parametrize("physical", [True, False])
+    def test_matches_separate_steps(self, h_dict, calibrated, neg_modes, physical):
+        # separate steps
+        h = utils.coorbital_to_inertial(h_dict)
+        h = h.with_data(h.data * 0.25)
+        if calibrated:
+            t, h = nr_calibration.generate_calibrated_ppBHPT(0.5, np.arange(200.0), h, self.coefs_alpha,
+                                                             [0.1, 0, 0, 0], nr_calibration.alpha_beta_BHPTNRSur1dq1e4)
+        else:
+            t, h = np.arange(200.0) * 0.9, h.with_data(h.data * 0.9)
+        if neg_modes:
+            h = utils.generate_negative_m_mode(h)
+        if physical:
+            t, h = utils.geo_to_SI(t, h, 60.0, 100.0)
+            h = utils.evaluate_on_sphere(0.7, 0.3, h)
+
+        t_fused, h_fused = self.process(h_dict, calibrated, neg_modes, physical, mode_sum=False)
+        np.testing.assert_allclose(t_fused, t, rtol=1e-15)
+        assert list(h_fused.keys()) == list(h.keys())
+        # the m<0 modes are written out only on the sphere
+        assert h_fused.data.shape[0] == (6 if neg_modes and physical else 3)
+        np.testing.assert_allclose(h_fused.data, h.data, rtol=1e-13, atol=1e-13 * np.abs(h.data).max())
+        if physical:
+            _, h_summed = self.process(h_dict, calibrated, neg_modes, physical, mode_sum=True)
+            np.testing.assert_allclose(h_summed, utils.sum_modes(h), rtol=1e-13,
+                                       atol=1e-13 * np.abs(h.data).max())
+
+    def test_in_place(self, h_dict):
+        h_raw = WaveformModes.from_dict(h_dict)
+        raw_data = h_raw.data.copy()
+        _, h = self.process(h_raw, True, neg_modes=False, physical=False, mode_sum=False)
+        np.testing.assert_array_equal(h_raw.data, raw_data)
+        _, h = self.process(h_raw, True, neg_modes=False, physical=False, mode_sum=False, in_place=True)
+        assert h.data is h_raw.data
+
+
+def amp_phase_modes(h_dict, phase_offset=0.0):
+    """ h_dict as amplitude and unwrapped phase, with the phases shifted by phase_offset """
+    return AmpPhaseModes.from_dict({mode: (np.abs(h), np.unwrap(np.angle(h)) + phase_offset)
+                                    for mode, h in h_dict.items()})
+
+
+class TestAmpPhaseModes:
+    def test_amp_and_phase_are_views_of_the_block(self, h_dict):
+        h = amp_phase_modes(h_dict)
+        assert h.data.shape == (3, 2, 200)
+        amp, phase = h[(2, 1)]
+        assert np.shares_memory(amp, h.amp) and np.shares_memory(phase, h.phase)
+        np.testing.assert_array_equal(h.amp[1], np.abs(h_dict[(2, 1)]))
+        h_complex = h.to_complex()
+        for mode in MODES:
+            np.testing.assert_allclose(h_complex[mode], h_dict[mode], rtol=1e-13)
+        assert as_waveform_modes(h).modes == MODES
+        np.testing.assert_array_equal(as_waveform_modes(h).data, h_complex.data)
+
+    def test_negative_m_modes(self, h_dict):
+        h_dict_neg = utils.generate_negative_m_mode(h_dict)
+        h = AmpPhaseModes(MODES, amp_phase_modes(h_dict).data, negative_m=True)
+        assert list(h.keys()) == list(h_dict_neg.keys())
+        h_complex, h_all = h.to_complex(), h.materialize()
+        assert h_all.data.shape == (6, 2, 200)
+        for mode in h_dict_neg:
+            np.testing.assert_allclose(h_complex[mode], h_dict_neg[mode], rtol=1e-13)
+            np.testing.assert_array_equal(h_all[mode], h[mode])
+        # the phase of the m<0 modes stays continuous
+        assert np.abs(np.diff(h[(3, -3)][1])).max() < np.pi
+        h[(3, -3)] = (np.ones(200), np.pi + np.zeros(200))
+        np.testing.assert_array_equal(h[(3, 3)], [np.ones(200), np.zeros(200)])
+        h_new = pickle.loads(pickle.dumps(h))
+        assert type(h_new) is AmpPhaseModes and h_new.negative_m
+
+    def test_polar_decompositions(self):
+        rng = np.random.default_rng(3)
+        x, y = rng.normal(size=(2, 2, 100))
+        for func, polar_func in [(utils.amp_ph_to_comp, utils.amp_ph_to_polar),
+                                 (utils.re_im_to_comp, utils.re_im_to_polar)]:
+            assert utils.polar_decomposition(func) is polar_func
+            amp, phase = polar_func(x, y)
+            np.testing.assert_allclose(amp*np.exp(1j*phase), func(x, y), rtol=1e-13, atol=1e-15)
+            if polar_func is utils.re_im_to_polar:
+                np.testing.assert_array_equal(phase, np.unwrap(phase))
+            # in place
+            out = (x.copy(), y.copy())
+            assert polar_func(out[0], out[1], out=out, workspace=Workspace()) is out
+            np.testing.assert_array_equal(out[0], amp)
+            np.testing.assert_array_equal(out[1], phase)
+        with pytest.raises(ValueError):
+            utils.polar_decomposition(np.exp)
+
+    @pytest.mark.parametrize("offset", [0.0, 3.0, -7.5, 40*np.pi])
+    def test_orbital_phase_from_phase(self, h_dict, offset):
+        h22 = h_dict[(2, 2)] * np.exp(1j*offset)
+        phase22 = np.unwrap(np.angle(h_dict[(2, 2)])) + offset
+        workspace = Workspace()
+        np.testing.assert_allclose(utils._orbital_phase_from_phase(phase22, workspace),
+                                   utils._orbital_phase(h22, Workspace()), rtol=0, atol=1e-12)
+        # batch
+        phase_batch = np.stack([phase22, phase22 + 2*np.pi])
+        np.testing.assert_allclose(utils._orbital_phase_from_phase(phase_batch, workspace),
+                                   utils._orbital_phase(np.stack([h22, h22]), Workspace()), rtol=0, atol=1e-12)
+
+    @pytest.mark.filterwarnings("ignore:Modes are NOT NR calibrated")
+    @pytest.mark.parametrize("calibrated", [True, False])
+    @pytest.mark.parametrize("neg_modes", [True, False])
+    @pytest.mark.parametrize("physical", [True, False])
+    def test_processing_matches_complex_modes(self, h_dict, calibrated, neg_modes, physical):
+        process = TestFusedProcessing().process
+        t, h = process(h_dict, calibrated, neg_modes, physical, mode_sum=False)
+        t_ap, h_ap = process(amp_phase_modes(h_dict, 14*np.pi), calibrated, neg_modes, physical,
+                             mode_sum=False, in_place=True)
+        assert isinstance(h_ap, AmpPhaseModes)
+        np.testing.assert_array_equal(t_ap, t)
+        assert list(h_ap.keys()) == list(h.keys())
+        h_complex = h_ap.to_complex()
+        for mode in h:
+            np.testing.assert_allclose(h_complex[mode], h[mode], rtol=1e-12, atol=1e-12 * np.abs(h.data).max())
+        if physical:
+            with pytest.raises(ValueError):
+                process(amp_phase_modes(h_dict), calibrated, neg_modes, physical, mode_sum=True)
+
+    def test_unwrap_without_jumps(self):
+        phase = 0.3*np.sin(np.linspace(0, 5, 100)) + 2.0
+        np.testing.assert_array_equal(utils._unwrap(phase.copy(), Workspace()), np.unwrap(phase))
+
+
+class TestWorkspace:
+    def test_arrays_are_reused(self):
+        workspace = Workspace()
+        a = workspace.array('a', (3, 4), complex)
+        assert workspace.array('a', (3, 4), complex) is a
+        assert workspace.array('a', (3, 5), complex) is not a
+        assert workspace.array('a', (3, 5)).dtype == float
+
+    def test_thread_workspaces(self):
+        import threading
+        workspace = Workspace()
+        main = workspace.for_thread()
+        assert workspace.for_thread() is main and main is not workspace
+        others = []
+        thread = threading.Thread(target=lambda: others.append(workspace.for_thread()))
+        thread.start()
+        thread.join()
+        assert others[0] is not main
+        others[0].array('a', (1000,))
+        assert workspace.nbytes() == 8000
+        workspace.clear()
+        assert workspace.for_thread() is not main
+
+    def test_orbital_phase_matches_unwrap(self, h_dict):
+        h22 = np.stack([h_dict[(2, 2)], -h_dict[(2, 2)]])
+        # a jump of exactly pi
+        h22[0, 3], h22[0, 4] = -1.0, 1.0
+        workspace = Workspace()
+        for h in [h22, h22[0]]:
+            np.testing.assert_array_equal(utils._orbital_phase(h, workspace), np.unwrap(np.angle(h)) / 2)
+
+    def test_decompositions_into_out(self):
+        rng = np.random.default_rng(2)
+        x, y = rng.normal(size=(2, 50))
+        out = np.empty(50, dtype=complex)
+        assert utils.amp_ph_to_comp(x, y, out=out) is out
+        np.testing.assert_array_equal(out, utils.amp_ph_to_comp(x, y))
+        assert utils.re_im_to_comp(x, y, out=out) is out
+        np.testing.assert_array_equal(out, utils.re_im_to_comp(x, y))